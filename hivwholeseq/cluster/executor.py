@@ -0,0 +1,301 @@
+# vim: fdm=marker
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Execution backends for the cluster jobs: SGE (qsub) or a local pool of
+            processes on a multi-core machine. The fork functions build qsub
+            command lines, which are submitted here.
+
+            The backend is chosen by the environment variable
+            HIVWHOLESEQ_EXECUTOR ('sge', the default, or 'local'); the number
+            of local job slots by HIVWHOLESEQ_LOCAL_JOBS (default: all cores).
+            Jobs running a pool of processes request their slots in the SGE
+            parallel environment HIVWHOLESEQ_PARALLEL_ENVIRONMENT (default: smp).
+'''
+# Modules
+import os
+import sys
+import re
+import time
+import atexit
+import subprocess as sp
+from collections import deque
+
+from . import JOBLOGERR, JOBLOGOUT
+
+
+
+# Globals
+executor_env = 'HIVWHOLESEQ_EXECUTOR'
+local_jobs_env = 'HIVWHOLESEQ_LOCAL_JOBS'
+parallel_environment_env = 'HIVWHOLESEQ_PARALLEL_ENVIRONMENT'
+
+# qsub options without arguments
+_qsub_flags = ('-cwd', '-V')
+
+# Local jobs
+_jobs = {}
+_queue = deque()
+_job_counter = [0]
+
+
+
+# Functions
+def get_executor():
+    '''Get the execution backend from the environment ('sge' or 'local')'''
+    executor = os.getenv(executor_env, 'sge').lower()
+    if executor not in ('sge', 'local'):
+        raise ValueError('Executor not found: '+executor+' (must be sge or local)')
+    return executor
+
+
+def get_local_slots():
+    '''Get the number of local job slots'''
+    if local_jobs_env in os.environ:
+        return int(os.environ[local_jobs_env])
+
+    import multiprocessing as mp
+    return mp.cpu_count()
+
+
+def parse_time(cluster_time):
+    '''Convert a h_rt time (H:MM:SS) into seconds'''
+    seconds = 0
+    for field in cluster_time.split(':'):
+        seconds = 60 * seconds + int(field)
+    return seconds
+
+
+def parse_memory(vmem):
+    '''Convert a h_vmem memory (e.g. 2G, 500M) into bytes'''
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    vmem = vmem.upper()
+    if vmem[-1] in units:
+        return int(float(vmem[:-1]) * units[vmem[-1]])
+    return int(vmem)
+
+
+def get_parallel_environment(threads):
+    '''Get the qsub options requesting slots for a job with a pool of processes'''
+    if threads <= 1:
+        return []
+    return ['-pe', os.getenv(parallel_environment_env, 'smp'), threads]
+
+
+def parse_qsub_call(call_list):
+    '''Parse a qsub command line into the job specification
+
+    Returns:
+       job (dict): with keys 'name', 'time' (s), 'vmem' (bytes), 'logout',
+       'logerr', 'command', and 'slots' (from -pe, else from --threads)
+    '''
+    call_list = map(str, call_list)
+    if call_list[0] != 'qsub':
+        raise ValueError('Not a qsub command line: '+' '.join(call_list))
+
+    job = {'name': 'job',
+           'time': None,
+           'vmem': None,
+           'logout': JOBLOGOUT,
+           'logerr': JOBLOGERR,
+           'slots': 1,
+          }
+
+    i = 1
+    while (i < len(call_list)) and call_list[i].startswith('-'):
+        opt = call_list[i]
+        if opt in _qsub_flags:
+            i += 1
+            continue
+
+        # Parallel environment: name and number of slots
+        if opt == '-pe':
+            job['slots'] = max(1, int(call_list[i + 2].split('-')[-1]))
+            i += 3
+            continue
+
+        arg = call_list[i + 1]
+        if opt == '-N':
+            job['name'] = arg
+        elif opt == '-o':
+            job['logout'] = arg
+        elif opt == '-e':
+            job['logerr'] = arg
+        elif opt == '-l':
+            for resource in arg.split(','):
+                (key, value) = resource.split('=')
+                if key == 'h_rt':
+                    job['time'] = parse_time(value)
+                elif key == 'h_vmem':
+                    job['vmem'] = parse_memory(value)
+        i += 2
+
+    command = call_list[i:]
+    if command[0].endswith('.py'):
+        command = [sys.executable] + command
+    job['command'] = command
+
+    if ('-pe' not in call_list[:i]) and ('--threads' in command):
+        job['slots'] = max(1, int(command[command.index('--threads') + 1]))
+
+    return job
+
+
+def get_log_filename(folder, name, jobid, kind='o'):
+    '''Get the log filename of a job, like SGE (<name>.o<jobid>)'''
+    if not folder.endswith('/'):
+        return folder
+    return folder+re.sub('[ /]', '_', name)+'.'+kind+str(jobid)
+
+
+def _start_local_job(job):
+    '''Start a local job in a child process, with its memory limit'''
+    vmem = job['vmem']
+    def set_limits():
+        if vmem is not None:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS, (vmem, vmem))
+
+    with open(get_log_filename(job['logout'], job['name'], job['id'], 'o'), 'w') as fout, \
+         open(get_log_filename(job['logerr'], job['name'], job['id'], 'e'), 'w') as ferr:
+        job['process'] = sp.Popen(job['command'], stdout=fout, stderr=ferr,
+                                  preexec_fn=set_limits)
+    job['start'] = time.time()
+    job['status'] = 'running'
+
+
+def _schedule_local():
+    '''Reap finished local jobs, kill those over time, and start queued ones'''
+    slots_used = 0
+    for job in _jobs.itervalues():
+        if job['status'] != 'running':
+            continue
+
+        returncode = job['process'].poll()
+        if returncode is None:
+            if (job['time'] is not None) and (time.time() - job['start'] > job['time']):
+                job['process'].kill()
+                job['process'].wait()
+                job['status'] = 'killed'
+            else:
+                slots_used += job['slots']
+        elif returncode == 0:
+            job['status'] = 'done'
+        else:
+            job['status'] = 'failed'
+
+    # Jobs bigger than the machine run alone
+    slots = get_local_slots()
+    while _queue:
+        job = _jobs[_queue[0]]
+        if slots_used and (slots_used + job['slots'] > slots):
+            break
+        _queue.popleft()
+        _start_local_job(job)
+        slots_used += job['slots']
+
+
+def submit(call_list, VERBOSE=0):
+    '''Submit a job from its qsub command line
+
+    Returns:
+       output (str): the submission message, as from qsub
+    '''
+    call_list = map(str, call_list)
+    if get_executor() == 'sge':
+        return sp.check_output(call_list)
+
+    job = parse_qsub_call(call_list)
+    _job_counter[0] += 1
+    job['id'] = 'local'+str(os.getpid())+'.'+str(_job_counter[0])
+    job['status'] = 'queued'
+    _jobs[job['id']] = job
+    _queue.append(job['id'])
+    _schedule_local()
+
+    if VERBOSE >= 2:
+        print 'Local job', job['id'], job['status']+':', ' '.join(job['command'])
+
+    return 'Your job '+job['id']+' ("'+job['name']+'") has been submitted\n'
+
+
+def get_job_id(output):
+    '''Get the job ID from the submission message'''
+    match = re.search('Your job(?:-array)? ([^ ]+) ', output)
+    if match is None:
+        raise ValueError('Job ID not found: '+output)
+
+    # SGE job arrays have IDs like 12345.1-10:1
+    jobid = match.group(1)
+    if not jobid.startswith('local'):
+        jobid = jobid.split('.')[0]
+    return jobid
+
+
+def poll(jobid):
+    '''Get the status of a job
+
+    Returns:
+       status (str): 'queued', 'running', 'done', 'failed', or 'killed' (over
+       time); SGE jobs are only 'running' (incl. queued) or 'done'
+    '''
+    if jobid in _jobs:
+        _schedule_local()
+        return _jobs[jobid]['status']
+
+    with open(os.devnull, 'w') as devnull:
+        returncode = sp.call(['qstat', '-j', jobid], stdout=devnull, stderr=devnull)
+    return 'running' if returncode == 0 else 'done'
+
+
+def iter_finished(jobids, interval=None, VERBOSE=0):
+    '''Iterate over jobs as they finish, without waiting for the slowest one
+
+    Parameters:
+       jobids (list): the jobs to follow
+       interval (float): seconds between checks of the job statuses (default:
+       1 for the local executor, 10 for SGE)
+
+    Yields:
+       (jobid, status): each job once, as soon as it is not running any more
+    '''
+    if interval is None:
+        interval = 1 if get_executor() == 'local' else 10
+
+    pending = list(jobids)
+    while True:
+        still_pending = []
+        for jobid in pending:
+            status = poll(jobid)
+            if status in ('queued', 'running'):
+                still_pending.append(jobid)
+            else:
+                yield (jobid, status)
+        pending = still_pending
+
+        if not pending:
+            break
+        if VERBOSE >= 2:
+            print 'Jobs still running:', len(pending)
+        time.sleep(interval)
+
+
+def wait(jobids=None, interval=10, VERBOSE=0):
+    '''Wait until jobs are finished (default: all local jobs)
+
+    Returns:
+       statuses (dict): jobid -> final status
+    '''
+    if jobids is None:
+        jobids = _jobs.keys()
+
+    return dict(iter_finished(jobids, interval=interval, VERBOSE=VERBOSE))
+
+
+def _wait_local_jobs():
+    '''Wait for local jobs before the submitting script exits'''
+    if _jobs:
+        wait(interval=1)
+
+
+atexit.register(_wait_local_jobs)
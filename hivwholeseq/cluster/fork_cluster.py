@@ -6,9 +6,8 @@ content:    Module with all submit functions for the cluster. With this we can
             keep all cluster-specific code in one place.
 '''
 # Globals
-import subprocess as sp
-
 from . import JOBDIR, JOBLOGERR, JOBLOGOUT
+from .executor import submit, get_parallel_environment
 
 
 
@@ -59,7 +58,7 @@ def fork_check_pipeline(seq_runs, adaIDs=None, pats=False,
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
 def fork_quality_along_read(seq_run, VERBOSE=0, maxreads=-1, savefig=True):
@@ -88,10 +87,11 @@ def fork_quality_along_read(seq_run, VERBOSE=0, maxreads=-1, savefig=True):
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
-def fork_demultiplex(seq_run, VERBOSE=0, maxreads=-1, summary=True):
+def fork_demultiplex(seq_run, VERBOSE=0, maxreads=-1, summary=True,
+                     threads=1, compresslevel=6, max_mismatches=1):
     '''Submit demultiplex script to the cluster'''
     if VERBOSE:
         print 'Forking to the cluster'
@@ -107,17 +107,23 @@ def fork_demultiplex(seq_run, VERBOSE=0, maxreads=-1, summary=True):
                  '-N', 'demux',
                  '-l', 'h_rt='+cluster_times[not (0 < maxreads < 1e6)],
                  '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
-                 '--run', seq_run,
-                 '--verbose', VERBOSE,
-                 '--maxreads', maxreads,
                 ]
+    # The script runs a pool of processes: request its slots
+    call_list.extend(get_parallel_environment(threads))
+    call_list.extend([JOBSCRIPT,
+                      '--run', seq_run,
+                      '--verbose', VERBOSE,
+                      '--maxreads', maxreads,
+                      '--threads', threads,
+                      '--compresslevel', compresslevel,
+                      '--max-mismatches', max_mismatches,
+                     ])
     if not summary:
         call_list.append('--no-summary')
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
 def fork_trim(seq_run, adaID, VERBOSE=0, summary=True):
@@ -146,7 +152,7 @@ def fork_trim(seq_run, adaID, VERBOSE=0, summary=True):
     call_list = map(str, call_list)
     if VERBOSE >= 2:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
 def fork_premap(seq_run, adaID, VERBOSE=0, threads=1, maxreads=-1,
@@ -189,7 +195,7 @@ def fork_premap(seq_run, adaID, VERBOSE=0, threads=1, maxreads=-1,
     call_list = map(str, call_list)
     if VERBOSE >= 2:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
 def fork_premapped_coverage(samplename, VERBOSE=0, maxreads=-1):
@@ -217,11 +223,11 @@ def fork_premapped_coverage(samplename, VERBOSE=0, maxreads=-1):
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
 def fork_trim_and_divide(seq_run, adaID, VERBOSE=0, maxreads=-1, minisize=100,
-                         summary=True):
+                         summary=True, threads=1):
     '''Submit trim and divide script to the cluster for each adapter ID'''
     if VERBOSE:
         print 'Forking to the cluster: adaID '+adaID
@@ -237,19 +243,23 @@ def fork_trim_and_divide(seq_run, adaID, VERBOSE=0, maxreads=-1, minisize=100,
                  '-N', 'trdv '+adaID,
                  '-l', 'h_rt='+cluster_time,
                  '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
-                 '--run', seq_run,
-                 '--adaIDs', adaID,
-                 '--verbose', VERBOSE,
-                 '--maxreads', maxreads,
-                 '--minisize', minisize,
                 ]
+    # The script runs a pool of processes: request its slots
+    call_list.extend(get_parallel_environment(threads))
+    call_list.extend([JOBSCRIPT,
+                      '--run', seq_run,
+                      '--adaIDs', adaID,
+                      '--verbose', VERBOSE,
+                      '--maxreads', maxreads,
+                      '--minisize', minisize,
+                      '--threads', threads,
+                     ])
     if not summary:
         call_list.append('--no-summary')
     call_list = map(str, call_list)
     if VERBOSE >= 2:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
 def fork_build_consensus_iterative(seq_run, adaID, fragment, n_reads=1000,
@@ -282,7 +292,7 @@ def fork_build_consensus_iterative(seq_run, adaID, fragment, n_reads=1000,
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
 def fork_build_consensus(seq_run, adaID, fragment,
@@ -323,7 +333,7 @@ def fork_build_consensus(seq_run, adaID, fragment,
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
 def fork_map_to_consensus(seq_run, adaID, fragment, VERBOSE=3,
@@ -366,7 +376,7 @@ def fork_map_to_consensus(seq_run, adaID, fragment, VERBOSE=3,
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
 def fork_filter_mapped(seq_run, adaID, fragment, VERBOSE=0, maxreads=-1,
@@ -401,7 +411,7 @@ def fork_filter_mapped(seq_run, adaID, fragment, VERBOSE=0, maxreads=-1,
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
 def fork_get_allele_counts(seq_run, adaID, fragment, VERBOSE=3):
@@ -429,7 +439,7 @@ def fork_get_allele_counts(seq_run, adaID, fragment, VERBOSE=3):
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
 def fork_filter_allele_frequencies(seq_run, adaID, fragment, VERBOSE=3, summary=True):
@@ -459,7 +469,7 @@ def fork_filter_allele_frequencies(seq_run, adaID, fragment, VERBOSE=3, summary=
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
 def fork_extract_mutations(seq_run, adaID, VERBOSE=0, summary=True):
@@ -487,7 +497,7 @@ def fork_extract_mutations(seq_run, adaID, VERBOSE=0, summary=True):
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
 def fork_get_coallele_counts(data_folder, adaID, fragment, VERBOSE=3, summary=True):
@@ -516,7 +526,7 @@ def fork_get_coallele_counts(data_folder, adaID, fragment, VERBOSE=3, summary=Tr
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
 def fork_split_for_mapping(seq_run, adaID, fragment, VERBOSE=0, maxreads=-1, chunk_size=10000):
@@ -546,7 +556,7 @@ def fork_split_for_mapping(seq_run, adaID, fragment, VERBOSE=0, maxreads=-1, chu
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
 # PHIX
@@ -577,7 +587,7 @@ def fork_get_allele_counts_phix(seq_run, maxreads=-1, VERBOSE=0, qual_min=None):
     call_list = map(str, call_list)
     if VERBOSE >= 2:
         print ' '.join(call_list)
-    sp.call(call_list)
+    submit(call_list, VERBOSE=VERBOSE)
 
 
 # PATIENTS
@@ -622,13 +632,14 @@ def fork_map_to_initial_reference(samplename, fragment,
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, VERBOSE=VERBOSE)
 
 
 def fork_filter_mapped_init(samplename, fragment,
                             VERBOSE=0, n_pairs=-1,
                             PCR=1,
-                            summary=True):
+                            summary=True,
+                            threads=1):
     '''Fork to the cluster for each sample and fragment'''
     if VERBOSE:
         print 'Forking to the cluster: sample '+samplename+', fragment '+fragment
@@ -645,19 +656,23 @@ def fork_filter_mapped_init(samplename, fragment,
                  '-N', 'fmi '+samplename+' '+fragment,
                  '-l', 'h_rt='+cluster_time,
                  '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
-                 '--samples', samplename,
-                 '--fragments', fragment,
-                 '--verbose', VERBOSE,
-                 '--maxreads', n_pairs,
-                 '--PCR', PCR,
                 ]
+    # The script runs a pool of processes: request its slots
+    qsub_list.extend(get_parallel_environment(threads))
+    qsub_list.extend([JOBSCRIPT,
+                      '--samples', samplename,
+                      '--fragments', fragment,
+                      '--verbose', VERBOSE,
+                      '--maxreads', n_pairs,
+                      '--PCR', PCR,
+                      '--threads', threads,
+                     ])
     if not summary:
-        call_list.append('--no-summary')
+        qsub_list.append('--no-summary')
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, VERBOSE=VERBOSE)
 
 
 def fork_build_consensus_patient(samplename_pat, fragment, VERBOSE=0, PCR=1,
@@ -690,7 +705,7 @@ def fork_build_consensus_patient(samplename_pat, fragment, VERBOSE=0, PCR=1,
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, VERBOSE=VERBOSE)
 
 
 def fork_get_allele_counts_patient(samplename, fragment, VERBOSE=0, PCR=1, qual_min=30):
@@ -721,7 +736,7 @@ def fork_get_allele_counts_patient(samplename, fragment, VERBOSE=0, PCR=1, qual_
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, VERBOSE=VERBOSE)
 
 
 def fork_get_insertions_patient(samplename, fragment, VERBOSE=0, PCR=1, qual_min=30):
@@ -752,7 +767,7 @@ def fork_get_insertions_patient(samplename, fragment, VERBOSE=0, PCR=1, qual_min
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, VERBOSE=VERBOSE)
 
 
 def fork_get_allele_counts_aa_patient(samplename, protein, VERBOSE=0, PCR=1, qual_min=30):
@@ -783,19 +798,23 @@ def fork_get_allele_counts_aa_patient(samplename, protein, VERBOSE=0, PCR=1, qua
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, VERBOSE=VERBOSE)
 
 
 def fork_get_cocounts_patient(samplename, fragment, VERBOSE=0,
                               PCR=1, qual_min=30,
-                              maxreads=-1, use_tests=False):
+                              maxreads=-1, use_tests=False,
+                              sparse=False):
     '''Fork to the cluster for each patient, sample, and fragment'''
     if VERBOSE:
         print 'Forking to the cluster: sample '+samplename+', fragment '+fragment
 
     JOBSCRIPT = JOBDIR+'store/store_allele_cocounts.py'
     cluster_time = '23:59:59'
-    vmem = '8G'
+    if sparse:
+        vmem = '2G'
+    else:
+        vmem = '8G'
 
     qsub_list = ['qsub','-cwd',
                  '-b', 'y',
@@ -816,14 +835,16 @@ def fork_get_cocounts_patient(samplename, fragment, VERBOSE=0,
                 ]
     if use_tests:
         qsub_list.append('--tests')
+    if sparse:
+        qsub_list.append('--sparse')
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, VERBOSE=VERBOSE)
 
 
 def fork_compress_cocounts_patient(samplename, fragment, VERBOSE=0,
-                                   PCR=1, qual_min=30):
+                                   PCR=1, qual_min=30, sparse=False):
     '''Fork to the cluster for each patient, sample, and fragment'''
     if VERBOSE:
         print 'Forking to the cluster: sample '+samplename+', fragment '+fragment
@@ -847,15 +868,19 @@ def fork_compress_cocounts_patient(samplename, fragment, VERBOSE=0,
                  '--qualmin', qual_min,
                  '--PCR', PCR,
                 ]
+    if sparse:
+        qsub_list.append('--sparse')
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, VERBOSE=VERBOSE)
 
 
 
 def fork_decontaminate_reads_patient(samplename, fragment, VERBOSE=0, PCR=None,
-                                     maxreads=-1, summary=True):
+                                     maxreads=-1, summary=True,
+                                     kmer=12, candidates=5, validate=False,
+                                     threads=1):
     '''Fork to the cluster the decontamination of reads'''
     if VERBOSE:
         print 'Fork to cluster: sample', samplename, fragment
@@ -872,21 +897,32 @@ def fork_decontaminate_reads_patient(samplename, fragment, VERBOSE=0, PCR=None,
                  '-N', 'de'+fragment+samplename,
                  '-l', 'h_rt='+cluster_time,
                  '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
-                 '--samples', samplename,
-                 '--fragments', fragment,
-                 '--verbose', VERBOSE,
                 ]
+    # The script runs a pool of processes: request its slots
+    qsub_list.extend(get_parallel_environment(threads))
+    qsub_list.extend([JOBSCRIPT,
+                      '--samples', samplename,
+                      '--fragments', fragment,
+                      '--verbose', VERBOSE,
+                     ])
     if PCR is not None:
         qsub_list.extend(['--PCR', PCR])
     if maxreads != -1:
         qsub_list.extend(['--maxreads', maxreads])
     if not summary:
         qsub_list.append('--no-summary')
+    if kmer != 12:
+        qsub_list.extend(['--kmer', kmer])
+    if candidates != 5:
+        qsub_list.extend(['--candidates', candidates])
+    if validate:
+        qsub_list.append('--validate-kmers')
+    if threads > 1:
+        qsub_list.extend(['--threads', threads])
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, VERBOSE=VERBOSE)
 
 
 def fork_get_allele_frequency_trajectory(pname, fragment, VERBOSE=0):
@@ -915,7 +951,7 @@ def fork_get_allele_frequency_trajectory(pname, fragment, VERBOSE=0):
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, VERBOSE=VERBOSE)
 
 
 def fork_store_haplotypes_scan(pname, width, gap, start, end, VERBOSE=0,
@@ -949,7 +985,7 @@ def fork_store_haplotypes_scan(pname, width, gap, start, end, VERBOSE=0,
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, VERBOSE=VERBOSE)
 
 
 # WEBSITE
@@ -977,7 +1013,7 @@ def fork_store_haplotypes_website(pname, region, VERBOSE=0):
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, VERBOSE=VERBOSE)
 
 
 def fork_store_cocounts_website(pname, samplenumber, fragment, VERBOSE=0):
@@ -1005,7 +1041,7 @@ def fork_store_cocounts_website(pname, samplenumber, fragment, VERBOSE=0):
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, VERBOSE=VERBOSE)
 
 
 
@@ -1035,5 +1071,5 @@ def fork_calculate_beta_SFS(alpha, N, VERBOSE=0):
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, VERBOSE=VERBOSE)
 
@@ -75,3 +75,10 @@ def get_custom_alignment_filename(aliname, format='fasta'):
     filename = 'alignments/'+aliname
     filename = filename+'.'+format
     return reference_folder+filename
+
+
+def get_table_cache_filename(sheetname, index_col=0):
+    '''Get the filename of the binary cache of a sheet of the general table'''
+    filename = 'table_cache/'+sheetname.replace(' ', '_')+'_'+str(index_col)
+    filename = filename+'.pickle'
+    return tmp_folder+filename
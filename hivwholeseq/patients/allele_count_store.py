@@ -0,0 +1,148 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Store of the allele counts of all samples of a patient, one
+            contiguous memory-mapped array (time, read type, allele, position)
+            per fragment, with a small JSON index of the samples.
+'''
+# Modules
+import os
+import fcntl
+from contextlib import contextmanager
+import numpy as np
+
+from hivwholeseq.utils.generic import read_json, write_json
+from hivwholeseq.patients.filenames import \
+        get_allele_count_trajectories_store_filename as get_store_filename
+
+
+
+# Functions
+@contextmanager
+def _lock_store(pname, fragment, qual_min=30):
+    '''Lock the store against concurrent writers (e.g. cluster jobs)'''
+    fn = get_store_filename(pname, fragment, qual_min=qual_min, index=True)+'.lock'
+    with open(fn, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load_allele_count_store_index(pname, fragment, qual_min=30):
+    '''Load the index of the allele count store, or None if there is no store
+
+    Returns:
+       index (dict): with keys 'samples' (list of [samplename, PCR]), 'shape'
+       (read types, alleles, length of one sample) and 'dtype'
+    '''
+    fn = get_store_filename(pname, fragment, qual_min=qual_min, index=True)
+    if not os.path.isfile(fn):
+        return None
+    index = read_json(fn)
+    index['samples'] = [tuple(s) for s in index['samples']]
+    return index
+
+
+def load_allele_count_store(pname, fragment, qual_min=30, mode='r'):
+    '''Open the allele count store of a patient fragment without loading it
+
+    Returns:
+       samples (list): (samplename, PCR) of each time point in the store
+       counts (np.memmap): allele counts, shape (samples, read types, alleles, L).
+       Slicing it, e.g. counts[:, :, :, start: end], does not copy any data.
+    '''
+    index = load_allele_count_store_index(pname, fragment, qual_min=qual_min)
+    if index is None:
+        raise IOError('Allele count store not found: '+pname+', '+fragment)
+
+    samples = index['samples']
+    shape = tuple([len(samples)] + list(index['shape']))
+    if not len(samples):
+        return (samples, np.zeros(shape, index['dtype']))
+
+    fn = get_store_filename(pname, fragment, qual_min=qual_min)
+    counts = np.memmap(fn, dtype=index['dtype'], mode=mode, shape=shape)
+    return (samples, counts)
+
+
+def add_allele_counts_to_store(pname, samplename, fragment, counts, PCR=1,
+                               qual_min=30, VERBOSE=0):
+    '''Add or replace the allele counts of one sample in the store
+
+    Parameters:
+       counts (ndarray): allele counts of the sample, shape (read types, alleles, L)
+
+    The store is created if missing; new samples are appended at the end of
+    the file, so existing data is never rewritten. If the shape differs from
+    the store (e.g. after a correction of the reference), the old store is
+    dropped and a new one started: the other samples are added back when the
+    store is rebuilt from their allele count files.
+    '''
+    fn = get_store_filename(pname, fragment, qual_min=qual_min)
+    fn_index = get_store_filename(pname, fragment, qual_min=qual_min, index=True)
+    key = (samplename, PCR)
+
+    with _lock_store(pname, fragment, qual_min=qual_min):
+        index = load_allele_count_store_index(pname, fragment, qual_min=qual_min)
+        if (index is not None) and (tuple(counts.shape) != tuple(index['shape'])):
+            if VERBOSE >= 1:
+                print 'Allele count store dropped: shape '+\
+                        str(tuple(index['shape']))+', sample has '+str(counts.shape)
+            os.remove(fn_index)
+            if os.path.isfile(fn):
+                os.remove(fn)
+            index = None
+
+        if index is None:
+            index = {'samples': [],
+                     'shape': list(counts.shape),
+                     'dtype': np.dtype(counts.dtype).str,
+                    }
+            open(fn, 'wb').close()
+
+        counts = np.ascontiguousarray(counts, dtype=index['dtype'])
+
+        if key in index['samples']:
+            i = index['samples'].index(key)
+            (_, store) = load_allele_count_store(pname, fragment,
+                                                 qual_min=qual_min, mode='r+')
+            store[i] = counts
+            store.flush()
+            del store
+            if VERBOSE >= 2:
+                print 'Allele counts replaced in store:', samplename, PCR, fragment
+
+        else:
+            # Write right after the samples in the index and cut anything
+            # beyond, e.g. left over by a job that died before the index
+            with open(fn, 'r+b') as f:
+                f.seek(len(index['samples']) * counts.nbytes)
+                f.write(counts.tostring())
+                f.truncate()
+            index['samples'].append(key)
+            if VERBOSE >= 2:
+                print 'Allele counts added to store:', samplename, PCR, fragment
+
+        # Write the index atomically, after the data
+        index['samples'] = map(list, index['samples'])
+        write_json(index, fn_index+'.tmp')
+        os.rename(fn_index+'.tmp', fn_index)
+
+
+def build_allele_count_store(pname, samplenames, fragment, qual_min=30,
+                             PCRs=(1, 2), VERBOSE=0):
+    '''Build the allele count store from the allele count files of the samples'''
+    from hivwholeseq.patients.filenames import get_allele_counts_filename
+
+    for samplename in samplenames:
+        for PCR in PCRs:
+            fn = get_allele_counts_filename(pname, samplename, fragment, PCR=PCR,
+                                            qual_min=qual_min)
+            if not os.path.isfile(fn):
+                continue
+
+            add_allele_counts_to_store(pname, samplename, fragment, np.load(fn),
+                                       PCR=PCR, qual_min=qual_min, VERBOSE=VERBOSE)
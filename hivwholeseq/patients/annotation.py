@@ -0,0 +1,183 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Parsed and indexed patient references, cached across calls.
+'''
+# Modules
+import os
+from collections import OrderedDict
+
+from hivwholeseq.utils.exceptions import RoiError
+
+
+
+# Classes
+class LRUCache(object):
+    '''Dictionary that keeps only the most recently used items'''
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+    def __getitem__(self, key):
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            del self._data[key]
+        elif len(self._data) >= self.maxsize:
+            self._data.popitem(last=False)
+        self._data[key] = value
+
+
+    def clear(self):
+        self._data.clear()
+
+
+
+class AnnotationIndex(object):
+    '''Index of the features of an annotated genomewide reference
+
+    Every feature is stored by name with its genomewide coordinates, so that
+    a region of interest can be resolved into fragment coordinates without
+    scanning the features of the reference.
+    '''
+
+    def __init__(self, refseq):
+        '''Build the index from an annotated genomewide reference (SeqRecord)'''
+        self.length = len(refseq)
+        self.fragments = []
+        self.features = {}
+        for fea in refseq.features:
+            coord = (fea.location.nofuzzy_start, fea.location.nofuzzy_end)
+            if fea.type == 'fragment':
+                self.fragments.append((fea.id,) + coord)
+
+            # Like list.index, the first feature with a name wins
+            if fea.id not in self.features:
+                self.features[fea.id] = coord
+
+        self._cache = {}
+
+
+    def find_fragment(self, start, end, include_genomewide=False):
+        '''Find the first fragment fully covering a genomewide interval'''
+        key = (start, end, include_genomewide)
+        if key in self._cache:
+            return self._cache[key]
+
+        for (fr_name, fr_start, fr_end) in self.fragments:
+            if (fr_start <= start) and (fr_end >= end):
+                roi = (fr_name, start - fr_start, end - fr_start)
+                break
+        else:
+            if not include_genomewide:
+                raise RoiError('No fragment found that fully covers this roi')
+            roi = ('genomewide', start, end)
+
+        self._cache[key] = roi
+        return roi
+
+
+    def get_fragmented_roi(self, roi, VERBOSE=0, include_genomewide=False):
+        '''From a Region Of Interest, get fragment(s), start and end coordinates'''
+        if roi[0] in ['F'+str(i) for i in xrange(1, 7)]:
+            start = roi[1]
+            if roi[2] != '+oo':
+                end = roi[2]
+            elif roi[0] not in self.features:
+                raise ValueError('Fragment not found: '+roi[0])
+            else:
+                (fr_start, fr_end) = self.features[roi[0]]
+                end = fr_end - fr_start
+            roi = (roi[0], start, end)
+
+            if VERBOSE >= 3:
+                print 'Fragment selected', roi
+            return roi
+
+        if roi[0] == 'genomewide':
+            start = roi[1]
+            if roi[2] != '+oo':
+                end = roi[2]
+            else:
+                end = self.length
+
+            roi = self.find_fragment(start, end, include_genomewide=include_genomewide)
+            if VERBOSE >= 3:
+                print 'Genomewide selected', roi
+            return roi
+
+        elif roi[0] in self.features:
+            (fea_start, fea_end) = self.features[roi[0]]
+            start = roi[1] + fea_start
+            if roi[2] != '+oo':
+                end = roi[2] + fea_start
+            else:
+                end = fea_end
+
+            roi = self.find_fragment(start, end, include_genomewide=include_genomewide)
+            if VERBOSE >= 3:
+                print 'Feature selected', roi
+            return roi
+
+        raise ValueError('Roi not understood')
+
+
+
+# Globals
+_references = LRUCache(maxsize=64)
+_indices = LRUCache(maxsize=64)
+
+
+
+# Functions
+def _copy_record(record):
+    '''Copy a SeqRecord, including features and annotations'''
+    record_new = record[:]
+    record_new.annotations = dict(record.annotations)
+    record_new.dbxrefs = list(record.dbxrefs)
+    return record_new
+
+
+def load_reference(filename, format='fasta'):
+    '''Load a reference from file, parsing it only if it changed since last time
+
+    Returns:
+       refseq (SeqRecord): a copy of the reference, safe to modify
+    '''
+    from Bio import SeqIO
+
+    mtime = os.path.getmtime(filename)
+    key = (filename, format)
+    if (key in _references) and (_references[key][0] == mtime):
+        return _copy_record(_references[key][1])
+
+    refseq = SeqIO.read(filename, format)
+    if format in ('gb', 'genbank'):
+        from hivwholeseq.utils.sequence import correct_genbank_features_load
+        correct_genbank_features_load(refseq)
+
+    _references[key] = (mtime, refseq)
+    return _copy_record(refseq)
+
+
+def get_annotation_index(filename, format='gb'):
+    '''Get the feature index of an annotated reference, cached by file'''
+    mtime = os.path.getmtime(filename)
+    key = (filename, format)
+    if (key in _indices) and (_indices[key][0] == mtime):
+        return _indices[key][1]
+
+    index = AnnotationIndex(load_reference(filename, format=format))
+    _indices[key] = (mtime, index)
+    return index
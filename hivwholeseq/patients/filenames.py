@@ -193,10 +193,13 @@ def get_insertions_filename(pname, samplename_pat, fragment, PCR=1, qual_min=30,
 
 
 def get_allele_cocounts_filename(pname, samplename_pat, fragment, PCR=1, qual_min=30,
-                                 compressed=True):
+                                 compressed=True, sparse=False):
     '''Get the matrix of allele cocounts on the initial reference'''
-    filename = 'allele_cocounts_'+fragment+'_qual'+str(qual_min)+'+'+'.'
-    if compressed:
+    filename = 'allele_cocounts_'
+    if sparse:
+        filename = filename+'sparse_'
+    filename = filename+fragment+'_qual'+str(qual_min)+'+'+'.'
+    if compressed or sparse:
         filename = filename+'npz'
     else:
         filename = filename+'npy'
@@ -219,6 +222,22 @@ def get_allele_count_trajectories_filename(pname, fragment):
     return filename
 
 
+def get_allele_count_trajectories_store_filename(pname, fragment, qual_min=30,
+                                                 index=False):
+    '''Get the memory-mapped store of allele counts of all samples of a patient
+
+    Parameters:
+       index (bool): get the filename of the sidecar index (samples, shape)
+    '''
+    filename = 'allele_counts_trajectories_'+fragment+'_qual'+str(qual_min)+'+'
+    if index:
+        filename = filename+'_index.json'
+    else:
+        filename = filename+'.dat'
+    filename = get_foldername(pname)+filename
+    return filename
+
+
 def get_allele_frequency_trajectories_filename(pname, fragment):
     '''Get the matrix with allele frequencies on the initial reference'''
     filename = 'allele_frequency_trajectories_'+fragment+'.npz'
@@ -118,17 +118,74 @@ def trim_read_roi(read, start, end):
     return seq
 
 
-def get_local_haplotypes(bamfilename, start, end, VERBOSE=0, maxreads=-1,
-                         label=''):
-    '''Extract reads fully covering the region, discarding insertions'''
+def get_read_pair_haplotype(reads, start, end):
+    '''Get the haplotype of a read pair in a region, or None if not covered
+
+    Parameters:
+       reads (pair of reads): the read pair, fwd read first
+       start (int): start of the region
+       end (int): end of the region
+    '''
+    # Check for coverage of the region
+    start_fwd = reads[0].pos
+    end_fwd = start_fwd + sum(bl for (bt, bl) in reads[0].cigar if bt in (0, 2))
+    start_rev = reads[1].pos
+    end_rev = start_rev + sum(bl for (bt, bl) in reads[1].cigar if bt in (0, 2))
+    overlap_len = max(0, end_fwd - start_rev)
+
+    # Various scenarios possible
+    if start_fwd > start:
+        return None
+
+    if end_rev < end:
+        return None
+
+    # No single read covers the whole region AND (the insert has a whole
+    # OR a very short overlap)
+    if (end_fwd < end) and (start_rev > start) and (overlap_len < 20):
+        return None
+
+    # Now the good cases
+    if (start_fwd <= start) and (end_fwd >= end):
+        seq = trim_read_roi(reads[0], start, end)
+
+    elif (start_rev <= start) and (end_rev >= end):
+        seq = trim_read_roi(reads[1], start, end)
+
+    else:
+        seqs = [trim_read_roi(read, start, end) for read in reads]
+        seq = merge_read_pair(*seqs)
+
+    return seq
+
+
+def get_local_haplotypes_windows(bamfilename, windows, VERBOSE=0, maxreads=-1,
+                                 label=''):
+    '''Extract reads fully covering each of several regions, in one pass
+
+    Parameters:
+       bamfilename (str): path to the BAM file with the read pairs
+       windows (list): (start, end) of each region
+       maxreads (int): use a random subsample of read pairs (-1: all)
+       label (str): prefix of the progress output
+
+    Returns:
+       haplotypes (list of Counters): one per window, same order as windows
+    '''
     import sys
     import pysam
     from hivwholeseq.utils.mapping import pair_generator
     from hivwholeseq.utils.mapping import extract_mapped_reads_subsample_open
 
     from collections import Counter
-    haplotypes = Counter()
+    haplotypes = [Counter() for window in windows]
 
+    # Sort windows by start, to dispatch each read pair to the windows it spans
+    ind_sort = np.argsort([window[0] for window in windows], kind='mergesort')
+    starts = np.array([windows[i][0] for i in ind_sort], int)
+    ends = np.array([windows[i][1] for i in ind_sort], int)
+
+    irp = 0
     with pysam.Samfile(bamfilename, 'rb') as bamfile:
 
         if maxreads == -1:
@@ -153,39 +210,19 @@ def get_local_haplotypes(bamfilename, start, end, VERBOSE=0, maxreads=-1,
             is_fwd = reads[0].is_reverse
             reads = [reads[is_fwd], reads[not is_fwd]]
 
-            # Check for coverage of the region
+            # Only windows within the read pair span can be covered
             start_fwd = reads[0].pos
-            end_fwd = start_fwd + sum(bl for (bt, bl) in reads[0].cigar if bt in (0, 2))
-            start_rev = reads[1].pos
-            end_rev = start_rev + sum(bl for (bt, bl) in reads[1].cigar if bt in (0, 2))
-            overlap_len = max(0, end_fwd - start_rev)
-
-            # Various scenarios possible
-            if start_fwd > start:
-                continue
-
-            if end_rev < end:
-                continue
-
-            # No single read covers the whole region AND (the insert has a whole
-            # OR a very short overlap)
-            if (end_fwd < end) and (start_rev > start) and (overlap_len < 20):
-                continue
-
-            # Now the good cases
-            if (start_fwd <= start) and (end_fwd >= end):
-                seq = trim_read_roi(reads[0], start, end)
-
-            elif (start_rev <= start) and (end_rev >= end):
-                seq = trim_read_roi(reads[1], start, end)
-
-            else:
-                seqs = [trim_read_roi(read, start, end) for read in reads]
-                seq = merge_read_pair(*seqs)
-
-            haplotypes[seq] += 1
-            if VERBOSE >= 4:
-                import ipdb; ipdb.set_trace()
+            end_rev = reads[1].pos + sum(bl for (bt, bl) in reads[1].cigar
+                                         if bt in (0, 2))
+            iw_start = starts.searchsorted(start_fwd, side='left')
+            iw_end = starts.searchsorted(end_rev, side='right')
+            for iw in xrange(iw_start, iw_end):
+                if ends[iw] > end_rev:
+                    continue
+
+                seq = get_read_pair_haplotype(reads, starts[iw], ends[iw])
+                if seq is not None:
+                    haplotypes[ind_sort[iw]][seq] += 1
 
     if VERBOSE >= 2:
         if irp >= 10000:
@@ -195,6 +232,54 @@ def get_local_haplotypes(bamfilename, start, end, VERBOSE=0, maxreads=-1,
     return haplotypes
 
 
+def get_local_haplotypes(bamfilename, start, end, VERBOSE=0, maxreads=-1,
+                         label=''):
+    '''Extract reads fully covering the region, discarding insertions'''
+    return get_local_haplotypes_windows(bamfilename, [(start, end)],
+                                        VERBOSE=VERBOSE,
+                                        maxreads=maxreads,
+                                        label=label)[0]
+
+
+def filter_haplotypes(haplo, filters):
+    '''Filter a Counter of haplotypes in place
+
+    Parameters:
+       filters (list): any of 'noN', 'nosingletons', 'mincount=<int>',
+       'freqmin=<float>'
+    '''
+    if 'noN' in filters:
+        hnames = [hname for hname in haplo.iterkeys() if 'N' in hname]
+        for hname in hnames:
+            del haplo[hname]
+
+    if 'nosingletons' in filters:
+        hnames = [hname for hname, c in haplo.iteritems() if c <= 1]
+        for hname in hnames:
+            del haplo[hname]
+
+    if any('mincount=' in ft for ft in filters):
+        for ft in filters:
+            if 'mincount=' in ft:
+                break
+        cmin = int(ft[len('mincount='):])
+        hnames = [hname for hname, c in haplo.iteritems() if c < cmin]
+        for hname in hnames:
+            del haplo[hname]
+    
+    if any('freqmin=' in ft for ft in filters):
+        for ft in filters:
+            if 'freqmin=' in ft:
+                break
+        fmin = float(ft[len('minfreq='):])
+        csum = sum(haplo.itervalues())
+        hnames = [hname for hname, c in haplo.iteritems() if c < fmin * csum]
+        for hname in hnames:
+            del haplo[hname]
+
+    return haplo
+
+
 def plot_haplotype_frequencies(times, hft, figax=None, title='',
                                picker=None):
     '''Plot haplotype frequencies'''
@@ -10,67 +10,22 @@ from hivwholeseq.patients.patients import load_patient
 from hivwholeseq.patients.samples import SamplePat
 from hivwholeseq.utils.exceptions import RoiError
 from hivwholeseq.utils.argparse import RoiAction
+from hivwholeseq.patients.annotation import AnnotationIndex, get_annotation_index
 
 
 
 # Functions
 def get_fragmented_roi(refseq, roi, VERBOSE=0, include_genomewide=False):
-    '''From a Region Of Interest, get fragment(s), start and end coordinates'''
-    def find_fragment(fea_frags, start, end, include_genomewide=False):
-        for fea in fea_frags:
-            fr_start = fea.location.nofuzzy_start
-            fr_end = fea.location.nofuzzy_end
-
-            if (fr_start <= start) and (fr_end >= end):
-                return (fea.id, start - fr_start, end - fr_start)
-        
-        if not include_genomewide:
-            raise RoiError('No fragment found that fully covers this roi')
-        else:
-            return ('genomewide', start, end)
-
-    fea_frags = [fea for fea in refseq.features if fea.type == 'fragment']
-    feanames = [fea.id for fea in refseq.features]
+    '''From a Region Of Interest, get fragment(s), start and end coordinates
 
-    if roi[0] in ['F'+str(i) for i in xrange(1, 7)]:
-        start = roi[1]
-        if roi[2] != '+oo':
-            end = roi[2]
-        else:
-            fea = refseq.features[feanames.index(roi[0])]
-            end = fea.location.nofuzzy_end - fea.location.nofuzzy_start
-        roi = (roi[0], start, end)
-
-        if VERBOSE >= 3:
-            print 'Fragment selected', roi
-        return roi
-
-    if roi[0] == 'genomewide':
-        start = roi[1]
-        if roi[2] != '+oo':
-            end = roi[2]
-        else:
-            end = len(refseq)
-
-        roi = find_fragment(fea_frags, start, end, include_genomewide=include_genomewide)
-        if VERBOSE >= 3:
-            print 'Genomewide selected', roi
-        return roi
-
-    elif roi[0] in feanames:
-        fea = refseq.features[feanames.index(roi[0])]
-        start = roi[1] + fea.location.nofuzzy_start
-        if roi[2] != '+oo':
-            end = roi[2] + fea.location.nofuzzy_start
-        else:
-            end = fea.location.nofuzzy_end
-
-        roi = find_fragment(fea_frags, start, end, include_genomewide=include_genomewide)
-        if VERBOSE >= 3:
-            print 'Feature selected', roi
-        return roi
-
-    raise ValueError('Roi not understood')
+    Parameters:
+       refseq (SeqRecord or AnnotationIndex): annotated genomewide reference,
+       or its feature index (see patients.annotation)
+    '''
+    if not isinstance(refseq, AnnotationIndex):
+        refseq = AnnotationIndex(refseq)
+    return refseq.get_fragmented_roi(roi, VERBOSE=VERBOSE,
+                                     include_genomewide=include_genomewide)
 
 
 def get_fragments_covered(patsam, roi, VERBOSE=0, include_coordinates=False):
@@ -94,24 +49,22 @@ def get_fragments_covered(patsam, roi, VERBOSE=0, include_coordinates=False):
                     'fragment': (start, end),
                    }]
 
-    refseq = patsam.get_reference('genomewide', 'gb')
+    index = get_annotation_index(patsam.get_reference_filename('genomewide',
+                                                               format='gb'))
     frags_cov = []
-    for fea in refseq.features:
-        if fea.type == 'fragment':
-            start_fr = fea.location.nofuzzy_start
-            end_fr = fea.location.nofuzzy_end
-            if (start_fr < end) & (end_fr > start):
-                if not include_coordinates:
-                    datum = fea.id
-                else:
-                    datum = {'name': fea.id,
-                             'roi': (max(start, start_fr) - start,
-                                     min(end, end_fr) - start),
-                             'fragment': (max(start, start_fr) - start_fr,
-                                          min(end, end_fr) - start_fr),
-                            }
-
-                frags_cov.append(datum)
+    for (fea_id, start_fr, end_fr) in index.fragments:
+        if (start_fr < end) & (end_fr > start):
+            if not include_coordinates:
+                datum = fea_id
+            else:
+                datum = {'name': fea_id,
+                         'roi': (max(start, start_fr) - start,
+                                 min(end, end_fr) - start),
+                         'fragment': (max(start, start_fr) - start_fr,
+                                      min(end, end_fr) - start_fr),
+                        }
+
+            frags_cov.append(datum)
 
     return frags_cov
 
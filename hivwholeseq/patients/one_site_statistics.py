@@ -12,58 +12,91 @@ from Bio.Seq import Seq
 from Bio.Alphabet.IUPAC import ambiguous_dna
 from Bio import SeqIO
 
-from hivwholeseq.utils.miseq import alpha
+from hivwholeseq.utils.miseq import alpha, read_types
 
 
 
 # Functions
 def get_allele_count_trajectories(pname, samplenames, fragment, use_PCR1=1,
-                                  VERBOSE=0):
-    '''Get allele counts for a single patient sample'''
+                                  start=0, end=None, qual_min=30, VERBOSE=0):
+    '''Get allele counts for a single patient sample
+
+    Parameters:
+       start, end (int): restrict to this region of the fragment
+
+    Samples found in the patient allele count store are sliced from the
+    memory map, the others are loaded from their own allele count files. Files
+    newer than the store are preferred, and a store with another length than
+    the reference (e.g. before a correction of the reference) is ignored.
+    '''
     if VERBOSE >= 1:
         print 'Getting allele counts:', pname, fragment
 
     from hivwholeseq.patients.filenames import get_initial_reference_filename, \
-            get_allele_counts_filename
+            get_allele_counts_filename, \
+            get_allele_count_trajectories_store_filename as get_store_filename
+    from hivwholeseq.patients.allele_count_store import load_allele_count_store
 
     refseq = SeqIO.read(get_initial_reference_filename(pname, fragment), 'fasta')
-    fns = []
+    length = len(refseq)
+
+    samples_store = {}
+    store = None
+    try:
+        (samples_store, store) = load_allele_count_store(pname, fragment,
+                                                         qual_min=qual_min)
+        if store.shape[-1] == length:
+            samples_store = {key: i for i, key in enumerate(samples_store)}
+            time_store = os.path.getmtime(get_store_filename(pname, fragment,
+                                                             qual_min=qual_min,
+                                                             index=True))
+        else:
+            samples_store = {}
+            store = None
+    except IOError:
+        pass
+
+    def get_source(samplename_pat, PCR):
+        fn = get_allele_counts_filename(pname, samplename_pat, fragment, PCR=PCR,
+                                        qual_min=qual_min)
+        if (samplename_pat, PCR) in samples_store:
+            if not (os.path.isfile(fn) and (os.path.getmtime(fn) > time_store)):
+                return samples_store[(samplename_pat, PCR)]
+        if os.path.isfile(fn):
+            return fn
+        return None
+
+    # PCR1 filter here: 0 takes both PCRs, 1 prefers PCR1, 2 takes only PCR1
+    PCRs = {0: (1, 2), 1: (1, 2), 2: (1,)}.get(use_PCR1, ())
+
+    sources = []
     samplenames_out = []
     for samplename_pat in samplenames:
+        for PCR in PCRs:
+            source = get_source(samplename_pat, PCR)
+            if source is None:
+                continue
 
-        # PCR1 filter here
-        fn1 = get_allele_counts_filename(pname, samplename_pat, fragment, PCR=1)
-        fn2 = get_allele_counts_filename(pname, samplename_pat, fragment, PCR=2)
-        if use_PCR1 == 0:
-            for PCR, fn in enumerate((fn1, fn2), 1):
-                if os.path.isfile(fn):
-                    fns.append(fn)
-                    samplenames_out.append((samplename_pat, PCR))
-                    if VERBOSE >= 3:
-                        print samplename_pat, PCR
-
-        elif use_PCR1 == 1:
-            if os.path.isfile(fn1):
-                fns.append(fn1)
-                samplenames_out.append((samplename_pat, 1))
-                if VERBOSE >= 3:
-                    print samplename_pat, 1
-            elif os.path.isfile(fn2):
-                fns.append(fn2)
-                samplenames_out.append((samplename_pat, 2))
-                if VERBOSE >= 3:
-                    print samplename_pat, 2
-        elif use_PCR1 == 2:
-            if os.path.isfile(fn1):
-                fns.append(fn1)
-                samplenames_out.append((samplename_pat, 1))
-                if VERBOSE >= 3:
-                    print samplename_pat, 1
-
-    act = np.zeros((len(fns), len(alpha), len(refseq)), int)
-    for i, fn in enumerate(fns):
+            sources.append(source)
+            samplenames_out.append((samplename_pat, PCR))
+            if VERBOSE >= 3:
+                print samplename_pat, PCR
+
+            # Unless we take all PCRs, the first one found is enough
+            if use_PCR1 != 0:
+                break
+
+    if end is None:
+        end = length
+    (start, end, _) = slice(start, end).indices(length)
+
+    act = np.zeros((len(sources), len(alpha), max(0, end - start)), int)
+    for i, source in enumerate(sources):
         # Average directly over read types?
-        act[i] = np.load(fn).sum(axis=0)
+        if isinstance(source, basestring):
+            act[i] = np.load(source)[:, :, start: end].sum(axis=0)
+        else:
+            act[i] = store[source, :, :, start: end].sum(axis=0)
 
     return (samplenames_out, act)
 
@@ -116,6 +149,7 @@ def get_allele_frequency_trajectories(pname, samples, fragment, qual_min=30, VER
     # Prepare output data structures
     cos_traj = np.zeros((len(samples), len(alpha), len(refseq)), int)
     nus_traj = np.zeros((len(samples), len(alpha), len(refseq)))
+    counts_traj = np.zeros((len(samples), len(read_types), len(alpha), len(refseq)), int)
     
     for it, sample in enumerate(samples):
         if VERBOSE >= 2:
@@ -129,10 +163,10 @@ def get_allele_frequency_trajectories(pname, samples, fragment, qual_min=30, VER
         # Take the total counts, blending in the read types
         cou = counts.sum(axis=0)
         cos_traj[it] = cou
+        counts_traj[it] = counts
 
-        # Take the filtered frequencies, blending in the read types
-        nu = filter_nus(counts)
-        nus_traj[it] = nu
+    # Take the filtered frequencies, blending in the read types
+    nus_traj[:] = filter_nus(counts_traj)
 
     #FIXME: test, etc.
 
@@ -5,6 +5,7 @@ date:       23/10/13
 content:    Description module for HIV patients.
 '''
 # Modules
+from itertools import izip
 import numpy as np
 import pandas as pd
 
@@ -140,11 +141,12 @@ class Patient(pd.Series):
 
     def get_fragmented_roi(self, roi, VERBOSE=0, **kwargs):
         '''Get a region of interest in fragment coordinates'''
-        from .get_roi import get_fragmented_roi
+        from hivwholeseq.patients.annotation import get_annotation_index
         if isinstance(roi, basestring):
             roi = (roi, 0, '+oo')
-        refseq = self.get_reference('genomewide', 'gb')
-        return get_fragmented_roi(refseq, roi, VERBOSE=VERBOSE, **kwargs)
+        index = get_annotation_index(self.get_reference_filename('genomewide',
+                                                                 format='gb'))
+        return index.get_fragmented_roi(roi, VERBOSE=VERBOSE, **kwargs)
 
     
     def get_fragments_covered(self, roi, VERBOSE=0):
@@ -161,7 +163,7 @@ class Patient(pd.Series):
 
     def get_reference(self, region, format='fasta'):
         '''Get the reference for a genomic region'''
-        from Bio import SeqIO
+        from hivwholeseq.patients.annotation import load_reference
         fragments = ['F'+str(i) for i in xrange(1, 7)] + ['genomewide']
 
         if region in fragments:
@@ -170,12 +172,8 @@ class Patient(pd.Series):
             (fragment, start, end) = self.get_fragmented_roi((region, 0, '+oo'),
                                                              include_genomewide=True)
 
-        refseq = SeqIO.read(self.get_reference_filename(fragment, format=format),
-                            format)
-
-        if format in ('gb', 'genbank'):
-            from hivwholeseq.utils.sequence import correct_genbank_features_load
-            correct_genbank_features_load(refseq)
+        refseq = load_reference(self.get_reference_filename(fragment, format=format),
+                                format=format)
 
         if region not in fragments:
             refseq = refseq[start: end]
@@ -445,8 +443,9 @@ class Patient(pd.Series):
                 end = part.nofuzzy_end - fea_frag.location.nofuzzy_start
                 (sns, act) = get_allele_count_trajectories(self.name, self.samples.index,
                                                            fragment,
-                                                           use_PCR1=2, **kwargs)
-                act = act[:, :, start: end]
+                                                           use_PCR1=2,
+                                                           start=start, end=end,
+                                                           **kwargs)
                 ind = np.array([i for i, (_, sample) in enumerate(self.samples.iterrows())
                                 if sample.name in map(itemgetter(0), sns)], int)
                 acts.append(act)
@@ -467,11 +466,12 @@ class Patient(pd.Series):
             # Fall back on genomewide counts if no single fragment is enough
             (fragment, start, end) = self.get_fragmented_roi((region, 0, '+oo'),
                                                              include_genomewide=True)
+            # Select genomic region (only that is read from file)
             (sns, act) = get_allele_count_trajectories(self.name, self.samples.index,
                                                        fragment,
-                                                       use_PCR1=2, **kwargs)
-            # Select genomic region
-            act = act[:, :, start: end]
+                                                       use_PCR1=2,
+                                                       start=start, end=end,
+                                                       **kwargs)
 
             # Select time points
             ind = np.array([i for i, (_, sample) in enumerate(self.samples.iterrows())
@@ -670,11 +670,67 @@ class Patient(pd.Series):
         return (haplos, ind)
 
 
+    def get_local_haplotype_trajectories_windows(self, region, windows,
+                                                 VERBOSE=0, **kwargs):
+        '''Get trajectories of local haplotypes in several windows at once
+
+        Each BAM file is read once for all windows falling into its fragment.
+
+        Parameters:
+           region (str): genomic region or fragment
+           windows (list): (start, end) of each window in region coordinates
+
+        Returns:
+           data (list): (haplos, ind) for each window, or None if no fragment
+           covers the window
+        '''
+        from hivwholeseq.utils.exceptions import RoiError
+
+        # Group the windows by fragment
+        windows_frag = {}
+        for iw, (start, end) in enumerate(windows):
+            if region in ['F'+str(i) for i in xrange(1, 7)]:
+                fragment = region
+            else:
+                try:
+                    (fragment, start, end) = self.get_fragmented_roi((region, start, end),
+                                                                     VERBOSE=VERBOSE)
+                except RoiError:
+                    continue
+
+            if fragment not in windows_frag:
+                windows_frag[fragment] = []
+            windows_frag[fragment].append((iw, (start, end)))
+
+        data = [None for window in windows]
+        for fragment, iwins in windows_frag.iteritems():
+            for iw, window in iwins:
+                data[iw] = ([], [])
+
+            for i, sample in enumerate(self.itersamples()):
+                try:
+                    haplos = sample.get_local_haplotypes_windows(fragment,
+                                                                 [w for (iw, w) in iwins],
+                                                                 VERBOSE=VERBOSE,
+                                                                 **kwargs)
+                except IOError:
+                    continue
+
+                # Discard time points with zero coverage
+                for (iw, window), haplo in izip(iwins, haplos):
+                    if len(haplo):
+                        data[iw][0].append(haplo)
+                        data[iw][1].append(i)
+
+        return data
+
+
     def get_local_haplotype_count_trajectories(self,
                                                region, start=0, end='+oo',
                                                VERBOSE=0,
                                                align=False,
                                                return_dict=False,
+                                               sparse=False,
                                                **kwargs):
         '''Get trajectories of local haplotypes counts
         
@@ -682,20 +738,93 @@ class Patient(pd.Series):
            region (str): genomic region or fragment
            start (int): start position in region
            end (int): end position in region ('+oo': end of the region)
+           sparse (bool or 'auto'): return the counts as a scipy.sparse matrix
+           ('auto': only if most haplotypes are seen at one time point)
         '''
         (haplos, ind) = self.get_local_haplotype_trajectories(region,
                                                               start, end,
                                                               VERBOSE=VERBOSE,
                                                               **kwargs)
+        return self._get_haplotype_count_trajectories(haplos, ind,
+                                                      align=align,
+                                                      return_dict=return_dict,
+                                                      sparse=sparse)
+
+
+    def get_local_haplotype_count_trajectories_windows(self,
+                                                       region, windows,
+                                                       VERBOSE=0,
+                                                       align=False,
+                                                       return_dict=False,
+                                                       sparse=False,
+                                                       **kwargs):
+        '''Get trajectories of local haplotypes counts in several windows
+
+        Parameters:
+           region (str): genomic region or fragment
+           windows (list): (start, end) of each window in region coordinates
+
+        Returns:
+           data (list): the same as get_local_haplotype_count_trajectories for
+           each window, or None if no fragment covers the window
+        '''
+        data = self.get_local_haplotype_trajectories_windows(region, windows,
+                                                             VERBOSE=VERBOSE,
+                                                             **kwargs)
+        hcts = []
+        for datum in data:
+            if datum is None:
+                hcts.append(None)
+                continue
+
+            (haplos, ind) = datum
+            hcts.append(self._get_haplotype_count_trajectories(haplos, ind,
+                                                               align=align,
+                                                               return_dict=return_dict,
+                                                               sparse=sparse))
+        return hcts
+
+
+    @staticmethod
+    def _get_haplotype_count_trajectories(haplos, ind, align=False,
+                                          return_dict=False,
+                                          sparse=False):
+        '''Make trajectories of haplotype counts from one Counter per sample
+
+        Parameters:
+           sparse (bool or 'auto'): return the counts as a scipy.sparse CSR
+           matrix ('auto': only if most haplotypes are seen at one time point)
+        '''
         # Make trajectories of counts
         seqs_set = set()
         for haplo in haplos:
             seqs_set |= set(haplo.keys())
         seqs_set = list(seqs_set)
-        hct = np.zeros((len(seqs_set), len(haplos)), int)
+
+        # Index haplotypes by hashing and fill the matrix from COO triplets
+        seqs_index = {seq: i for i, seq in enumerate(seqs_set)}
+        n_entries = sum(map(len, haplos))
+        rows = np.empty(n_entries, int)
+        cols = np.empty(n_entries, int)
+        values = np.empty(n_entries, int)
+        ie = 0
         for i, haplo in enumerate(haplos):
-            for seq, count in haplo.iteritems():
-                hct[seqs_set.index(seq), i] = count
+            ne = len(haplo)
+            rows[ie: ie + ne] = [seqs_index[seq] for seq in haplo.iterkeys()]
+            cols[ie: ie + ne] = i
+            values[ie: ie + ne] = haplo.values()
+            ie += ne
+
+        if sparse == 'auto':
+            sparse = n_entries < 2 * len(seqs_set)
+
+        if sparse:
+            from scipy.sparse import coo_matrix
+            hct = coo_matrix((values, (rows, cols)),
+                             shape=(len(seqs_set), len(haplos))).tocsr()
+        else:
+            hct = np.zeros((len(seqs_set), len(haplos)), int)
+            hct[rows, cols] = values
 
         # Sometimes you collect no haplotype at all (too wide or unlucky regions)
         if not len(seqs_set):
@@ -939,7 +1068,8 @@ def iterpatient(patients):
 
 def load_patients(pnames=None):
     '''Load patients from general table'''
-    patients = pd.read_excel(table_filename, 'Patients', index_col=1)
+    from hivwholeseq.utils.table import read_table_sheet
+    patients = read_table_sheet('Patients', index_col=1)
     patients.index = pd.Index(map(str, patients.index))
 
     if pnames is not None:
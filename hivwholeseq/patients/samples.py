@@ -62,11 +62,12 @@ class SamplePat(pd.Series):
 
     def get_fragmented_roi(self, roi, VERBOSE=0, **kwargs):
         '''Get a region of interest in fragment coordinates'''
-        from hivwholeseq.patients.get_roi import get_fragmented_roi
+        from hivwholeseq.patients.annotation import get_annotation_index
         if isinstance(roi, basestring):
             roi = (roi, 0, '+oo')
-        refseq = self.get_reference('genomewide', 'gb')
-        return get_fragmented_roi(refseq, roi, VERBOSE=VERBOSE, **kwargs)
+        index = get_annotation_index(self.get_reference_filename('genomewide',
+                                                                 format='gb'))
+        return index.get_fragmented_roi(roi, VERBOSE=VERBOSE, **kwargs)
 
 
     def get_fragments_covered(self, roi, VERBOSE=0, include_coordinates=False):
@@ -84,7 +85,7 @@ class SamplePat(pd.Series):
 
     def get_reference(self, region, format='fasta'):
         '''Get the reference for a genomic region'''
-        from Bio import SeqIO
+        from hivwholeseq.patients.annotation import load_reference
         fragments = ['F'+str(i) for i in xrange(1, 7)] + ['genomewide']
 
         if region in fragments:
@@ -93,12 +94,8 @@ class SamplePat(pd.Series):
             (fragment, start, end) = self.get_fragmented_roi((region, 0, '+oo'),
                                                              include_genomewide=True)
 
-        refseq = SeqIO.read(self.get_reference_filename(fragment, format=format),
-                            format)
-
-        if format in ('gb', 'genbank'):
-            from hivwholeseq.utils.sequence import correct_genbank_features_load
-            correct_genbank_features_load(refseq)
+        refseq = load_reference(self.get_reference_filename(fragment, format=format),
+                                format=format)
 
         if region not in fragments:
             refseq = refseq[start: end]
@@ -145,12 +142,13 @@ class SamplePat(pd.Series):
 
 
     def get_allele_cocounts_filename(self, fragment, PCR=1, qual_min=30,
-                                     compressed=True):
+                                     compressed=True, sparse=False):
         '''Get the filename of the allele counts'''
         from hivwholeseq.patients.filenames import get_allele_cocounts_filename
         return get_allele_cocounts_filename(self.patient, self.name, fragment,
                                             PCR=PCR, qual_min=qual_min,
-                                            compressed=compressed)
+                                            compressed=compressed,
+                                            sparse=sparse)
 
 
     def get_consensus_filename(self, fragment, PCR=1):
@@ -247,11 +245,41 @@ class SamplePat(pd.Series):
         return ac
 
 
-    def get_allele_cocounts(self, fragment, PCR=1, qual_min=30):
-        '''Get the allele cocounts'''
+    def get_allele_cocounts(self, region, PCR=1, qual_min=30, sparse=False):
+        '''Get the allele cocounts
+
+        Parameters:
+           region (str): fragment or other region of interest
+           sparse (bool): return the compact upper-triangular representation
+           instead of the dense matrix (see utils.two_site_statistics)
+
+        If a sparse cocount file is present, only the blocks of the region are
+        loaded from it.
+        '''
+        import os
         import numpy as np
-        acc = np.load(self.get_allele_cocounts_filename(fragment, PCR=PCR,
-                                                        qual_min=qual_min))['cocounts']
+        from hivwholeseq.utils.two_site_statistics import (
+            load_coallele_counts_sparse, sparsify_coallele_counts,
+            densify_coallele_counts)
+
+        (fragment, start, end) = self.get_fragmented_roi((region, 0, '+oo'),
+                                                         include_genomewide=True)
+
+        fn = self.get_allele_cocounts_filename(fragment, PCR=PCR,
+                                               qual_min=qual_min,
+                                               sparse=True)
+        if os.path.isfile(fn):
+            acc = load_coallele_counts_sparse(fn, start=start, end=end)
+            if not sparse:
+                acc = densify_coallele_counts(acc)
+
+        else:
+            acc = np.load(self.get_allele_cocounts_filename(fragment, PCR=PCR,
+                                                            qual_min=qual_min))['cocounts']
+            acc = acc[:, :, start: end, start: end]
+            if sparse:
+                acc = sparsify_coallele_counts(acc)
+
         return acc
 
 
@@ -270,45 +298,41 @@ class SamplePat(pd.Series):
                              filters=None,
                              PCR=1):
         '''Get local haplotypes'''
-        from hivwholeseq.patients.get_local_haplotypes import get_local_haplotypes
+        return self.get_local_haplotypes_windows(fragment, [(start, end)],
+                                                 VERBOSE=VERBOSE,
+                                                 maxreads=maxreads,
+                                                 filters=filters,
+                                                 PCR=PCR)[0]
+
+
+    def get_local_haplotypes_windows(self,
+                                     fragment, windows,
+                                     VERBOSE=0,
+                                     maxreads=-1,
+                                     filters=None,
+                                     PCR=1):
+        '''Get local haplotypes in several windows, reading the BAM file once
+
+        Parameters:
+           windows (list): (start, end) of each window in fragment coordinates
+
+        Returns:
+           haplos (list of Counters): one per window
+        '''
+        from hivwholeseq.patients.get_local_haplotypes import (
+            get_local_haplotypes_windows, filter_haplotypes)
         bamfilename = self.get_mapped_filtered_filename(fragment, PCR=PCR)
-        haplo = get_local_haplotypes(bamfilename,
-                                     start, end,
-                                     VERBOSE=VERBOSE,
-                                     maxreads=maxreads,
-                                     label=self.name)
+        haplos = get_local_haplotypes_windows(bamfilename,
+                                              windows,
+                                              VERBOSE=VERBOSE,
+                                              maxreads=maxreads,
+                                              label=self.name)
 
         if filters is not None:
-            if 'noN' in filters:
-                hnames = [hname for hname in haplo.iterkeys() if 'N' in hname]
-                for hname in hnames:
-                    del haplo[hname]
-
-            if 'nosingletons' in filters:
-                hnames = [hname for hname, c in haplo.iteritems() if c <= 1]
-                for hname in hnames:
-                    del haplo[hname]
-
-            if any('mincount=' in ft for ft in filters):
-                for ft in filters:
-                    if 'mincount=' in ft:
-                        break
-                cmin = int(ft[len('mincount='):])
-                hnames = [hname for hname, c in haplo.iteritems() if c < cmin]
-                for hname in hnames:
-                    del haplo[hname]
-            
-            if any('freqmin=' in ft for ft in filters):
-                for ft in filters:
-                    if 'freqmin=' in ft:
-                        break
-                fmin = float(ft[len('minfreq='):])
-                csum = sum(haplo.itervalues())
-                hnames = [hname for hname, c in haplo.iteritems() if c < fmin * csum]
-                for hname in hnames:
-                    del haplo[hname]
-
-        return haplo
+            for haplo in haplos:
+                filter_haplotypes(haplo, filters)
+
+        return haplos
 
 
 
@@ -320,8 +344,8 @@ def itersample(samples):
 
 def load_samples_sequenced(patients=None, include_empty=False):
     '''Load patient samples sequenced from general table'''
-    sample_table = pd.read_excel(table_filename, 'Samples timeline sequenced',
-                                 index_col=0)
+    from hivwholeseq.utils.table import read_table_sheet
+    sample_table = read_table_sheet('Samples timeline sequenced', index_col=0)
 
     # Reindex DataFrame
     sample_table.index = pd.Index(map(str, sample_table.index))
@@ -332,8 +356,7 @@ def load_samples_sequenced(patients=None, include_empty=False):
     sample_table['n templates'] = sample_table['viral load'] * 0.4 / 12 * 2
 
     if not include_empty:
-        ind = [i for i, sample in sample_table.iterrows()
-               if (sample[['F1', 'F2', 'F3', 'F4', 'F5', 'F6']] != 'miss').any()]
+        ind = (sample_table[['F1', 'F2', 'F3', 'F4', 'F5', 'F6']] != 'miss').any(axis=1)
         sample_table = sample_table.loc[ind]
 
     if patients is not None:
@@ -4,6 +4,11 @@ author:     Fabio Zanini, Richard Neher
 date:       11/08/13
 content:    Info on the illumina adapters.
 '''
+# Modules
+from itertools import izip
+
+
+
 # Globals
 # From: http://support.illumina.com/downloads/illumina_adapter_sequences_letter.ilmn
 TrueSeq_LT = {1: 'ATCACG',
@@ -66,6 +71,61 @@ def load_adapter_table(data_folder):
     return table
 
 
+def get_barcode_neighbors(barcode, max_distance=1, alphabet='ACGTN'):
+    '''Get all barcodes within a Hamming distance from a barcode
+
+    Returns:
+       neighbors (dict): barcode -> Hamming distance, including the barcode itself
+
+    Note: the dash between the indices of dual index adapters is kept fixed.
+    '''
+    from itertools import combinations, product
+
+    positions = [i for i, a in enumerate(barcode) if a != '-']
+    neighbors = {barcode: 0}
+    for distance in xrange(1, max_distance + 1):
+        for poss in combinations(positions, distance):
+            subs = [[a for a in alphabet if a != barcode[pos]] for pos in poss]
+            for letters in product(*subs):
+                neighbor = list(barcode)
+                for pos, a in izip(poss, letters):
+                    neighbor[pos] = a
+                neighbors[''.join(neighbor)] = distance
+    return neighbors
+
+
+def build_barcode_index(adapters_designed, max_distance=1):
+    '''Map all barcodes close to a designed adapter onto that adapter
+
+    Parameters:
+       adapters_designed (list): pairs of (adaID, barcode)
+       max_distance (int): maximal Hamming distance from the designed barcode
+
+    Returns:
+       index (dict): barcode -> (adaID, Hamming distance). Barcodes equally
+       close to more than one adapter are ambiguous and left out.
+    '''
+    index = {}
+    ambiguous = set()
+    for (adaID, barcode) in adapters_designed:
+        for neighbor, distance in get_barcode_neighbors(barcode, max_distance).iteritems():
+            if neighbor in index:
+                (adaID_other, distance_other) = index[neighbor]
+                if distance > distance_other:
+                    continue
+                elif (distance == distance_other) and (adaID != adaID_other):
+                    ambiguous.add(neighbor)
+                    continue
+
+            index[neighbor] = (adaID, distance)
+            ambiguous.discard(neighbor)
+
+    for neighbor in ambiguous:
+        del index[neighbor]
+
+    return index
+
+
 def foldername_adapter(adaID):
     '''Convert an adapter number in a folder name'''
     if adaID == -1:
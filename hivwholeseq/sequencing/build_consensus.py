@@ -68,16 +68,22 @@ def build_consensus(bamfilename, len_reference, VERBOSE=0,
         # Initial block
         if VERBOSE >= 2:
             print 'Block n', len(consensi_local) + 1, 
-        for pos_first_block in xrange(len_reference):
-            bamfile.reset()
-
-            # The first block has to make a consensus for the FIRST base, this needs
-            # at least ONE read starting exactly at the first position. Otherwise,
-            # the same is repeated for position 2, and so on.
-            reads = [read for read in bamfile if (read.is_proper_pair) and (read.pos == pos_first_block)]
-            if not len(reads):
+        # The first block has to make a consensus for the FIRST base, this needs
+        # at least ONE read starting exactly at the first position. Otherwise,
+        # the same is repeated for position 2, and so on: in a single pass, keep
+        # the reads starting at the leftmost position seen so far.
+        pos_first_block = len_reference
+        reads = []
+        for read in bamfile:
+            if (not read.is_proper_pair) or (read.pos > pos_first_block) or \
+               (read.pos >= len_reference):
                 continue
+            if read.pos < pos_first_block:
+                pos_first_block = read.pos
+                reads = []
+            reads.append(read)
 
+        if len(reads):
             np.random.shuffle(reads)
             reads = reads[:n_reads_per_ali]
             seqs = [SeqRecord(Seq(read.seq[:block_len], ambiguous_dna), id=read.qname)
@@ -90,7 +96,6 @@ def build_consensus(bamfilename, len_reference, VERBOSE=0,
             pos_ref += (block_len_initial // 2) * (1 + pos_first_block // (block_len_initial // 2))
             if VERBOSE >= 2:
                 print 'pos', pos_first_block, 'to', pos_first_block + block_len, 'block len', block_len
-            break
 
         # Start consensus
         if len(consensi_local) == 1:
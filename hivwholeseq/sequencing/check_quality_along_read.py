@@ -24,89 +24,182 @@ from hivwholeseq.sequencing.samples import load_sequencing_run
 
 
 
+# Globals
+# Phred scores are binned from 0 to n_qualities - 1 (higher scores go in the last bin)
+n_qualities = 42
+
+
+
 # Functions
+def get_quality_histogram_chunk(quals_chunk, read_len):
+    '''Histogram of phred scores along the reads for a chunk of quality strings
+
+    Parameters:
+       quals_chunk (list): Sanger quality strings, possibly of different lengths
+
+    Returns:
+       hist (ndarray): counts, shape (read_len, n_qualities); bases beyond
+       read_len are ignored
+    '''
+    if not len(quals_chunk):
+        return np.zeros((read_len, n_qualities), int)
+
+    # Decode all quality strings at once
+    lengths = np.fromiter(map(len, quals_chunk), int, len(quals_chunk))
+    quals = np.fromstring(''.join(quals_chunk), np.uint8).astype(int) - ord('!')
+    quals = np.clip(quals, 0, n_qualities - 1)
+
+    # Position of each base in its read
+    starts = np.cumsum(lengths) - lengths
+    poss = np.arange(len(quals)) - np.repeat(starts, lengths)
+    ind = poss < read_len
+
+    hist = np.bincount(poss[ind] * n_qualities + quals[ind],
+                       minlength=read_len * n_qualities)
+    return hist.reshape((read_len, n_qualities))
+
+
+def _get_quality_histogram_pairs_chunk(args):
+    '''Histogram of a chunk of quality string pairs (for the pool)'''
+    (quals_pairs, read_len) = args
+    return np.array([get_quality_histogram_chunk([quals[ip] for quals in quals_pairs],
+                                                 read_len)
+                     for ip in xrange(2)])
+
+
+def merge_quality_histograms(hists):
+    '''Merge quality histograms, e.g. from several files or runs
+
+    Histograms of different read lengths are padded with zeros.
+    '''
+    read_len = max(hist.shape[1] for hist in hists)
+    hist_merged = np.zeros((2, read_len, n_qualities), int)
+    for hist in hists:
+        hist_merged[:, :hist.shape[1]] += hist
+    return hist_merged
+
+
+def get_quality_percentiles(hist, percentiles=(5, 25, 50, 75, 95)):
+    '''Percentiles of phred scores at each position from cumulative histograms
+
+    Returns:
+       qpercs (ndarray): shape (..., read_len, len(percentiles)); positions
+       without any base are -1
+    '''
+    cumhist = np.cumsum(hist, axis=-1)
+    total = cumhist[..., -1:]
+    qpercs = np.array([(cumhist < 0.01 * perc * total).sum(axis=-1)
+                       for perc in percentiles])
+    qpercs = np.rollaxis(qpercs, 0, qpercs.ndim)
+    qpercs[total[..., 0] == 0] = -1
+    return qpercs
+
+
+def get_percentage_above_quality(hist, qthresh):
+    '''Percentage of bases above a phred score at each position
+
+    This is the same as 100 - scipy.stats.percentileofscore (kind='rank')
+    on the list of scores.
+    '''
+    total = hist.sum(axis=-1)
+    ties = hist[..., qthresh]
+    n_above = hist[..., qthresh + 1:].sum(axis=-1) + 0.5 * (ties - (ties > 0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 100.0 * n_above / total
+
+
+def open_reads_file(filename, threads=1):
+    '''Open a FASTQ file, decompressing gzipped files in a child process if threads > 1
+
+    Returns:
+       (fh, child): the file handle and the child process (or None)
+    '''
+    if filename[-3:] != '.gz':
+        return (open(filename, 'r'), None)
+
+    if threads <= 1:
+        return (gzip.open(filename, 'rb'), None)
+
+    # The child may be stopped early by a broken pipe (maxreads), silence it
+    import subprocess as sp
+    with open(os.devnull, 'w') as devnull:
+        child = sp.Popen(['gzip', '-dc', filename], stdout=sp.PIPE, stderr=devnull,
+                         bufsize=-1)
+    return (child.stdout, child)
+
+
 def quality_score_along_reads(read_len, reads_filenames,
                               skipreads=0,
                               randomreads=False,
-                              maxreads=-1, VERBOSE=0):
-    '''Calculate the quality score along the reads'''
+                              maxreads=-1, VERBOSE=0,
+                              chunksize=10000, threads=1):
+    '''Calculate the quality score along the reads
 
-    quality = [[[] for j in xrange(read_len)] for i in xrange(2)]
+    Parameters:
+       randomreads (bool): take a uniform random sample of maxreads read pairs
+       chunksize (int): number of read pairs decoded at a time
+       threads (int): if more than one, decompress gzipped files in child
+       processes and compute the histograms of chunks in a pool of workers
 
-    # Precompute conversion table
-    SANGER_SCORE_OFFSET = ord("!")
-    q_mapping = dict()
-    for letter in range(0, 255):
-        q_mapping[chr(letter)] = letter - SANGER_SCORE_OFFSET
+    Returns:
+       hist (ndarray): counts of phred scores, shape (2, read_len, n_qualities)
+    '''
+    from itertools import islice
+    from hivwholeseq.utils.mapping import reservoir_sample
 
-    if reads_filenames[0][-3:] == '.gz':
-        openf = gzip.open
-        file_readmode = 'rb'
-    else:
-        openf = open
-        file_readmode = 'r'
-
-    # Iterate over all reads (using fast iterators)
-    with openf(reads_filenames[0], file_readmode) as fh1, \
-         openf(reads_filenames[1], file_readmode) as fh2:
-    
-        if randomreads:
-            if VERBOSE:
-                print 'Getting number of reads',
-                sys.stdout.flush()
-            n_reads = sum(1 for read in FGI(fh1))
-            fh1.rewind()
-            if VERBOSE:
-                print n_reads
+    hist = np.zeros((2, read_len, n_qualities), int)
 
-            inds = np.arange(skipreads, n_reads)
-            np.random.shuffle(inds)
-            inds = inds[:maxreads]
-            inds.sort()
-            indi = 0
-            if VERBOSE:
-                print 'Random indices from ', inds[0], 'to', inds[-1]
+    (fh1, child1) = open_reads_file(reads_filenames[0], threads=threads)
+    (fh2, child2) = open_reads_file(reads_filenames[1], threads=threads)
 
-            for (i, reads) in enumerate(izip(FGI(fh1), FGI(fh2))):
-                if VERBOSE and (not ((i + 1) % 10000)):
-                    print i + 1
+    if threads > 1:
+        from multiprocessing import Pool
+        pool = Pool(processes=threads)
 
-                if (i != inds[indi]):
-                    continue
+    # Iterate over all reads (using fast iterators)
+    try:
+        quals_iter = ((read1[2], read2[2]) for (read1, read2) in izip(FGI(fh1), FGI(fh2)))
+        quals_iter = islice(quals_iter, skipreads, None)
 
-                for ip, read in enumerate(reads):
-                    for j, qletter in enumerate(read[2]):
-                        quality[ip][j].append(q_mapping[qletter])
+        # Take a random subsample in a single pass
+        if randomreads:
+            if VERBOSE:
+                print 'Sampling read pairs at random:', maxreads
+            quals_iter = iter(reservoir_sample(quals_iter, maxreads))
+        elif maxreads != -1:
+            quals_iter = islice(quals_iter, maxreads)
 
-                indi += 1
-                if indi == maxreads:
-                    if VERBOSE:
-                        print 'Maximal number of read pairs reached:', maxreads
-                    break
+        chunks_iter = iter(lambda: list(islice(quals_iter, chunksize)), [])
 
+        if threads > 1:
+            hists_chunks = pool.imap_unordered(_get_quality_histogram_pairs_chunk,
+                                               ((chunk, read_len) for chunk in chunks_iter))
         else:
+            hists_chunks = (_get_quality_histogram_pairs_chunk((chunk, read_len))
+                            for chunk in chunks_iter)
 
-            for (i, reads) in enumerate(izip(FGI(fh1), FGI(fh2))):
-                if i < skipreads:
-                    continue
-
-                if i == skipreads + maxreads:
-                    if VERBOSE:
-                        print 'Maximal number of read pairs reached:', maxreads
-                    break
+        for ichunk, hist_chunk in enumerate(hists_chunks):
+            hist += hist_chunk
+            if VERBOSE:
+                print (ichunk + 1) * chunksize
 
-                if VERBOSE and (not ((i + 1) % 10000)):
-                    print i + 1
+        if threads > 1:
+            pool.close()
 
-                for ip, read in enumerate(reads):
-                    for j, qletter in enumerate(read[2]):
-                        quality[ip][j].append(q_mapping[qletter])
+    except:
+        if threads > 1:
+            pool.terminate()
+        raise
 
-    for qual in quality:
-        for qpos in qual:
-            qpos.sort()
+    finally:
+        if threads > 1:
+            pool.join()
+        for (fh, child) in ((fh1, child1), (fh2, child2)):
+            fh.close()
+            if child is not None:
+                child.wait()
 
-    return quality
+    return hist
 
 
 def plot_quality_along_reads(data_folder, adaID, title, quality, VERBOSE=0, savefig=False):
@@ -117,9 +210,11 @@ def plot_quality_along_reads(data_folder, adaID, title, quality, VERBOSE=0, save
     fig, axs = plt.subplots(1, 2, figsize=(16, 9))
     for i, (ax, qual) in enumerate(izip(axs, quality)):
         for j, qpos in enumerate(qual):
-            x = qpos
-            y = np.linspace(0, 1, len(x))[::-1]
-            ax.plot(x, y, color=cm.jet(int(255.0 * j / len(qual))),
+            if not qpos.sum():
+                continue
+            x = np.arange(n_qualities)
+            y = 1.0 - np.concatenate([[0], np.cumsum(qpos)[:-1]]) / qpos.sum()
+            ax.step(x, y, where='post', color=cm.jet(int(255.0 * j / len(qual))),
                     alpha=0.5,
                     lw=2)
         ax.set_xlabel('Phred quality', fontsize=14)
@@ -147,7 +242,6 @@ def plot_quality_along_reads(data_folder, adaID, title, quality, VERBOSE=0, save
 def plot_cuts_quality_along_reads(data_folder, adaID, quality, title='',
                                   VERBOSE=0, savefig=False):
     '''Plot some cuts of the quality along the read'''
-    from scipy.stats import percentileofscore as pof
     import matplotlib.pyplot as plt
     from matplotlib import cm
     fig, axs = plt.subplots(1, 2, figsize=(14, 8))
@@ -155,7 +249,7 @@ def plot_cuts_quality_along_reads(data_folder, adaID, quality, title='',
     for i, (ax, qual) in enumerate(izip(axs, quality)):
         for j, qthresh in enumerate(qthreshs):
             x = np.arange(len(qual))
-            y = np.array([100 - pof(qual[k], qthresh) for k in xrange(len(qual))])
+            y = get_percentage_above_quality(qual, qthresh)
             ax.plot(x, y, color=cm.jet(int(255.0 * j / len(qthreshs))),
                     alpha=0.8,
                     lw=2,
@@ -203,8 +297,8 @@ if __name__ == '__main__':
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)    
     parser.add_argument('--run', required=True,
                         help='Seq run to analyze (e.g. Tue28, test_tiny)')
-    parser.add_argument('--adaID', required=True,
-                        help='Adapter ID to analyze (e.g. TS2)')
+    parser.add_argument('--adaID', required=True, nargs='+',
+                        help='Adapter IDs to analyze (e.g. TS2), merged in one histogram')
     parser.add_argument('--verbose', type=int, default=0,
                         help='Verbosity level [0-3]')
     parser.add_argument('--maxreads', type=int, default=-1,
@@ -213,14 +307,17 @@ if __name__ == '__main__':
                         help='Fork the job to the cluster via qsub')
     parser.add_argument('--no-savefig', action='store_false', dest='savefig',
                         help='Show figure instead of saving it')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of processes to decompress and decode reads')
 
     args = parser.parse_args()
     seq_run = args.run
     VERBOSE = args.verbose
     submit = args.submit
     maxreads = args.maxreads
-    adaID = args.adaID
+    adaIDs = args.adaID
     savefig = args.savefig
+    threads = args.threads
 
     if submit:
         fork_self(seq_run, VERBOSE=VERBOSE, maxreads=maxreads, savefig=savefig)
@@ -230,14 +327,20 @@ if __name__ == '__main__':
     data_folder = dataset.folder
     read_len = dataset.cycles // 2
 
-    reads_filenames = get_read_filenames(data_folder, adaID, gzip=True)
-    if not os.path.isfile(reads_filenames[0]):
-        reads_filenames = get_read_filenames(data_folder, adaID, gzip=False)
-    title = seq_run+', '+adaID
+    hists = []
+    for adaID in adaIDs:
+        reads_filenames = get_read_filenames(data_folder, adaID, gzip=True)
+        if not os.path.isfile(reads_filenames[0]):
+            reads_filenames = get_read_filenames(data_folder, adaID, gzip=False)
+
+        hists.append(quality_score_along_reads(read_len, reads_filenames,
+                                               randomreads=(maxreads >= 1),
+                                               maxreads=maxreads, VERBOSE=VERBOSE,
+                                               threads=threads))
 
-    quality = quality_score_along_reads(read_len, reads_filenames,
-                                        randomreads=(maxreads >= 1),
-                                        maxreads=maxreads, VERBOSE=VERBOSE)
+    quality = merge_quality_histograms(hists)
+    adaID = adaIDs[0]
+    title = seq_run+', '+', '.join(adaIDs)
 
     plot_cuts_quality_along_reads(data_folder, adaID,
                                   quality,
@@ -21,7 +21,8 @@ from Bio.SeqIO.QualityIO import FastqGeneralIterator as FGI
 from hivwholeseq.datasets import MiSeq_runs
 from hivwholeseq.sequencing.filenames import get_demultiplex_summary_filename, get_raw_read_files, \
         get_read_filenames, get_unclassified_reads_filenames
-from hivwholeseq.sequencing.adapter_info import adapters_illumina, foldername_adapter
+from hivwholeseq.sequencing.adapter_info import adapters_illumina, foldername_adapter, \
+        build_barcode_index
 from hivwholeseq.cluster.fork_cluster import fork_demultiplex as fork_self
 
 
@@ -72,8 +73,17 @@ def get_adapters_designed(dataset, VERBOSE=0, summary=True):
     return adapters_designed
 
 
+def write_match_distances(f, match_distances):
+    '''Write the histogram of barcode match distances to the summary file'''
+    f.write('Hamming distances of barcodes from the designed adapters:\n')
+    for distance in sorted(d for d in match_distances if d is not None):
+        f.write(str(distance)+'\t'+str(match_distances[distance])+'\n')
+    f.write('unclassified\t'+str(match_distances[None])+'\n')
+
+
 def demultiplex_reads_single_index(data_folder, data_filenames, adapters_designed,
-                                   maxreads=-1, VERBOSE=0, summary=True):
+                                   maxreads=-1, VERBOSE=0, summary=True,
+                                   compresslevel=9, max_mismatches=0):
     '''Demultiplex reads with single index adapters'''
 
     # Get the read filenames
@@ -82,15 +92,14 @@ def demultiplex_reads_single_index(data_folder, data_filenames, adapters_designe
     datafile_adapter = data_filenames['adapter']
 
     # Open output files (compressed)
-    fouts = {adaID: [gzip.open(fn, 'wb', compresslevel=9)
+    fouts = {adaID: [gzip.open(fn, 'wb', compresslevel=compresslevel)
              for fn in get_read_filenames(data_folder, adaID, gzip=True)]
              for adaID, _ in adapters_designed}
 
-    fouts['unclassified'] = [gzip.open(fn, 'wb', compresslevel=9)
+    fouts['unclassified'] = [gzip.open(fn, 'wb', compresslevel=compresslevel)
                              for fn in get_unclassified_reads_filenames(data_folder, gzip=True)]
 
-    adapters_designed_inv = dict(map(reversed, adapters_designed))
-    adapters_strings = map(itemgetter(1), adapters_designed)
+    barcode_index = build_barcode_index(adapters_designed, max_distance=max_mismatches)
 
     # Make sure you close the files
     try:
@@ -105,6 +114,7 @@ def demultiplex_reads_single_index(data_folder, data_filenames, adapters_designe
                 print '--------------------'
 
             adapters_found = Counter()
+            match_distances = Counter()
             for i, (read1, read2, adapter) in enumerate(izip(FGI(fh1), FGI(fh2),
                                                              SeqIO.parse(fha, 'fastq'))):
 
@@ -123,10 +133,9 @@ def demultiplex_reads_single_index(data_folder, data_filenames, adapters_designe
 
                 # If the adapter does not match any know one,
                 # throw into wastebin folder
-                if adapter_string not in adapters_strings:
-                    adaID = 'unclassified'
-                else:
-                    adaID = adapters_designed_inv[adapter_string]
+                (adaID, distance) = barcode_index.get(adapter_string,
+                                                      ('unclassified', None))
+                match_distances[distance] += 1
             
                 if VERBOSE >= 3:
                     print adaID
@@ -134,7 +143,7 @@ def demultiplex_reads_single_index(data_folder, data_filenames, adapters_designe
                 # Write sequences (append to file, manual but fast)
                 fouts[adaID][0].write("@%s\n%s\n+\n%s\n" % read1)
                 fouts[adaID][1].write("@%s\n%s\n+\n%s\n" % read2)
-                if adapter_string not in adapters_strings:
+                if adaID == 'unclassified':
                     SeqIO.write(adapter, fouts['unclassified'][2], 'fastq')
 
     finally:
@@ -151,10 +160,142 @@ def demultiplex_reads_single_index(data_folder, data_filenames, adapters_designe
                 f.write('Adapters found across all reads:\n')
                 for e in adapters_found.most_common():
                     f.write('\t'.join(map(str, e))+'\n')
+                write_match_distances(f, match_distances)
+
+
+def _compress_fastq_buffer(args):
+    '''Compress a chunk of FASTQ text into an independent gzip member'''
+    from cStringIO import StringIO
+    (text, compresslevel) = args
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=compresslevel) as f:
+        f.write(text)
+    return buf.getvalue()
+
+
+def demultiplex_reads_single_index_parallel(data_folder, data_filenames,
+                                            adapters_designed,
+                                            maxreads=-1, VERBOSE=0, summary=True,
+                                            threads=4, chunksize=100000,
+                                            compresslevel=6, max_mismatches=0):
+    '''Demultiplex reads with single index adapters, compressing in parallel
+
+    Parameters:
+       threads (int): number of compressor processes
+       chunksize (int): number of read pairs classified per chunk
+       compresslevel (int): gzip compression level of the output
+
+    The three input streams are read in chunks, the barcodes classified by
+    dict lookup, and the FASTQ of each output file compressed by a pool of
+    workers into one gzip member per chunk. Members are written in order,
+    so the reads in each output file are in the same order as the serial
+    demultiplexer. At most two chunks are held in memory at any time.
+    '''
+    from itertools import islice
+    from multiprocessing import Pool
+
+    # Get the read filenames
+    datafile_read1 = data_filenames['read1']
+    datafile_read2 = data_filenames['read2']
+    datafile_adapter = data_filenames['adapter']
+
+    # Open output files (the gzip members are compressed by the workers)
+    fouts = {adaID: [open(fn, 'wb')
+             for fn in get_read_filenames(data_folder, adaID, gzip=True)]
+             for adaID, _ in adapters_designed}
+
+    fouts['unclassified'] = [open(fn, 'wb')
+                             for fn in get_unclassified_reads_filenames(data_folder, gzip=True)]
+
+    barcode_index = build_barcode_index(adapters_designed, max_distance=max_mismatches)
+    fmt = "@%s\n%s\n+\n%s\n"
+
+    def write_members(pending):
+        for (fout, res) in pending:
+            fout.write(res.get())
+
+    pool = Pool(processes=threads)
+    n_reads = 0
+    adapters_found = Counter()
+    match_distances = Counter()
+
+    # Make sure you close the files
+    try:
+        with gzip.open(datafile_read1, 'rb') as fh1,\
+             gzip.open(datafile_read2, 'rb') as fh2,\
+             gzip.open(datafile_adapter, 'rb') as fha:
+
+            reads_iter = izip(FGI(fh1), FGI(fh2), FGI(fha))
+            if maxreads != -1:
+                reads_iter = islice(reads_iter, maxreads)
+
+            pending = []
+            while True:
+                chunk = list(islice(reads_iter, chunksize))
+                if not chunk:
+                    break
+                n_reads += len(chunk)
+
+                # Classify the barcodes of the whole chunk
+                barcodes = [adapter[1] for (_, _, adapter) in chunk]
+                adapters_found.update(barcodes)
+                matches = [barcode_index.get(b, ('unclassified', None)) for b in barcodes]
+                match_distances.update(map(itemgetter(1), matches))
+                adaIDs = map(itemgetter(0), matches)
+
+                # Collect the FASTQ text of each output file
+                buffers = {adaID: ([], [], []) for adaID in fouts}
+                for (read1, read2, adapter), adaID in izip(chunk, adaIDs):
+                    buf = buffers[adaID]
+                    buf[0].append(fmt % read1)
+                    buf[1].append(fmt % read2)
+                    if adaID == 'unclassified':
+                        buf[2].append(fmt % adapter)
+                del chunk, barcodes, matches, adaIDs
+
+                # Write the previous chunk while this one is being compressed
+                pending_new = []
+                for adaID, fout in fouts.iteritems():
+                    for fou, buf in izip(fout, buffers[adaID]):
+                        if buf:
+                            res = pool.apply_async(_compress_fastq_buffer,
+                                                   ((''.join(buf), compresslevel),))
+                            pending_new.append((fou, res))
+                del buffers
+
+                write_members(pending)
+                pending = pending_new
+
+                if VERBOSE:
+                    print n_reads
+
+            write_members(pending)
+
+        pool.close()
+
+    except:
+        pool.terminate()
+        raise
+
+    finally:
+        pool.join()
+        for fout in fouts.itervalues():
+            for fou in fout:
+                fou.close()
+
+    if summary:
+        with open(get_demultiplex_summary_filename(data_folder), 'a') as f:
+            f.write('\n')
+            f.write('Total number of reads demultiplexed: '+str(n_reads)+'\n')
+            f.write('Adapters found across all reads:\n')
+            for e in adapters_found.most_common():
+                f.write('\t'.join(map(str, e))+'\n')
+            write_match_distances(f, match_distances)
 
 
 def demultiplex_reads_dual_index(data_folder, data_filenames, adapters_designed,
-                                   maxreads=-1, VERBOSE=0, summary=True):
+                                   maxreads=-1, VERBOSE=0, summary=True,
+                                   max_mismatches=0):
     '''Demultiplex reads with dual index adapters'''
     #FIXME: use gzipped files
 
@@ -174,8 +315,7 @@ def demultiplex_reads_dual_index(data_folder, data_filenames, adapters_designed,
                              open(data_folder+'unclassified_reads/adapter2.fastq', 'w'),
                             )
 
-    adapters_designed_inv = dict(map(reversed, adapters_designed))
-    adapters_strings = map(itemgetter(1), adapters_designed)
+    barcode_index = build_barcode_index(adapters_designed, max_distance=max_mismatches)
 
     # Make sure you close the files
     try:
@@ -191,6 +331,7 @@ def demultiplex_reads_dual_index(data_folder, data_filenames, adapters_designed,
                 print '--------------------'
 
             adapters_found = Counter()
+            match_distances = Counter()
             for i, (read1, read2,
                     adapter1,
                     adapter2) in enumerate(izip(FGI(fh1), FGI(fh2),
@@ -212,10 +353,9 @@ def demultiplex_reads_dual_index(data_folder, data_filenames, adapters_designed,
 
                 # If the adapter does not match any know one,
                 # throw into wastebin folder
-                if adapter_string not in adapters_strings:
-                    adaID = 'unclassified'
-                else:
-                    adaID = adapters_designed_inv[adapter_string]
+                (adaID, distance) = barcode_index.get(adapter_string,
+                                                      ('unclassified', None))
+                match_distances[distance] += 1
             
                 if VERBOSE >= 3:
                     print adaID
@@ -223,7 +363,7 @@ def demultiplex_reads_dual_index(data_folder, data_filenames, adapters_designed,
                 # Write sequences (append to file, manual but fast)
                 fouts[adaID][0].write("@%s\n%s\n+\n%s\n" % read1)
                 fouts[adaID][1].write("@%s\n%s\n+\n%s\n" % read2)
-                if adapter_string not in adapters_strings:
+                if adaID == 'unclassified':
                     SeqIO.write(adapter1, fouts['unclassified'][2], 'fastq')
                     SeqIO.write(adapter2, fouts['unclassified'][3], 'fastq')
 
@@ -240,6 +380,7 @@ def demultiplex_reads_dual_index(data_folder, data_filenames, adapters_designed,
             f.write('Adapters found across all reads:\n')
             for e in adapters_found.most_common():
                 f.write('\t'.join(map(str, e))+'\n')
+            write_match_distances(f, match_distances)
 
 
 
@@ -259,6 +400,13 @@ if __name__ == '__main__':
     parser.add_argument('--no-summary', action='store_false',
                         dest='summary',
                         help='Do not save results in a summary file')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of processes compressing the output')
+    parser.add_argument('--compresslevel', type=int, default=6,
+                        help='Compression level of the output files [1-9]')
+    parser.add_argument('--max-mismatches', type=int, default=1,
+                        dest='max_mismatches',
+                        help='Maximal Hamming distance of barcodes from an adapter')
 
     args = parser.parse_args()
     seq_run = args.run
@@ -266,10 +414,15 @@ if __name__ == '__main__':
     maxreads = args.maxreads
     submit = args.submit
     summary = args.summary
+    threads = args.threads
+    compresslevel = args.compresslevel
+    max_mismatches = args.max_mismatches
 
     # If submit, outsource to the cluster
     if submit:
-        fork_self(seq_run, VERBOSE=VERBOSE, maxreads=maxreads, summary=summary)
+        fork_self(seq_run, VERBOSE=VERBOSE, maxreads=maxreads, summary=summary,
+                  threads=threads, compresslevel=compresslevel,
+                  max_mismatches=max_mismatches)
         sys.exit()
 
     # Specify the dataset
@@ -288,11 +441,19 @@ if __name__ == '__main__':
     data_filenames = get_raw_read_files(dataset)
 
     # Is it a dual index library?
-    if '-' not in adapters_designed[0][0]:
+    if ('-' not in adapters_designed[0][0]) and (threads > 1):
+        demultiplex_reads_single_index_parallel(data_folder, data_filenames,
+                                                adapters_designed,
+                                                maxreads=maxreads, VERBOSE=VERBOSE,
+                                                summary=summary, threads=threads,
+                                                compresslevel=compresslevel,
+                                                max_mismatches=max_mismatches)
+    elif '-' not in adapters_designed[0][0]:
         demultiplex_reads_single_index(data_folder, data_filenames, adapters_designed,
                                        maxreads=maxreads, VERBOSE=VERBOSE,
-                                       summary=summary)
+                                       summary=summary, compresslevel=compresslevel,
+                                       max_mismatches=max_mismatches)
     else:
         demultiplex_reads_dual_index(data_folder, data_filenames, adapters_designed,
                                      maxreads=maxreads, VERBOSE=VERBOSE,
-                                     summary=summary)
+                                     summary=summary, max_mismatches=max_mismatches)
@@ -9,6 +9,7 @@ content:    Build a subset of the mapped reads excluding mismappings.
 import os
 import argparse
 from operator import itemgetter
+from functools import partial
 import pysam
 import numpy as np
 import pandas as pd
@@ -18,7 +19,9 @@ from hivwholeseq.sequencing.samples import load_samples_sequenced, SampleSeq
 from hivwholeseq.sequencing.filenames import get_consensus_filename, get_mapped_filename, \
         get_filter_mapped_summary_filename, get_mapped_suspicious_filename
 from hivwholeseq.utils.mapping import get_ind_good_cigars, convert_sam_to_bam,\
-        pair_generator, get_range_good_cigars
+        get_range_good_cigars
+from hivwholeseq.utils.filter_pairs import filter_read_pairs_bam
+from hivwholeseq.utils.bam_statistics import write_bam_statistics
 from hivwholeseq.cluster.fork_cluster import fork_filter_mapped as fork_self
 from seqanpy import align_overlap
 
@@ -282,6 +285,14 @@ def trim_bad_cigar(reads,
     return False
 
 
+def trim_bad_cigar_pair(reads, match_len_min=match_len_min,
+                        trim_bad_cigars=trim_bad_cigars):
+    '''Trim away short CIGARs from both edges of a pair, for the batch filter'''
+    return trim_bad_cigar(reads, match_len_min=match_len_min,
+                          trim_left=trim_bad_cigars,
+                          trim_right=trim_bad_cigars)
+
+
 def check_suspect(reads, consensi_foreign, deltamax=30, VERBOSE=0):
     '''Check suspicious reads for closer distance to potential contaminants'''
     if VERBOSE >= 2:
@@ -346,109 +357,47 @@ def filter_reads(data_folder,
     suspiciousfilename = get_mapped_suspicious_filename(data_folder, adaID, frag_gen)
     trashfilename = outfilename[:-4]+'_trashed.bam'
  
+    # Suspect pairs are checked against the contaminants one by one
+    if contaminants is not None:
+        check_suspect_pair = partial(check_suspect,
+                                     consensi_foreign=contaminants,
+                                     VERBOSE=VERBOSE)
+    else:
+        check_suspect_pair = None
+
+    binsize = 200
+    histogram_distance_from_consensus = np.zeros(n_cycles + 1, int)
+    histogram_dist_along = np.zeros((len(ref) // binsize + 1,
+                                     n_cycles + 1), int)
     with pysam.Samfile(bamfilename, 'rb') as bamfile:
         with pysam.Samfile(outfilename, 'wb', template=bamfile) as outfile,\
              pysam.Samfile(suspiciousfilename, 'wb', template=bamfile) as suspfile,\
              pysam.Samfile(trashfilename, 'wb', template=bamfile) as trashfile:
- 
-            # Iterate over all pairs
-            n_good = 0
-            n_wrongname = 0
-            n_unmapped = 0
-            n_unpaired = 0
-            n_mutator = 0
-            n_suspect = 0
-            n_mismapped_edge = 0
-            n_badcigar = 0
-            histogram_distance_from_consensus = np.zeros(n_cycles + 1, int)
-            binsize = 200
-            histogram_dist_along = np.zeros((len(ref) // binsize + 1,
-                                             n_cycles + 1), int)
-            for irp, reads in enumerate(pair_generator(bamfile)):
-
-                # Limit to the first reads
-                if irp == maxreads:
-                    break
-            
-                # Assign names
-                (read1, read2) = reads
-                i_fwd = reads[0].is_reverse
-
-                # Check a few things to make sure we are looking at paired reads
-                if read1.qname != read2.qname:
-                    n_wrongname += 1
-                    raise ValueError('Read pair '+str(irp)+': reads have different names!')
-
-                # Ignore unmapped reads
-                if read1.is_unmapped or read2.is_unmapped:
-                    if VERBOSE >= 2:
-                        print 'Read pair '+read1.qname+': unmapped'
-                    n_unmapped += 1
-                    map(trashfile.write, reads)
-                    continue
-            
-                # Ignore not properly paired reads (this includes mates sitting on
-                # different fragments)
-                if (not read1.is_proper_pair) or (not read2.is_proper_pair):
-                    if VERBOSE >= 2:
-                        print 'Read pair '+read1.qname+': not properly paired'
-                    n_unpaired += 1
-                    map(trashfile.write, reads)
-                    continue
-
-                # Mismappings are sometimes at fragment edges:
-                # Check for overhangs beyond the edge
-                skip = check_overhanging_reads(reads, len(ref))
-                if skip:
-                    n_mismapped_edge += 1
-                    map(trashfile.write, reads)
-                    continue
-                    
-                # Mismappings are often characterized by many mutations:
-                # check the number of mismatches of the whole pair and skip reads with too many
-                dc = get_distance_from_consensus(ref, reads, VERBOSE=VERBOSE)
-                histogram_distance_from_consensus[dc.sum()] += 1
-                hbin = (reads[i_fwd].pos + reads[i_fwd].isize / 2) // binsize
-                histogram_dist_along[hbin, dc.sum()] += 1
-                if (dc.sum() > max_mismatches):
-                    if VERBOSE >= 2:
-                        print n_mutator+1, irp, '{:2.1f}'.format(100.0 * (n_mutator + 1) / (irp + 1))+'%',\
-                                'Read pair '+read1.qname+': too many mismatches '+\
-                                '('+str(dc[0])+' + '+str(dc[1])+')'
-                    n_mutator += 1
-                    map(trashfile.write, reads)
-                    continue
-
-                # Check for contamination from other PCR plates. Typically,
-                # contamination happens for only one fragment, whereas superinfection
-                # happens for all. At this stage, we can only give clues about
-                # cross-contamination, the rest will be done in a script downstream
-                # (here we could TAG suspicious reads for contamination)
-                elif (dc.sum() > susp_mismatches):
-                    if contaminants is not None:
-                        skip = check_suspect(reads, contaminants, VERBOSE=VERBOSE)
-                    else:
-                        skip = True
-                    if skip:
-                        n_suspect += 1
-                        map(suspfile.write, reads)
-                        continue
-
-                # Trim the bad CIGARs from the sides, if there are any good ones
-                skip = trim_bad_cigar(reads, match_len_min=match_len_min,
-                                       trim_left=trim_bad_cigars,
-                                       trim_right=trim_bad_cigars)
-                if skip:
-                    n_badcigar += 1
-                    map(trashfile.write, reads)
-                    continue
-
-                # TODO: we might want to incorporate some more stringent
-                # criterion here, to avoid short reads, cross-overhang, etc.
-
-                # Write the output
-                n_good += 1
-                map(outfile.write, reads)
+
+            counts = filter_read_pairs_bam(bamfile, outfile, trashfile, ref,
+                                           suspfile=suspfile,
+                                           maxreads=maxreads,
+                                           hist_distance_from_consensus=histogram_distance_from_consensus,
+                                           hist_dist_along=histogram_dist_along,
+                                           binsize=binsize,
+                                           max_mismatches=max_mismatches,
+                                           susp_mismatches=susp_mismatches,
+                                           check_suspect=check_suspect_pair,
+                                           check_edges=True,
+                                           trim_pair=trim_bad_cigar_pair,
+                                           match_len_min=match_len_min,
+                                           trim_bad_cigars=trim_bad_cigars,
+                                           VERBOSE=VERBOSE)
+
+    n_good = counts['good']
+    n_unmapped = counts['unmapped']
+    n_unpaired = counts['unpaired']
+    n_mutator = counts['mutator']
+    n_suspect = counts['suspect']
+    n_mismapped_edge = counts['mismapped_edge']
+    n_badcigar = counts['bad_cigar']
+
+    write_bam_statistics(outfilename, VERBOSE=VERBOSE)
 
     if VERBOSE >= 1:
         print 'Read pairs: '
@@ -464,7 +413,7 @@ def filter_reads(data_folder,
         summary_filename = get_filter_mapped_summary_filename(data_folder, adaID, fragment)
         with open(summary_filename, 'a') as f:
             f.write('Filter results: adaID '+adaID+fragment+'\n')
-            f.write('Total:\t\t\t'+str(irp + 1)+'\n')
+            f.write('Total:\t\t\t'+str(sum(counts.itervalues()))+'\n')
             f.write('Good:\t\t\t'+str(n_good)+'\n')
             f.write('Unmapped:\t\t'+str(n_unmapped)+'\n')
             f.write('Unpaired:\t\t'+str(n_unpaired)+'\n')
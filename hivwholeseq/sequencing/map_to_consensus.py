@@ -18,13 +18,15 @@ import subprocess as sp
 
 from hivwholeseq.sequencing.adapter_info import load_adapter_table, foldername_adapter
 from hivwholeseq.utils.mapping import stampy_bin, subsrate, convert_sam_to_bam, \
-        convert_bam_to_sam, get_number_reads
+        convert_bam_to_sam, get_number_reads, merge_mapped_parts, map_to_bam
+from hivwholeseq.utils.bam_statistics import write_bam_statistics
 from hivwholeseq.sequencing.filenames import get_consensus_filename, get_mapped_filename,\
         get_read_filenames, get_divided_filename, get_map_summary_filename, \
         get_reference_consensus_ali_filename        
 from hivwholeseq.sequencing.filter_mapped_reads import match_len_min, trim_bad_cigars
 from hivwholeseq.sequencing.filter_mapped_reads import filter_reads as filter_mapped_reads
 from hivwholeseq.cluster.fork_cluster import fork_map_to_consensus as fork_self
+from hivwholeseq.cluster import executor, JOBLOGOUT, JOBLOGERR
 from hivwholeseq.sequencing.samples import load_sequencing_run, SampleSeq
 from hivwholeseq.utils.clean_temp_files import remove_mapped_tempfiles
 
@@ -36,10 +38,6 @@ stampy_sensitive = True     # Default: False
 
 
 # Cluster submit
-import hivwholeseq
-JOBDIR = hivwholeseq.__path__[0].rstrip('/')+'/'
-JOBLOGERR = JOBDIR+'logerr/'
-JOBLOGOUT = JOBDIR+'logout/'
 vmem = '8G'
 
 
@@ -195,14 +193,13 @@ def map_stampy(data_folder, adaID, fragment, VERBOSE=0, threads=1,
     # parallelize if requested
     if threads == 1:
 
-        output_filename = get_mapped_filename(data_folder, adaID, frag_gen, type='sam',
+        output_filename = get_mapped_filename(data_folder, adaID, frag_gen, type='bam',
                                               rescue=rescue)
 
-        # Map
+        # Map, piping the SAM output into a BAM file sorted by read name
         call_list = [stampy_bin,
                      '-g', get_index_file(data_folder, adaID, frag_gen, ext=False),
                      '-h', get_hash_file(data_folder, adaID, frag_gen, ext=False), 
-                     '-o', output_filename,
                      '--overwrite',
                      '--substitutionrate='+subsrate,
                      '--gapopen', stampy_gapopen,
@@ -227,15 +224,13 @@ def map_stampy(data_folder, adaID, fragment, VERBOSE=0, threads=1,
             print ' '.join(call_list)
 
         if not dry:
-            sp.call(call_list)
+            map_to_bam(call_list, output_filename, VERBOSE=VERBOSE)
 
             if summary:
                 with open(summary_filename, 'a') as f:
                     f.write('Stampy mapped (single thread).\n')
 
-            output_filename = get_mapped_filename(data_folder, adaID, frag_gen, type='bam',
-                                                  rescue=rescue)
-            convert_sam_to_bam(output_filename)
+            write_bam_statistics(output_filename, VERBOSE=VERBOSE)
         else:
             if summary:
                 with open(summary_filename, 'a') as f:
@@ -249,8 +244,7 @@ def map_stampy(data_folder, adaID, fragment, VERBOSE=0, threads=1,
     else:
 
         # Submit map script
-        jobs_done = np.zeros(threads, bool)
-        job_IDs = np.zeros(threads, 'S30')
+        job_IDs = []
         for j in xrange(threads):
         
             # Get output filename
@@ -282,9 +276,7 @@ def map_stampy(data_folder, adaID, fragment, VERBOSE=0, threads=1,
                 print ' '.join(call_list)
 
             if not dry:
-                job_ID = sp.check_output(call_list)
-                job_ID = job_ID.split()[2]
-                job_IDs[j] = job_ID
+                job_IDs.append(executor.get_job_id(executor.submit(call_list, VERBOSE=VERBOSE)))
 
         if dry:
             if summary:
@@ -295,78 +287,22 @@ def map_stampy(data_folder, adaID, fragment, VERBOSE=0, threads=1,
                 print 'Dry run works (multi thread)'
             return
 
-        # Monitor output
+        # Convert the parts as their jobs finish, and merge them sorted by name
+        # (to ensure the pair_generator)
         output_file_parts = [get_mapped_filename(data_folder, adaID, frag_gen,
                                                  type='bam', part=(j+1), rescue=rescue)
                               for j in xrange(threads)]
-        time_wait = 10 # secs
-        while not jobs_done.all():
-
-            # Sleep some time
-            time.sleep(time_wait)
-
-            # Get the output of qstat to check the status of jobs
-            qstat_output = sp.check_output(['qstat'])
-            qstat_output = qstat_output.split('\n')[:-1] # The last is an empty line
-            if len(qstat_output) < 3:
-                jobs_done[:] = True
-                break
-            else:
-                qstat_output = [line.split()[0] for line in qstat_output[2:]]
-
-            time_wait = 10 # secs
-            for j in xrange(threads):
-                if jobs_done[j]:
-                    continue
-
-                if job_IDs[j] not in qstat_output:
-                    # Convert to BAM for merging
-                    if VERBOSE >= 1:
-                        print 'Convert mapped reads to BAM for merging: adaID '+\
-                               adaID+', fragment '+frag_gen+', part '+str(j+1)+ ' of '+ \
-                               str(threads)
-                    convert_sam_to_bam(output_file_parts[j])
-                    # We do not need to wait if we did the conversion (it takes
-                    # longer than some secs)
-                    time_wait = 0
-                    jobs_done[j] = True
-
-        if summary:
-            with open(summary_filename, 'a') as f:
-                f.write('Stampy mapped ('+str(threads)+' threads).\n')
-
-        # Concatenate output files
-        output_filename = get_mapped_filename(data_folder, adaID, frag_gen, type='bam',
-                                              unsorted=True, rescue=rescue)
-        if VERBOSE >= 1:
-            print 'Concatenate mapped reads: adaID '+adaID+', fragment '+frag_gen
-        pysam.cat('-o', output_filename, *output_file_parts)
-        if summary:
-            with open(summary_filename, 'a') as f:
-                f.write('BAM files concatenated (unsorted).\n')
-
-        # Sort the file by read names (to ensure the pair_generator)
         output_filename_sorted = get_mapped_filename(data_folder, adaID, frag_gen,
                                                      type='bam',
                                                      unsorted=False,
                                                      rescue=rescue)
-        # NOTE: we exclude the extension and the option -f because of a bug in samtools
-        if VERBOSE >= 1:
-            print 'Sort mapped reads: adaID '+adaID+', fragment '+frag_gen
-        pysam.sort('-n', output_filename, output_filename_sorted[:-4])
+        merge_mapped_parts(job_IDs, output_file_parts, output_filename_sorted,
+                           threads=threads, VERBOSE=VERBOSE)
+        write_bam_statistics(output_filename_sorted, VERBOSE=VERBOSE)
         if summary:
             with open(summary_filename, 'a') as f:
-                f.write('Joint BAM file sorted.\n')
-
-        # Reheader the file without BAM -> SAM -> BAM
-        if VERBOSE >= 1:
-            print 'Reheader mapped reads: adaID '+adaID+', fragment '+frag_gen
-        header_filename = get_mapped_filename(data_folder, adaID, frag_gen,
-                                              type='sam', part=1, rescue=rescue)
-        pysam.reheader(header_filename, output_filename_sorted)
-        if summary:
-            with open(summary_filename, 'a') as f:
-                f.write('Joint BAM file reheaded.\n')
+                f.write('Stampy mapped ('+str(threads)+' threads).\n')
+                f.write('BAM files merged (sorted by name).\n')
 
     # FIXME: check whether temp files are all deleted
     if VERBOSE >= 1:
@@ -17,11 +17,6 @@ from hivwholeseq.sequencing.filenames import table_filename
 
 
 
-# Globals
-_sequencing_runs = None
-
-
-
 # Classes
 class SampleSeq(pd.Series):
     '''A sequenced sample (if something has been sequenced twice, they are separate)'''
@@ -263,8 +258,8 @@ class SequencingRun(pd.Series):
 # Functions
 def load_samples_sequenced(seq_runs=None):
     '''Load samples sequenced from general table'''
-    sample_table = pd.read_excel(table_filename, 'Samples sequenced',
-                                 index_col=0)
+    from hivwholeseq.utils.table import read_table_sheet
+    sample_table = read_table_sheet('Samples sequenced', index_col=0)
     sample_table.index = pd.Index(map(str, sample_table.index))
     sample_table.loc[:, 'patient sample'] = map(str, sample_table.loc[:, 'patient sample'])
     sample_table.loc[:, 'regions'] = map(str, sample_table.loc[:, 'regions'])
@@ -283,17 +278,14 @@ def load_sample_sequenced(samplename):
 
 def load_sequencing_runs(seq_runs=None):
     '''Load sequencing runs from general table'''
-    global _sequencing_runs
-    if _sequencing_runs is None:
-        seq_runs_in = pd.read_excel(table_filename, 'Sequencing runs',
-                                 index_col=0)
-        _sequencing_runs = seq_runs_in
+    from hivwholeseq.utils.table import read_table_sheet
+    seq_runs_in = read_table_sheet('Sequencing runs', index_col=0)
 
     if seq_runs is not None:
-        seq_runs = _sequencing_runs.loc[_sequencing_runs.index.isin(seq_runs)]
+        seq_runs = seq_runs_in.loc[seq_runs_in.index.isin(seq_runs)]
         return seq_runs
     else:
-        return _sequencing_runs
+        return seq_runs_in
 
 
 def load_sequencing_run(seq_run):
@@ -33,6 +33,7 @@ from hivwholeseq.utils.mapping import test_read_pair_crossoverhang as test_coh
 from hivwholeseq.utils.mapping import main_block_read_pair_low_quality as main_block_low_quality
 from hivwholeseq.utils.mapping import trim_read_pair_low_quality as trim_low_quality
 from hivwholeseq.utils.mapping import trim_read_pair_crossoverhangs as trim_coh
+from hivwholeseq.utils.bam_statistics import write_bam_statistics
 from hivwholeseq.cluster.fork_cluster import fork_trim_and_divide as fork_self
 
 from hivwholeseq.sequencing.samples import load_sequencing_run
@@ -461,40 +462,11 @@ def trim_primers(reads, frag_pos, include_tests=False):
     return False
 
 
-def trim_and_divide_reads(data_folder, adaID, n_cycles, fragments,
-                          maxreads=-1, VERBOSE=0,
-                          minisize=100,
-                          include_tests=False, summary=True):
-    '''Trim reads and divide them into fragments'''
-    if VERBOSE:
-        print 'Trim and divide into fragments: adaID '+adaID+', fragments: '+\
-                ' '.join(fragments)
-
-    if summary:
-        with open(get_divide_summary_filename(data_folder, adaID), 'a') as f:
-            f.write('Fragments used: '+' '.join(fragments)+'\n')
-
-    ref_filename = get_reference_premap_filename(data_folder, adaID)
-    refseq = SeqIO.read(ref_filename, 'fasta')
-    smat = np.array(refseq, 'S1')
-    len_reference = len(refseq)
-
-    # Get the positions of fragment start/end, w/ and w/o primers
-    frags_pos = get_fragment_positions(smat, fragments)
-    store_reference_fragmented(data_folder, adaID, refseq,
-                               dict(zip(fragments, frags_pos['trim'])))
-    if summary:
-        with open(get_divide_summary_filename(data_folder, adaID), 'a') as f:
-            f.write('Primer positions (for fragments):\n')
-            for (fragment, poss_full, poss_trim) in izip(fragments,
-                                                         frags_pos['full'],
-                                                         frags_pos['trim']):
-                f.write(fragment+': fwd '+str(poss_full[0])+' '+str(poss_trim[0])+\
-                                 ', rev '+str(poss_trim[1])+' '+str(poss_full[1])+'\n')
-    write_fragment_positions(data_folder, adaID, fragments, frags_pos)
+def get_outer_primers(smat, fragments):
+    '''Get positions and sequences of the unwanted outer primers
 
-    # Get the positions of the unwanted outer primers (in case we DO nested PCR
-    # for that fragment)
+    This is needed only in case we DO nested PCR for that fragment.
+    '''
     # NOTE: the LTRs make no problem, because the rev outer primer of F6
     # is not in the reference anymore if F6 has undergone nested PCR
     # FIXME: this might not work if we have mixed fragments (e.g. F5a+b) AND nesting
@@ -526,165 +498,379 @@ def trim_and_divide_reads(data_folder, adaID, n_cycles, fragments,
                                      get_primer_positions(smat,
                                                           primers_out['rev'], 'rev'))
 
+    return (primers_out_pos, primers_out_seq)
+
+
+def trim_and_divide_read_pair(reads, frags_pos, primers_out_pos, primers_out_seq,
+                              len_reference, minisize=100, include_tests=False,
+                              VERBOSE=0):
+    '''Trim a read pair and assign it to a fragment (or discard it)
+
+    Returns:
+       (category, n_frag): category is one of 'mapped', 'unmapped', 'outer',
+       'cross', 'ambiguous', 'lowq'; n_frag is the fragment index in the pool
+       for mapped pairs, None otherwise. Mapped reads are modified in place.
+    '''
+    i_fwd = reads[0].is_reverse
+
+    # If unmapped or unpaired, mini, or insert size mini, or
+    # divergent read pair (fully cross-overlapping), discard
+    if reads[0].is_unmapped or (not reads[0].is_proper_pair) or \
+       reads[1].is_unmapped or (not reads[1].is_proper_pair) or \
+       (reads[0].rlen < 50) or (reads[1].rlen < 50) or \
+       (reads[i_fwd].isize < minisize):
+        if VERBOSE >= 3:
+            print 'Read pair unmapped/unpaired/tiny/divergent:', reads[0].qname
+        return ('unmapped', None)
+
+    # If the insert is a misamplification from the outer primers
+    # in fragments that underwent nested PCR,
+    # trash it (it will have skewed amplification anyway). We cannot
+    # find all of those, rather only the ones still carrying the
+    # primer itself (some others have lost it while shearing). For
+    # those, no matter what happens at the end (reading into adapters,
+    # etc.), ONE of the reads in the pair will start exactly with one
+    # outer primer: if the rev read with a rev primer, if the fwd
+    # with a fwd one. Test all six.
+    if (len(primers_out_pos['fwd']) or len(primers_out_pos['rev'])) and \
+       test_outer_primer(reads,
+                         primers_out_pos, primers_out_seq,
+                         len_reference):
+        if VERBOSE >= 3:
+            print 'Read pair from outer primer:', reads[0].qname
+        return ('outer', None)
+
+    # FIXME: the following becomes a bit harder when we mix parallel
+    # PCRs, e.g. F5a+b, to get more product
+
+    # Assign to a fragment now, so that primer trimming is faster 
+    pair_identity = assign_to_fragment(reads, frags_pos['full'],
+                                       VERBOSE=VERBOSE)
+
+    # 1. If no fragments are possible (e.g. one read crosses the
+    # fragment boundary, they map to different fragments), dump it
+    # into a special bucket
+    if pair_identity == 'cross':
+        return ('cross', None)
+
+    # 2. If 2+ fragments are possible (tie), put into a special bucket
+    # (essentially excluded, because we want two independent measurements
+    # in the overlapping region, but we might want to recover them)
+    elif pair_identity == 'ambiguous':
+        return ('ambiguous', None)
+
+    # 3. If the intersection is a single fragment, good: trim the primers
+    # NB: n_frag is the index IN THE POOL. If we sequence only F2-F5, F2 is n_frag = 0
+    n_frag = int(pair_identity)
+    frag_pos = frags_pos['trim'][n_frag]
+    if not np.isscalar(frag_pos[0]):
+        frag_pos = [frag_pos[0]['inner'], frag_pos[1]['inner']]
+    trashed_primers = trim_primers(reads, frag_pos,
+                                   include_tests=include_tests)
+    if trashed_primers or (reads[i_fwd].isize < 100):
+        if VERBOSE >= 3:
+            print 'Read pair is mismapped:', reads[0].qname
+        return ('unmapped', None)
+
+    # Quality trimming: if no decently long pair survives, trash
+    #trashed_quality = main_block_low_quality(reads, phred_min=20,
+    #                                         include_tests=include_tests)
+    trashed_quality = trim_low_quality(reads, phred_min=20,
+                                       include_tests=include_tests)
+    if trashed_quality or (reads[i_fwd].isize < 100):
+        if VERBOSE >= 3:
+            print 'Read pair has low phred quality:', reads[0].qname
+        return ('lowq', None)
+
+    # Check for cross-overhangs or COH (reading into the adapters)
+    #        --------------->
+    #    <-----------
+    # In that case, trim to perfect overlap.
+    if test_coh(reads, VERBOSE=False):
+        trim_coh(reads, trim=0, include_tests=include_tests)
+
+    # Change coordinates into the fragmented reference (primer-trimmed)
+    for read in reads:
+        read.pos -= frag_pos[0]
+        read.mpos -= frag_pos[0]
+
+    # Here the tests
+    if include_tests:
+        lfr = frags_pos['trim'][n_frag][1] - frags_pos['trim'][n_frag][0]
+        if test_sanity(reads, n_frag, lfr):
+            raise ValueError('Tests failed: '+reads[0].qname)
+
+    return ('mapped', n_frag)
+
+
+def divide_read_pairs(bamfile, output_filenames, n_fragments, trim_kwargs,
+                      maxreads=-1, VERBOSE=0):
+    '''Trim and divide read pairs from an open BAM file into the output files
+
+    Parameters:
+       output_filenames (list): one BAM per fragment, then ambiguous,
+       crossmapped, unmapped, and low-quality
+       trim_kwargs (dict): passed down to trim_and_divide_read_pair
+
+    Returns:
+       counts (dict): number of read pairs per category (and per fragment)
+    '''
+    counts = {'total': 0,
+              'mapped': [0 for i in xrange(n_fragments)],
+              'unmapped': 0,
+              'outer': 0,
+              'cross': 0,
+              'ambiguous': 0,
+              'lowq': 0,
+             }
+
+    file_handles = []
+    try:
+        file_handles = [pysam.Samfile(ofn, 'wb', template=bamfile)
+                        for ofn in output_filenames]
+        fos = {'ambiguous': file_handles[-4],
+               'cross': file_handles[-3],
+               'unmapped': file_handles[-2],
+               'outer': file_handles[-2],
+               'lowq': file_handles[-1],
+              }
+
+        for irp, reads in enumerate(pair_generator(bamfile)):
+
+            if irp == maxreads:
+                if VERBOSE:
+                    print 'Maximal number of read pairs reached:', maxreads
+                break
+
+            if VERBOSE >= 2:
+                if not ((irp+1) % 10000):
+                    print irp+1
+
+            counts['total'] += 1
+            (category, n_frag) = trim_and_divide_read_pair(reads, VERBOSE=VERBOSE,
+                                                           **trim_kwargs)
+            if category == 'mapped':
+                counts['mapped'][n_frag] += 1
+                fo = file_handles[n_frag]
+            else:
+                counts[category] += 1
+                fo = fos[category]
+
+            fo.write(reads[0])
+            fo.write(reads[1])
+
+    finally:
+        for f in file_handles:
+            f.close()
+
+    return counts
+
+
+def get_chunk_filename(filename, ichunk):
+    '''Get the filename of a part of a BAM file'''
+    return filename[:-len('.bam')]+'_part'+str(ichunk)+'.bam'
+
+
+def split_bamfile_pairs(bamfilename, chunksize=100000, maxreads=-1):
+    '''Split a BAM file with consecutive mates into chunks of read pairs
+
+    Returns:
+       chunks (list): (virtual offset, number of read pairs) for each chunk
+    '''
+    chunks = []
+    if maxreads == 0:
+        return chunks
+
+    # Count single reads, without building pairs: mates are consecutive
+    n_reads_chunk = 2 * chunksize
+    n_reads_max = 2 * maxreads
+    with pysam.Samfile(bamfilename, 'rb') as bamfile:
+        offset = bamfile.tell()
+        n_reads = 0
+        n_reads_tot = 0
+        for read in bamfile:
+            n_reads += 1
+            n_reads_tot += 1
+            if (n_reads == n_reads_chunk) or (n_reads_tot == n_reads_max):
+                chunks.append((offset, n_reads // 2))
+                if n_reads_tot == n_reads_max:
+                    n_reads = 0
+                    break
+                offset = bamfile.tell()
+                n_reads = 0
+
+        # The last read is lost if odd, as in pair_generator
+        if n_reads >= 2:
+            chunks.append((offset, n_reads // 2))
+
+    return chunks
+
+
+def _divide_read_pairs_chunk(args):
+    '''Trim and divide one chunk of read pairs into part files (for the pool)'''
+    (input_filename, output_filenames, n_fragments, trim_kwargs,
+     ichunk, offset, n_pairs) = args
+    output_filenames = [get_chunk_filename(fn, ichunk) for fn in output_filenames]
+    with pysam.Samfile(input_filename, 'rb') as bamfile:
+        bamfile.seek(offset)
+        return divide_read_pairs(bamfile, output_filenames, n_fragments,
+                                 trim_kwargs, maxreads=n_pairs)
+
+
+def concatenate_bamfiles(filenames, output_filename, template_filename,
+                         remove=True):
+    '''Concatenate BAM files in order, with the header of a template BAM file
+
+    The compressed blocks are copied as they are, without decoding the reads.
+    With no files, the output is an empty BAM file with the template header.
+    '''
+    if not len(filenames):
+        with pysam.Samfile(template_filename, 'rb') as bamfile:
+            with pysam.Samfile(output_filename, 'wb', template=bamfile) as fo:
+                pass
+        return
+
+    pysam.cat('-h', template_filename, '-o', output_filename, *filenames,
+              catch_stdout=False)
+
+    if remove:
+        for fn in filenames:
+            os.remove(fn)
+
+
+def divide_read_pairs_parallel(input_filename, output_filenames, n_fragments,
+                               trim_kwargs, threads=2, chunksize=100000,
+                               maxreads=-1, VERBOSE=0):
+    '''Trim and divide read pairs in chunks, using a pool of processes
+
+    Each chunk is written into its own part files, which are then concatenated
+    in order, so the output is the same as with divide_read_pairs.
+    '''
+    from multiprocessing import Pool
+
+    if trim_kwargs.get('include_tests', False):
+        raise ValueError('Tests require an interactive shell')
+
+    chunks = split_bamfile_pairs(input_filename, chunksize=chunksize,
+                                 maxreads=maxreads)
+    if VERBOSE >= 2:
+        print 'Chunks of read pairs:', len(chunks)
+
+    counts_chunks = []
+    if len(chunks):
+        pool = Pool(processes=min(threads, len(chunks)))
+        try:
+            counts_chunks = pool.map(_divide_read_pairs_chunk,
+                                     [(input_filename, output_filenames,
+                                       n_fragments, trim_kwargs,
+                                       ichunk, offset, n_pairs)
+                                      for ichunk, (offset, n_pairs) in enumerate(chunks)])
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    # Merge the part files and the counts, in chunk order
+    for ofn in output_filenames:
+        concatenate_bamfiles([get_chunk_filename(ofn, ichunk)
+                              for ichunk in xrange(len(chunks))], ofn,
+                             input_filename)
+
+    counts = {key: 0 for key in ('total', 'unmapped', 'outer', 'cross',
+                                 'ambiguous', 'lowq')}
+    counts['mapped'] = [0 for i in xrange(n_fragments)]
+    for counts_chunk in counts_chunks:
+        for key, value in counts_chunk.iteritems():
+            if key == 'mapped':
+                counts[key] = map(sum, izip(counts[key], value))
+            else:
+                counts[key] += value
+
+    return counts
+
+
+def trim_and_divide_reads(data_folder, adaID, n_cycles, fragments,
+                          maxreads=-1, VERBOSE=0,
+                          minisize=100,
+                          include_tests=False, summary=True,
+                          threads=1, chunksize=100000):
+    '''Trim reads and divide them into fragments
+
+    Parameters:
+       threads (int): if more than one, split the read pairs into chunks of
+       chunksize and process them in a pool of processes
+    '''
+    if VERBOSE:
+        print 'Trim and divide into fragments: adaID '+adaID+', fragments: '+\
+                ' '.join(fragments)
+
+    if summary:
+        with open(get_divide_summary_filename(data_folder, adaID), 'a') as f:
+            f.write('Fragments used: '+' '.join(fragments)+'\n')
+
+    ref_filename = get_reference_premap_filename(data_folder, adaID)
+    refseq = SeqIO.read(ref_filename, 'fasta')
+    smat = np.array(refseq, 'S1')
+    len_reference = len(refseq)
+
+    # Get the positions of fragment start/end, w/ and w/o primers
+    frags_pos = get_fragment_positions(smat, fragments)
+    store_reference_fragmented(data_folder, adaID, refseq,
+                               dict(zip(fragments, frags_pos['trim'])))
+    if summary:
+        with open(get_divide_summary_filename(data_folder, adaID), 'a') as f:
+            f.write('Primer positions (for fragments):\n')
+            for (fragment, poss_full, poss_trim) in izip(fragments,
+                                                         frags_pos['full'],
+                                                         frags_pos['trim']):
+                f.write(fragment+': fwd '+str(poss_full[0])+' '+str(poss_trim[0])+\
+                                 ', rev '+str(poss_trim[1])+' '+str(poss_full[1])+'\n')
+    write_fragment_positions(data_folder, adaID, fragments, frags_pos)
+
+    # Get the positions of the unwanted outer primers
+    (primers_out_pos, primers_out_seq) = get_outer_primers(smat, fragments)
+
+    trim_kwargs = {'frags_pos': frags_pos,
+                   'primers_out_pos': primers_out_pos,
+                   'primers_out_seq': primers_out_seq,
+                   'len_reference': len_reference,
+                   'minisize': minisize,
+                   'include_tests': include_tests,
+                  }
+
     # Input and output files
     input_filename = get_premapped_filename(data_folder, adaID, type='bam')
     if not os.path.isfile(input_filename):
         convert_sam_to_bam(input_filename)
     output_filenames = get_divided_filenames(data_folder, adaID, fragments, type='bam')
-    with pysam.Samfile(input_filename, 'rb') as bamfile:
 
-        try:
-            file_handles = [pysam.Samfile(ofn, 'wb', template=bamfile)
-                            for ofn in output_filenames[:len(fragments)]]
-    
-            fo_am = pysam.Samfile(output_filenames[-4], 'wb', template=bamfile)
-            fo_cm = pysam.Samfile(output_filenames[-3], 'wb', template=bamfile)
-            fo_um = pysam.Samfile(output_filenames[-2], 'wb', template=bamfile)
-            fo_lq = pysam.Samfile(output_filenames[-1], 'wb', template=bamfile)
-
-            # Iterate over the mapped reads and assign fragments
-            n_mapped = [0 for fragment in fragments]
-            n_unmapped = 0
-            n_crossfrag = 0
-            n_ambiguous = 0
-            n_outer = 0
-            n_lowq = 0
-            for irp, reads in enumerate(pair_generator(bamfile)):
-
-                if irp == maxreads:
-                    if VERBOSE:
-                        print 'Maximal number of read pairs reached:', maxreads
-                    break
+    if threads <= 1:
+        with pysam.Samfile(input_filename, 'rb') as bamfile:
+            counts = divide_read_pairs(bamfile, output_filenames, len(fragments),
+                                       trim_kwargs, maxreads=maxreads,
+                                       VERBOSE=VERBOSE)
 
-                if VERBOSE >= 2:
-                    if not ((irp+1) % 10000):
-                        print irp+1
-
-                i_fwd = reads[0].is_reverse
-
-                # If unmapped or unpaired, mini, or insert size mini, or
-                # divergent read pair (fully cross-overlapping), discard
-                if reads[0].is_unmapped or (not reads[0].is_proper_pair) or \
-                   reads[1].is_unmapped or (not reads[1].is_proper_pair) or \
-                   (reads[0].rlen < 50) or (reads[1].rlen < 50) or \
-                   (reads[i_fwd].isize < minisize):
-                    if VERBOSE >= 3:
-                        print 'Read pair unmapped/unpaired/tiny/divergent:', reads[0].qname
-                    n_unmapped += 1
-                    fo_um.write(reads[0])
-                    fo_um.write(reads[1])
-                    continue
-
-                # If the insert is a misamplification from the outer primers
-                # in fragments that underwent nested PCR,
-                # trash it (it will have skewed amplification anyway). We cannot
-                # find all of those, rather only the ones still carrying the
-                # primer itself (some others have lost it while shearing). For
-                # those, no matter what happens at the end (reading into adapters,
-                # etc.), ONE of the reads in the pair will start exactly with one
-                # outer primer: if the rev read with a rev primer, if the fwd
-                # with a fwd one. Test all six.
-                if (len(primers_out_pos['fwd']) or len(primers_out_pos['rev'])) and \
-                   test_outer_primer(reads,
-                                     primers_out_pos, primers_out_seq,
-                                     len_reference):
-                    if VERBOSE >= 3:
-                        print 'Read pair from outer primer:', reads[0].qname
-                    n_outer += 1
-                    fo_um.write(reads[0])
-                    fo_um.write(reads[1])
-                    continue
-
-                # FIXME: the following becomes a bit harder when we mix parallel
-                # PCRs, e.g. F5a+b, to get more product
-
-                # Assign to a fragment now, so that primer trimming is faster 
-                pair_identity = assign_to_fragment(reads, frags_pos['full'],
-                                                   VERBOSE=VERBOSE)
-
-                # 1. If no fragments are possible (e.g. one read crosses the
-                # fragment boundary, they map to different fragments), dump it
-                # into a special bucket
-                if pair_identity == 'cross':
-                    n_crossfrag += 1
-                    fo_cm.write(reads[0])
-                    fo_cm.write(reads[1])
-                    continue
-
-                # 2. If 2+ fragments are possible (tie), put into a special bucket
-                # (essentially excluded, because we want two independent measurements
-                # in the overlapping region, but we might want to recover them)
-                elif pair_identity == 'ambiguous':
-                    n_ambiguous += 1
-                    fo_am.write(reads[0])
-                    fo_am.write(reads[1])
-                    continue
-
-                # 3. If the intersection is a single fragment, good: trim the primers
-                # NB: n_frag is the index IN THE POOL. If we sequence only F2-F5, F2 is n_frag = 0
-                n_frag = int(pair_identity)
-                frag_pos = frags_pos['trim'][n_frag]
-                if not np.isscalar(frag_pos[0]):
-                    frag_pos = [frag_pos[0]['inner'], frag_pos[1]['inner']]
-                trashed_primers = trim_primers(reads, frag_pos,
-                                               include_tests=include_tests)
-                if trashed_primers or (reads[i_fwd].isize < 100):
-                    n_unmapped += 1
-                    if VERBOSE >= 3:
-                        print 'Read pair is mismapped:', reads[0].qname
-                    fo_um.write(reads[0])
-                    fo_um.write(reads[1])
-                    continue
-
-                # Quality trimming: if no decently long pair survives, trash
-                #trashed_quality = main_block_low_quality(reads, phred_min=20,
-                #                                         include_tests=include_tests)
-                trashed_quality = trim_low_quality(reads, phred_min=20,
-                                                   include_tests=include_tests)
-                if trashed_quality or (reads[i_fwd].isize < 100):
-                    n_lowq += 1
-                    if VERBOSE >= 3:
-                        print 'Read pair has low phred quality:', reads[0].qname
-                    fo_lq.write(reads[0])
-                    fo_lq.write(reads[1])
-                    continue
-
-                # Check for cross-overhangs or COH (reading into the adapters)
-                #        --------------->
-                #    <-----------
-                # In that case, trim to perfect overlap.
-                if test_coh(reads, VERBOSE=False):
-                    trim_coh(reads, trim=0, include_tests=include_tests)
-
-                # Change coordinates into the fragmented reference (primer-trimmed)
-                for read in reads:
-                    read.pos -= frag_pos[0]
-                    read.mpos -= frag_pos[0]
-
-                # Here the tests
-                if include_tests:
-                    lfr = frags_pos['trim'][n_frag][1] - frags_pos['trim'][n_frag][0]
-                    if test_sanity(reads, n_frag, lfr):
-                        print 'Tests failed:', reads[0].qname
-                        import ipdb; ipdb.set_trace()
-
-                # There we go!
-                n_mapped[n_frag] += 1
-                file_handles[n_frag].write(reads[0])
-                file_handles[n_frag].write(reads[1])
+    else:
+        counts = divide_read_pairs_parallel(input_filename, output_filenames,
+                                            len(fragments), trim_kwargs,
+                                            threads=threads, chunksize=chunksize,
+                                            maxreads=maxreads, VERBOSE=VERBOSE)
 
-        finally:
-            for f in file_handles:
-                f.close()
-            fo_am.close()
-            fo_cm.close()
-            fo_um.close()
-            fo_lq.close()
+    for ofn in output_filenames:
+        write_bam_statistics(ofn, VERBOSE=VERBOSE)
 
+    n_mapped = counts['mapped']
+    n_unmapped = counts['unmapped']
+    n_outer = counts['outer']
+    n_crossfrag = counts['cross']
+    n_ambiguous = counts['ambiguous']
+    n_lowq = counts['lowq']
 
     if VERBOSE:
         print 'Trim and divide results: adaID '+adaID
-        print 'Total:\t\t', irp
+        print 'Total:\t\t', counts['total']
         print 'Mapped:\t\t', sum(n_mapped), n_mapped
         print 'Unmapped/unpaired/tiny:\t', n_unmapped
         print 'Outer primer\t', n_outer
@@ -697,7 +883,7 @@ def trim_and_divide_reads(data_folder, adaID, n_cycles, fragments,
         with open(get_divide_summary_filename(data_folder, adaID), 'a') as f:
             f.write('\n')
             f.write('Trim and divide results: adaID '+adaID+'\n')
-            f.write('Total:\t\t'+str(irp + 1)+'\n')
+            f.write('Total:\t\t'+str(counts['total'])+'\n')
             f.write('Mapped:\t\t'+str(sum(n_mapped))+' '+str(n_mapped)+'\n')
             f.write('Unmapped/unpaired/tiny insert:\t'+str(n_unmapped)+'\n')
             f.write('Outer primer\t'+str(n_outer)+'\n')
@@ -729,6 +915,8 @@ if __name__ == '__main__':
                         help='Include sanity checks on mapped reads (slow)')
     parser.add_argument('--no-summary', action='store_false', dest='summary',
                         help='Do not save results in a summary file')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of processes to use')
 
     args = parser.parse_args()
     seq_run = args.run
@@ -739,6 +927,7 @@ if __name__ == '__main__':
     submit = args.submit
     include_tests = args.test
     summary = args.summary
+    threads = args.threads
 
     dataset = load_sequencing_run(seq_run)
     data_folder = dataset.folder
@@ -773,7 +962,7 @@ if __name__ == '__main__':
             if include_tests:
                 raise ValueError('Tests require an interactive shell')
             fork_self(seq_run, adaID, VERBOSE=VERBOSE, maxreads=maxreads,
-                      minisize=minisize, summary=summary)
+                      minisize=minisize, summary=summary, threads=threads)
             continue
 
         make_output_folders(data_folder, adaID, VERBOSE=VERBOSE)
@@ -796,4 +985,4 @@ if __name__ == '__main__':
                               maxreads=maxreads, VERBOSE=VERBOSE,
                               minisize=minisize,
                               include_tests=include_tests,
-                              summary=summary)
+                              summary=summary, threads=threads)
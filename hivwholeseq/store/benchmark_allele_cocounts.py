@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# vim: fdm=marker
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Benchmark the allele cocount accumulator against the previous
+            implementation (sort and dedupe of a fixed-size array per pair).
+'''
+# Modules
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pysam
+from Bio import SeqIO
+
+from hivwholeseq.patients.samples import load_samples_sequenced as lssp
+from hivwholeseq.patients.samples import SamplePat
+from hivwholeseq.utils.miseq import alpha, alphal
+from hivwholeseq.utils.mapping import pair_generator
+from hivwholeseq.utils.two_site_statistics import get_coallele_counts_from_file as gac
+
+
+
+# Functions
+def get_coallele_counts_from_file_reference(bamfilename, length, qual_min=30,
+                                            maxreads=-1, VERBOSE=0):
+    '''Get allele cocounts with the previous implementation, for comparison'''
+    alpha_mapping = {a: alphal.index(a) for a in alphal}
+    SANGER_SCORE_OFFSET = ord("!")
+    q_mapping = dict()
+    for letter in xrange(0, 255):
+        q_mapping[chr(letter)] = letter - SANGER_SCORE_OFFSET
+
+    counts = np.zeros((len(alpha), len(alpha), length, length), int)
+    posall = np.zeros(1000, dtype=[('pos', int), ('aind', int)])
+
+    with pysam.Samfile(bamfilename, 'rb') as bamfile:
+        for ir, reads in enumerate(pair_generator(bamfile)):
+            if ir == maxreads:
+                break
+
+            posall[:] = (-1, -1)
+            iall = 0
+            for read in reads:
+                alleles_ind = np.fromiter((alpha_mapping[x] for x in read.seq),
+                                          np.uint8, len(read.seq))
+                allqual_ind = np.fromiter((q_mapping[x] for x in read.qual),
+                                          np.uint8, len(read.qual))
+
+                pos_ref = read.pos
+                pos_read = 0
+                for (bt, bl) in read.cigar:
+                    if bt == 1:
+                        pos_read += bl
+                    elif bt == 2:
+                        qual_deletion = allqual_ind[pos_read: pos_read + 2].min()
+                        if qual_deletion >= qual_min:
+                            posall['pos'][iall: iall + bl] = np.arange(pos_ref,
+                                                                       pos_ref + bl)
+                            posall['aind'][iall: iall + bl] = 4
+                            iall += bl
+                        pos_ref += bl
+                    else:
+                        alleles_indb = alleles_ind[pos_read: pos_read + bl]
+                        allqual_indb = allqual_ind[pos_read: pos_read + bl]
+                        for i in xrange(len(alpha)):
+                            aitmp = (alleles_indb == i) & (allqual_indb >= qual_min)
+                            aitmp = aitmp.nonzero()[0] + pos_ref
+                            aitmplen = len(aitmp)
+                            posall['pos'][iall: iall + aitmplen] = aitmp
+                            posall['aind'][iall: iall + aitmplen] = i
+                            iall += aitmplen
+
+                        pos_read += bl
+                        pos_ref += bl
+
+            posall.sort(order=('pos', 'aind'))
+            iall = (posall['pos'] != -1).nonzero()[0][0]
+            while iall < len(posall) - 1:
+                if posall['pos'][iall + 1] == posall['pos'][iall]:
+                    if posall['aind'][iall + 1] == posall['aind'][iall]:
+                        posall[iall + 1] = (-1, -1)
+                    else:
+                        ibin = np.random.randint(2)
+                        posall[iall + ibin] = (-1, -1)
+                    iall += 1
+                iall += 1
+
+            poss = [posall['pos'][posall['aind'] == i1] for i1 in xrange(len(alpha))]
+            for i1 in xrange(len(alpha)):
+                poss1 = poss[i1]
+                if not len(poss1):
+                    continue
+                for i2 in xrange(len(alpha)):
+                    poss2 = poss[i2]
+                    if not len(poss2):
+                        continue
+                    cobra = counts[i1, i2].ravel()
+                    ind = poss1.repeat(len(poss2)) * length + np.tile(poss2, len(poss1))
+                    cobra[ind] += 1
+
+    return counts
+
+
+def benchmark(bamfilename, length, qual_min=30, maxreads=-1, seed=0, VERBOSE=0):
+    '''Time the two implementations and compare their results
+
+    Mates disagreeing at an overlap are resolved at random by both, so the
+    cocounts are not expected to be identical, but the cocoverage is.
+    '''
+    np.random.seed(seed)
+    t0 = time.time()
+    cc_ref = get_coallele_counts_from_file_reference(bamfilename, length,
+                                                     qual_min=qual_min,
+                                                     maxreads=maxreads,
+                                                     VERBOSE=VERBOSE)
+    t_ref = time.time() - t0
+
+    t0 = time.time()
+    cc = gac(bamfilename, length, qual_min=qual_min, maxreads=maxreads,
+             seed=seed, VERBOSE=VERBOSE)
+    t_new = time.time() - t0
+
+    t0 = time.time()
+    gac(bamfilename, length, qual_min=qual_min, maxreads=maxreads,
+        seed=seed, VERBOSE=VERBOSE, sparse=True)
+    t_sparse = time.time() - t0
+
+    cocov_equal = (cc.sum(axis=0).sum(axis=0) == cc_ref.sum(axis=0).sum(axis=0)).all()
+    frac_diff = (cc != cc_ref).sum() / float(max(1, ((cc != 0) | (cc_ref != 0)).sum()))
+
+    return {'time reference': t_ref,
+            'time dense': t_new,
+            'time sparse': t_sparse,
+            'cocoverage equal': cocov_equal,
+            'fraction of cocounts different': frac_diff,
+           }
+
+
+
+# Script
+if __name__ == '__main__':
+
+    # Parse input args
+    parser = argparse.ArgumentParser(description='Benchmark allele cocounts',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--samples', nargs='+', required=True,
+                        help='Samples to analyze')
+    parser.add_argument('--fragments', nargs='*',
+                        help='Fragment to map (e.g. F1 F6)')
+    parser.add_argument('--maxreads', type=int, default=10000,
+                        help='Number of read pairs to scan')
+    parser.add_argument('--verbose', type=int, default=0,
+                        help='Verbosity level [0-3]')
+    parser.add_argument('--qualmin', type=int, default=30,
+                        help='Minimal quality of base to call')
+    parser.add_argument('--PCR', type=int, default=1,
+                        help='Analyze only reads from this PCR (1 or 2)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the random choice at mate disagreements')
+
+    args = parser.parse_args()
+    samplenames = args.samples
+    fragments = args.fragments
+    VERBOSE = args.verbose
+    maxreads = args.maxreads
+    qual_min = args.qualmin
+    PCR = args.PCR
+    seed = args.seed
+
+    samples = lssp()
+    samples = samples.loc[samples.index.isin(samplenames)]
+
+    if not fragments:
+        fragments = ['F'+str(i) for i in xrange(1, 7)]
+
+    for samplename, sample in samples.iterrows():
+        sample = SamplePat(sample)
+        for fragment in fragments:
+            fn = sample.get_mapped_filtered_filename(fragment, PCR=PCR,
+                                                     decontaminated=True)
+            if not os.path.isfile(fn):
+                if VERBOSE >= 2:
+                    print 'Input file not found, skipping'
+                continue
+
+            refseq = SeqIO.read(sample.get_reference_filename(fragment), 'fasta')
+            res = benchmark(fn, len(refseq), qual_min=qual_min,
+                            maxreads=maxreads, seed=seed, VERBOSE=VERBOSE)
+
+            print samplename, fragment
+            for key, value in res.iteritems():
+                print key+':', value
@@ -13,6 +13,8 @@ import numpy as np
 
 from hivwholeseq.patients.samples import load_samples_sequenced as lssp
 from hivwholeseq.patients.samples import SamplePat
+from hivwholeseq.utils.two_site_statistics import sparsify_coallele_counts, \
+        save_coallele_counts_sparse
 from hivwholeseq.cluster.fork_cluster import fork_compress_cocounts_patient as fork_self
 
 
@@ -38,6 +40,8 @@ if __name__ == '__main__':
                         help='Minimal quality of base to call')
     parser.add_argument('--PCR', type=int, default=1,
                         help='Analyze only reads from this PCR (1 or 2)')
+    parser.add_argument('--sparse', action='store_true',
+                        help='Convert to the compact (sparse) cocounts')
 
     args = parser.parse_args()
     pnames = args.patients
@@ -47,6 +51,7 @@ if __name__ == '__main__':
     submit = args.submit
     qual_min = args.qualmin
     PCR = args.PCR
+    sparse = args.sparse
 
     samples = lssp()
     if pnames is not None:
@@ -66,7 +71,7 @@ if __name__ == '__main__':
         for fragment in fragments:
             for samplename, sample in samples.iterrows():
                 fork_self(samplename, fragment, VERBOSE=VERBOSE,
-                          qual_min=qual_min, PCR=PCR)
+                          qual_min=qual_min, PCR=PCR, sparse=sparse)
         sys.exit()
 
 
@@ -84,6 +89,13 @@ if __name__ == '__main__':
                                                      compressed=False)
             
             fn_out = sample.get_allele_cocounts_filename(fragment, PCR=PCR,
+                                                         qual_min=qual_min,
+                                                         compressed=True,
+                                                         sparse=sparse)
+
+            # The sparse format can be made from the compressed dense one too
+            if sparse and (not os.path.isfile(fn)):
+                fn = sample.get_allele_cocounts_filename(fragment, PCR=PCR,
                                                          qual_min=qual_min,
                                                          compressed=True)
 
@@ -95,7 +107,15 @@ if __name__ == '__main__':
             if VERBOSE >= 2:
                 print 'Loading cocounts'
             cocount = np.load(fn)
+            if fn.endswith('.npz'):
+                cocount = cocount['cocounts']
 
-            if VERBOSE >= 2:
-                print 'Storing compressed cocounts'
-            np.savez_compressed(fn_out, cocounts=cocount)
+            if sparse:
+                if VERBOSE >= 2:
+                    print 'Storing sparse cocounts'
+                save_coallele_counts_sparse(fn_out, sparsify_coallele_counts(cocount))
+
+            else:
+                if VERBOSE >= 2:
+                    print 'Storing compressed cocounts'
+                np.savez_compressed(fn_out, cocounts=cocount)
@@ -10,6 +10,7 @@ content:    Take the mapped reads and check for cross-contamination between the
 import os
 import sys
 import argparse
+from itertools import izip
 import numpy as np
 from Bio import SeqIO
 
@@ -17,6 +18,8 @@ from hivwholeseq.patients.patients import load_samples_sequenced as lssp
 from hivwholeseq.patients.patients import SamplePat
 from hivwholeseq.reference import load_custom_reference
 from hivwholeseq.utils.sequence import pretty_print_pairwise_ali
+from hivwholeseq.utils.bam_statistics import write_bam_statistics
+from hivwholeseq.utils.kmers import KmerIndex
 from hivwholeseq.patients.filenames import get_decontaminate_summary_filename
 from hivwholeseq.cluster.fork_cluster import fork_decontaminate_reads_patient as fork_self
 
@@ -25,6 +28,10 @@ from hivwholeseq.cluster.fork_cluster import fork_decontaminate_reads_patient as
 # Globals
 refnames = ['38304', '38540', 'LAI-III']
 
+# Consensi and k-mer index shared with the worker processes: they are set
+# before the pool is started, so the workers inherit them copy-on-write
+_pool_data = {}
+
 
 
 # Functions
@@ -100,9 +107,110 @@ def trim_align_overlap(ali):
     return (ali1, ali2)
 
 
+def align_delta(refseq, seq, **kwargs):
+    '''Overlap alignment of a read to a consensus and its delta from a perfect score
+
+    Returns:
+       (delta, ali): the score delta and the trimmed alignment
+    '''
+    from seqanpy import align_overlap
+    score_match = kwargs.get('score_match', 3)
+
+    (score, ali1, ali2) = align_overlap(refseq, seq, **kwargs)
+    (ali1, ali2) = trim_align_overlap((ali1, ali2))
+    scoremax = len(ali1) * score_match
+    return (scoremax - score, (ali1, ali2))
+
+
+def classify_read(seq, consseq, samplename, contseqs,
+                  deltascore_max_self=60, deltascore_max_other=24,
+                  candidates=None, **kwargs):
+    '''Check whether a read comes from its own consensus or from a contaminant
+
+    Args:
+      candidates (list): align only to these contaminants (default: all)
+      **kwargs: passed down to the pairwise alignment function
+
+    Returns:
+      (status, contname, delta, alignments): status is 'self' (very close to its
+      own consensus), 'closest' (closer to its own consensus than to others),
+      'contaminated' (close to contname), or 'none' (close to nothing really).
+    '''
+    from operator import itemgetter
+
+    # Look for distance to the own consensus, it that's small move on
+    alignments = {}
+    deltas = {}
+    (delta, alignments[samplename]) = align_delta(consseq, seq, **kwargs)
+    deltas[samplename] = delta
+    if delta <= deltascore_max_self:
+        return ('self', samplename, delta, alignments)
+
+    # Otherwise, move on to other sequences and find the neighbour
+    if candidates is None:
+        candidates = contseqs.iterkeys()
+    for contname in candidates:
+        (deltas[contname], alignments[contname]) = align_delta(contseqs[contname],
+                                                               seq, **kwargs)
+
+    (contname, delta) = min(deltas.iteritems(), key=itemgetter(1))
+
+    # Again, the correct consensus has precedence
+    if deltas[samplename] == delta:
+        contname = samplename
+
+    # The read may be closest to its own consensus, if not very close
+    if contname == samplename:
+        return ('closest', contname, delta, alignments)
+
+    # The read may come from another consensus (contamination)
+    elif delta <= deltascore_max_other:
+        return ('contaminated', contname, delta, alignments)
+
+    # Finally, the read is not really close to anything: accept
+    else:
+        return ('none', contname, delta, alignments)
+
+
+def classify_read_shortlist(seq, consseq, samplename, contseqs, contnames=None,
+                            kmer_index=None, n_candidates=5, validate=False,
+                            **kwargs):
+    '''Classify a read, aligning only to the contaminants shortlisted by k-mers
+
+    Args:
+      contnames (list): names of the contaminants in the k-mer index
+      kmer_index (KmerIndex): if None, align to all contaminants
+      validate (bool): also search all contaminants and use that result
+      **kwargs: passed down to classify_read
+
+    Returns:
+      (status, contname, delta, alignments, disagree): see classify_read;
+      disagree is None if the shortlist was not validated, else whether the
+      exhaustive search gave a different answer
+    '''
+    if kmer_index is None:
+        return classify_read(seq, consseq, samplename, contseqs, **kwargs) + (None,)
+
+    if contnames is None:
+        contnames = contseqs.keys()
+    candidates = kmer_index.get_candidates(seq, n=n_candidates, names=contnames)
+    res = classify_read(seq, consseq, samplename, contseqs, candidates=candidates,
+                        **kwargs)
+
+    # The shortlist does not matter if the read is close to its own consensus
+    if (not validate) or (res[0] == 'self'):
+        return res + (None,)
+
+    # Compare with the exhaustive search
+    res_all = classify_read(seq, consseq, samplename, contseqs, **kwargs)
+    disagree = res_all[:2] != res[:2]
+    return res_all + (disagree,)
+
+
 def filter_contamination(bamfilename, bamfilename_out, contseqs, samplename, VERBOSE=0,
                          deltascore_max_self=60, deltascore_max_other=24,
                          maxreads=-1,
+                         kmer_index=None, n_candidates=5, validate=False,
                          **kwargs):
     '''Fish contaminated reads from mapped reads
 
@@ -114,28 +222,33 @@ def filter_contamination(bamfilename, bamfilename_out, contseqs, samplename, VER
                                  consensus to be considered pure
       deltascore_max_other (int): the maximal delta in alignment score to any other
                                   sample to be considered a contamination
+      kmer_index (KmerIndex): if not None, align only to the n_candidates
+                              consensi sharing most k-mers with the read
+      validate (bool): also search all consensi, use that result, and count
+                       the reads for which the k-mer shortlist disagrees
       **kwargs: passed down to the pairwise alignment function
+
+    Returns:
+      (n_good, n_cont): number of good read pairs and of contaminated pairs by
+      source; if validate, also (n_disagree, n_searched): reads for which the
+      shortlist gave a different answer, out of those searched.
     '''
     import pysam
     from collections import defaultdict
-    from operator import itemgetter
-    from seqanpy import align_overlap
 
     from hivwholeseq.utils.mapping import pair_generator, get_number_reads
 
-    if 'score_match' in kwargs:
-        score_match = kwargs['score_match']
-    else:
-        score_match = 3
-
     bamfilename_trash = bamfilename_out[:-4]+'_trashed.bam'
 
     contseqs = contseqs.copy()
     consseq = contseqs.pop(samplename)
+    contnames = contseqs.keys()
 
     if VERBOSE >= 2:
         print 'Scanning reads ('+str(get_number_reads(bamfilename) // 2)+')'
 
+    n_disagree = 0
+    n_searched = 0
     with pysam.Samfile(bamfilename, 'rb') as bamfile:
         with pysam.Samfile(bamfilename_out, 'wb', template=bamfile) as bamfileout, \
              pysam.Samfile(bamfilename_trash, 'wb', template=bamfile) as bamfiletrash:
@@ -153,54 +266,36 @@ def filter_contamination(bamfilename, bamfilename_out, contseqs, samplename, VER
                         print irp + 1
 
                 for read in reads:
-
-                    # Look for distance to the own consensus, it that's small move on
-                    alignments_read = {}
-                    deltas_read = {}
-                    (score, alis1, alis2) = align_overlap(consseq, read.seq, **kwargs)
-                    (alis1, alis2) = trim_align_overlap((alis1, alis2))
-                    scoremax = len(alis1) * score_match
-                    delta_read = scoremax - score
-                    deltas_read[samplename] = delta_read
-                    alignments_read[samplename] = (alis1, alis2)
-                    if delta_read <= deltascore_max_self:
+                    (status, contname, delta_read, alignments, disagree) = \
+                            classify_read_shortlist(read.seq, consseq, samplename,
+                                                    contseqs, contnames=contnames,
+                                                    kmer_index=kmer_index,
+                                                    n_candidates=n_candidates,
+                                                    validate=validate,
+                                                    deltascore_max_self=deltascore_max_self,
+                                                    deltascore_max_other=deltascore_max_other,
+                                                    **kwargs)
+                    if disagree is not None:
+                        n_searched += 1
+                        n_disagree += disagree
+                        if disagree and (VERBOSE >= 3):
+                            print 'K-mer shortlist disagrees:', read.qname
+
+                    if status == 'self':
                         if VERBOSE >= 4:
-                            print 'Read is very close to its own consensus', scoremax, score, delta_read
-                            pretty_print_pairwise_ali([alis1, alis2], width=90,
+                            print 'Read is very close to its own consensus', delta_read
+                            pretty_print_pairwise_ali(alignments[samplename], width=90,
                                                       name1='ref', name2='read')
                         continue
 
-                    # Otherwise, move on to all other sequences and find the neighbour
-                    for contname, contseq in contseqs.iteritems():
-                        (score, ali1, ali2) = align_overlap(contseq, read.seq, **kwargs)
-                        (ali1, ali2) = trim_align_overlap((ali1, ali2))
-                        scoremax = len(ali1) * score_match
-                        delta_read = scoremax - score
-                        deltas_read[contname] = delta_read
-                        alignments_read[contname] = (ali1, ali2)
-
-                    if VERBOSE >= 5:
-                        print samplename
-                        for key, d in deltas_read.iteritems():
-                            print key, d
-                        
-                    (contname, delta_read) = min(deltas_read.iteritems(), key=itemgetter(1))
-
-                    # Again, the correct consensus has precedence
-                    if deltas_read[samplename] == delta_read:
-                        contname = samplename
-
-                    (ali1, ali2) = alignments_read[contname]
-
-                    # The read may be closest to its own consensus, if not very close
-                    if contname == samplename:
+                    elif status == 'closest':
                         if VERBOSE >= 4:
-                            print 'Read is closest to its consensus', scoremax, score, delta_read
-                            pretty_print_pairwise_ali([ali1, ali2], width=90,
+                            print 'Read is closest to its consensus', delta_read
+                            pretty_print_pairwise_ali(alignments[samplename], width=90,
                                                       name1='ref', name2='read')
+                        continue
 
-                    # The read may come from another consensus (contamination)
-                    elif (delta_read <= deltascore_max_other):
+                    elif status == 'contaminated':
                         n_cont[contname] += 1
                         bamfiletrash.write(reads[0])
                         bamfiletrash.write(reads[1])
@@ -209,37 +304,173 @@ def filter_contamination(bamfilename, bamfilename_out, contseqs, samplename, VER
                             print 'Contaminated read found! Good:', n_good, 'cont:', sum(n_cont.itervalues()), 'sources:', n_cont
 
                         if VERBOSE >= 3:
-                            print 'Read is contaminated by', contname, scoremax, score, delta_read
-                            pretty_print_pairwise_ali([alis1, alis2], width=90,
+                            print 'Read is contaminated by', contname, delta_read
+                            pretty_print_pairwise_ali(alignments[samplename], width=90,
                                                       name1='self', name2='read')
                             print ''
-                            pretty_print_pairwise_ali([ali1, ali2], width=90,
+                            pretty_print_pairwise_ali(alignments[contname], width=90,
                                                       name1='ref', name2='read')
 
                         if VERBOSE >= 2:
                             print ''
 
-
                         break
 
-                    # Finally, the read is not really close to anything: accept
                     else:
                         if VERBOSE >= 4:
-                            print 'Read is close to nothing really', scoremax, score, delta_read
-                            pretty_print_pairwise_ali([ali1, ali2], width=90, name1='ref', name2='read')
+                            print 'Read is close to nothing really', delta_read
+                            pretty_print_pairwise_ali(alignments[contname], width=90,
+                                                      name1='ref', name2='read')
 
                 else:
                     n_good += 1
                     bamfileout.write(reads[0])
                     bamfileout.write(reads[1])
 
+    write_bam_statistics(bamfilename_out, VERBOSE=VERBOSE)
+
     n_cont = dict(n_cont)
 
+    if validate:
+        return (n_good, n_cont, n_disagree, n_searched)
     return (n_good, n_cont)
 
 
 
 
+def _classify_read_pairs_chunk(seqs_chunk):
+    '''Classify a chunk of read pairs (for the pool)
+
+    Returns:
+      (contnames, n_disagree, n_searched): contnames has the source of each
+      contaminated pair, None for good pairs
+    '''
+    contnames = []
+    n_disagree = 0
+    n_searched = 0
+    for seqs in seqs_chunk:
+        for seq in seqs:
+            (status, contname, _, _, disagree) = classify_read_shortlist(seq, **_pool_data)
+            if disagree is not None:
+                n_searched += 1
+                n_disagree += disagree
+            if status == 'contaminated':
+                contnames.append(contname)
+                break
+        else:
+            contnames.append(None)
+
+    return (contnames, n_disagree, n_searched)
+
+
+def filter_contamination_parallel(bamfilename, bamfilename_out, contseqs, samplename,
+                                  VERBOSE=0,
+                                  deltascore_max_self=60, deltascore_max_other=24,
+                                  maxreads=-1,
+                                  kmer_index=None, n_candidates=5, validate=False,
+                                  threads=2, chunksize=1000,
+                                  **kwargs):
+    '''Fish contaminated reads from mapped reads, using a pool of processes
+
+    Args:
+      threads (int): number of worker processes
+      chunksize (int): number of read pairs sent to a worker at a time
+
+    Read pairs are streamed to the workers in chunks and written back in
+    order, so the output files and the returned values are the same as
+    with filter_contamination.
+    '''
+    import pysam
+    from collections import defaultdict, deque
+    from itertools import islice
+    from multiprocessing import Pool
+
+    from hivwholeseq.utils.mapping import pair_generator, get_number_reads
+
+    bamfilename_trash = bamfilename_out[:-4]+'_trashed.bam'
+
+    contseqs = contseqs.copy()
+    consseq = contseqs.pop(samplename)
+
+    if VERBOSE >= 2:
+        print 'Scanning reads ('+str(get_number_reads(bamfilename) // 2)+')'
+
+    _pool_data.clear()
+    _pool_data.update(kwargs)
+    _pool_data.update({'consseq': consseq,
+                       'samplename': samplename,
+                       'contseqs': contseqs,
+                       'contnames': contseqs.keys(),
+                       'kmer_index': kmer_index,
+                       'n_candidates': n_candidates,
+                       'validate': validate,
+                       'deltascore_max_self': deltascore_max_self,
+                       'deltascore_max_other': deltascore_max_other,
+                      })
+
+    pool = Pool(processes=threads)
+    n_good = 0
+    n_cont = defaultdict(int)
+    n_disagree = 0
+    n_searched = 0
+    try:
+        with pysam.Samfile(bamfilename, 'rb') as bamfile:
+            with pysam.Samfile(bamfilename_out, 'wb', template=bamfile) as bamfileout, \
+                 pysam.Samfile(bamfilename_trash, 'wb', template=bamfile) as bamfiletrash:
+
+                pairs = pair_generator(bamfile)
+                if maxreads != -1:
+                    pairs = islice(pairs, maxreads)
+
+                # Keep a few chunks per worker in flight, write them in order
+                pending = deque()
+                while True:
+                    chunk = [tuple(reads) for reads in islice(pairs, chunksize)]
+                    if chunk:
+                        seqs_chunk = [(reads[0].seq, reads[1].seq) for reads in chunk]
+                        pending.append((chunk, pool.apply_async(_classify_read_pairs_chunk,
+                                                                (seqs_chunk,))))
+                        if len(pending) < 2 * threads:
+                            continue
+
+                    if not pending:
+                        break
+
+                    (chunk_done, res) = pending.popleft()
+                    (contnames, n_disagree_chunk, n_searched_chunk) = res.get()
+                    n_disagree += n_disagree_chunk
+                    n_searched += n_searched_chunk
+                    for reads, contname in izip(chunk_done, contnames):
+                        if contname is None:
+                            n_good += 1
+                            bamfileout.write(reads[0])
+                            bamfileout.write(reads[1])
+                        else:
+                            n_cont[contname] += 1
+                            bamfiletrash.write(reads[0])
+                            bamfiletrash.write(reads[1])
+
+                    if VERBOSE >= 2:
+                        print 'Good:', n_good, 'cont:', sum(n_cont.itervalues())
+
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _pool_data.clear()
+
+    write_bam_statistics(bamfilename_out, VERBOSE=VERBOSE)
+
+    n_cont = dict(n_cont)
+
+    if validate:
+        return (n_good, n_cont, n_disagree, n_searched)
+    return (n_good, n_cont)
+
+
+
 # Script
 if __name__ == '__main__':
 
@@ -263,6 +494,14 @@ if __name__ == '__main__':
                         help='Execute the script in parallel on the cluster')
     parser.add_argument('--PCR', type=int, default=1,
                         help='Analyze only reads from this PCR (e.g. 1)')
+    parser.add_argument('--kmer', type=int, default=12,
+                        help='Length of k-mers to shortlist contaminants (0 to align to all)')
+    parser.add_argument('--candidates', type=int, default=5,
+                        help='Number of contaminants to align to after the k-mer shortlist')
+    parser.add_argument('--validate-kmers', action='store_true', dest='validate',
+                        help='Also align to all contaminants and count disagreements')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of processes to decontaminate reads in parallel')
 
     args = parser.parse_args()
     pnames = args.patients
@@ -273,6 +512,10 @@ if __name__ == '__main__':
     maxreads = args.maxreads
     summary = args.summary
     PCR = args.PCR
+    kmer = args.kmer
+    n_candidates = args.candidates
+    validate = args.validate
+    threads = args.threads
 
     samples = lssp()
     if pnames is not None:
@@ -309,7 +552,9 @@ if __name__ == '__main__':
                     #    continue
 
                     fork_self(samplename, fragment, VERBOSE=VERBOSE, maxreads=maxreads,
-                              summary=summary, PCR=PCR_sample)
+                              summary=summary, PCR=PCR_sample,
+                              kmer=kmer, candidates=n_candidates,
+                              validate=validate, threads=threads)
 
         sys.exit()
 
@@ -319,11 +564,18 @@ if __name__ == '__main__':
         for samplename, sample in samples.iterrows():
             sample = SamplePat(sample)
             try:
-                consensi[samplename] = sample.get_consensus(fragment, PCR=1)
+                consensi[samplename] = ''.join(sample.get_consensus(fragment, PCR=1))
             except IOError:
                 print samplename, 'file not found'
                 continue
 
+        if kmer:
+            if VERBOSE >= 2:
+                print 'Build k-mer index of the consensi, k =', kmer
+            kmer_index = KmerIndex(consensi, k=kmer)
+        else:
+            kmer_index = None
+
         for samplename, sample in samples_focal.iterrows():
             sample = SamplePat(sample)
             pname = sample.patient
@@ -360,13 +612,29 @@ if __name__ == '__main__':
                 print samplename,
                 if VERBOSE >= 2:
                     print ''
-                (n_good, n_cont) = filter_contamination(bamfilename, bamfilename_out,
+                if threads > 1:
+                    res = filter_contamination_parallel(bamfilename, bamfilename_out,
                                                         consensi_sample, samplename,
                                                         VERBOSE=VERBOSE,
-                                                        maxreads=maxreads)
+                                                        maxreads=maxreads,
+                                                        kmer_index=kmer_index,
+                                                        n_candidates=n_candidates,
+                                                        validate=validate,
+                                                        threads=threads)
+                else:
+                    res = filter_contamination(bamfilename, bamfilename_out,
+                                               consensi_sample, samplename,
+                                               VERBOSE=VERBOSE,
+                                               maxreads=maxreads,
+                                               kmer_index=kmer_index,
+                                               n_candidates=n_candidates,
+                                               validate=validate)
+                (n_good, n_cont) = res[:2]
 
                 if VERBOSE:
                     print 'good:', n_good, 'contaminated:', n_cont
+                    if validate and (kmer_index is not None):
+                        print 'k-mer shortlist disagreements:', res[2], '/', res[3]
 
                 if summary:
                     sfn = get_decontaminate_summary_filename(pname, samplename, fragment,
@@ -378,9 +646,15 @@ if __name__ == '__main__':
                                 ' --verbose '+str(VERBOSE))
                         if maxreads != -1:
                             f.write(' --maxreads '+str(maxreads))
+                        f.write(' --kmer '+str(kmer))
+                        if kmer:
+                            f.write(' --candidates '+str(n_candidates))
                         f.write('\n')
                         f.write('Good: '+str(n_good)+'\n')
                         f.write('Contaminated: '+str(sum(n_cont.itervalues()))+'\n')
+                        if validate and (kmer_index is not None):
+                            f.write('K-mer shortlist disagreements: '+str(res[2])+\
+                                    ' / '+str(res[3])+'\n')
                         f.write('Contamination sources:\n')
                         for contname, n_conti in n_cont.iteritems():
                             f.write('{:<20s}'.format(contname)+' '+'{:>7d}'.format(n_conti)+'\n')
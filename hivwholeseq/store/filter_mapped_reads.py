@@ -20,13 +20,12 @@ from hivwholeseq.patients.patients import load_patient
 from hivwholeseq.patients.samples import SamplePat
 from hivwholeseq.patients.samples import load_samples_sequenced as lssp
 from hivwholeseq.sequencing.samples import load_samples_sequenced as lss
-from hivwholeseq.sequencing.filter_mapped_reads import plot_distance_histogram, \
-        plot_distance_histogram_sliding_window, get_distance_from_consensus, \
-        check_overhanging_reads
 from hivwholeseq.patients.filenames import get_initial_reference_filename, \
         get_mapped_to_initial_filename, get_filter_mapped_init_summary_filename, \
         get_mapped_filtered_filename
-from hivwholeseq.utils.mapping import convert_sam_to_bam, pair_generator
+from hivwholeseq.utils.filter_pairs import filter_read_pairs_batch, \
+        filter_read_pairs_bams
+from hivwholeseq.utils.bam_statistics import write_bam_statistics
 from hivwholeseq.cluster.fork_cluster import fork_filter_mapped_init as fork_self
 
 
@@ -40,79 +39,17 @@ def filter_read_pair(reads,
                      match_len_min=30,
                      trim_bad_cigars=3,
                      VERBOSE=0):
-    '''Filter read pair'''
-    from hivwholeseq.utils.mapping import trim_short_cigars_pair
-
-    (read1, read2) = reads
-
-    # Check names to make sure we are looking at paired reads, this would
-    # screw up the whole bamfile
-    if read1.qname != read2.qname:
-        n_wrongname += 1
-        raise ValueError('Read pair '+str(irp)+': reads have different names!')
-
-    # Ignore unmapped reads
-    if read1.is_unmapped or read2.is_unmapped:
-        if VERBOSE >= 2:
-            print 'Read pair '+read1.qname+': unmapped'
-        return 'unmapped'
-
-    # Ignore not properly paired reads (this includes mates sitting on
-    # different fragments)
-    if (not read1.is_proper_pair) or (not read2.is_proper_pair):
-        if VERBOSE >= 2:
-            print 'Read pair '+read1.qname+': not properly paired'
-        return 'unpaired'
-        
-    i_fwd = reads[0].is_reverse
-    i_rev = not i_fwd
-    readf = reads[i_fwd]
-    readr = reads[i_rev]
-
-    # Mismappings are often characterized by many mutations:
-    # check the number of mismatches and skip reads with too many
-    dc = get_distance_from_consensus(ref, reads, VERBOSE=VERBOSE)
-    
-    if hist_distance_from_consensus is not None:
-        hist_distance_from_consensus[dc.sum()] += 1
-
-    if hist_dist_along is not None:
-        hbin = (readf.pos + readf.isize / 2) // binsize
-        hist_dist_along[hbin, dc.sum()] += 1
-
-    if (dc.sum() > max_mismatches):
-        if VERBOSE >= 2:
-            print 'Read pair '+read1.qname+': too many mismatches '+\
-                    '('+str(dc[0])+' + '+str(dc[1])+')'
-        return 'mutator'
-
-    # Trim the bad CIGARs from the sides, if there are any good ones
-    # FIXME: this must have a bug with leading insertions
-    # NOTE: I rewrote the function, now simpler, it should work
-    skip = trim_short_cigars_pair(reads, match_len_min=match_len_min,
-                                  trim_pad=trim_bad_cigars, throw=False)
-    if skip:
-        return 'bad_cigar'
-
-    # Check the reads are still long enough after trimming
-    if (len(read1.seq) < 100):
-        if VERBOSE >= 2:
-            print 'Read too short:', read1.qname, len(read1.seq)
-        return 'tiny'
-    
-    if (len(read2.seq) < 100):
-        if VERBOSE >= 2:
-            print 'Read too short:', read2.qname, len(read2.seq)
-        return 'tiny'
-
-    # NOTE: cross-overhang and similar stuff should never happen, because we
-    # filter only insert sizes > 400 after premapping. Nonetheless...
-    if readf.isize < 300:
-        if VERBOSE >= 2:
-            print 'Insert too small:', readf.isize
-        return 'tiny'
-
-    return 'good'
+    '''Filter read pair (see filter_read_pairs_batch for many pairs)'''
+    return filter_read_pairs_batch([reads], ref,
+                                   hist_distance_from_consensus=hist_distance_from_consensus,
+                                   hist_dist_along=hist_dist_along,
+                                   binsize=binsize,
+                                   max_mismatches=max_mismatches,
+                                   match_len_min=match_len_min,
+                                   trim_bad_cigars=trim_bad_cigars,
+                                   read_len_min=100,
+                                   isize_min=300,
+                                   VERBOSE=VERBOSE)[0]
 
 
 def filter_mapped_reads(sample, fragment,
@@ -123,8 +60,14 @@ def filter_mapped_reads(sample, fragment,
                         max_mismatches=100,
                         match_len_min=30,
                         trim_bad_cigars=3,
-                        summary=True):
-    '''Filter the reads to good chunks'''
+                        summary=True,
+                        threads=1):
+    '''Filter the reads to good chunks
+
+    Parameters:
+       threads (int): number of processes, each filtering the reads of one
+       sequenced sample
+    '''
     pname = sample.patient
     samplename_pat = sample.name
     samplenames_seq = sample.samples_seq.index.tolist()
@@ -160,82 +103,29 @@ def filter_mapped_reads(sample, fragment,
             print ''
         print '\n'.join(infilenames)
 
-    # Use first file as template for the new bamfile
-    infilename = infilenames[0]
-    if not os.path.isfile(infilename):
-        convert_sam_to_bam(infilename)
- 
-    with pysam.Samfile(infilename, 'rb') as bamfile:
-        with pysam.Samfile(outfilename, 'wb', template=bamfile) as outfile,\
-             pysam.Samfile(trashfilename, 'wb', template=bamfile) as trashfile:
- 
-            n_good = 0
-            n_wrongname = 0
-            n_unmapped = 0
-            n_unpaired = 0
-            n_mutator = 0
-            n_badcigar = 0
-            n_tiny = 0
-            binsize = 200
-            hist_distance_from_consensus = np.zeros(n_cycles + 1, int)
-            hist_dist_along = np.zeros((len(ref) // binsize + 1, n_cycles + 1), int)
-
-            # Iterate over input files, the first is already open
-            for infilename in infilenames:
-
-                if infilename != infilename[0]:
-                    file_open = lambda: pysam.Samfile(infilename, 'rb')
-                    file_close = lambda f: f.close()
-
-                    if not os.path.isfile(infilename):
-                        convert_sam_to_bam(infilename)
-
-                else:
-                    file_open = lambda: bamfile
-                    file_close = lambda f: None
-
-                try:
-                    bamfile = file_open()
-    
-                    for irp, reads in enumerate(pair_generator(bamfile)):
-                        if irp == maxreads:
-                            break
-
-                        pair_type = filter_read_pair(reads, ref,
-                                                     hist_distance_from_consensus,
-                                                     hist_dist_along,
-                                                     binsize,
-                                                     max_mismatches=max_mismatches,
-                                                     match_len_min=match_len_min,
-                                                     trim_bad_cigars=trim_bad_cigars,
-                                                     VERBOSE=VERBOSE)
-                    
-                        if pair_type == 'unmapped':
-                            n_unmapped += 1
-                            map(trashfile.write, reads)
-
-                        elif pair_type == 'unpaired':
-                            n_unpaired += 1
-                            map(trashfile.write, reads)
-
-                        elif pair_type == 'mutator':
-                            n_mutator += 1
-                            map(trashfile.write, reads)
-
-                        elif pair_type == 'bad_cigar':
-                            n_badcigar += 1
-                            map(trashfile.write, reads)
-
-                        elif pair_type == 'tiny':
-                            n_tiny += 1
-                            map(trashfile.write, reads)
-
-                        else:
-                            n_good += 1
-                            map(outfile.write, reads)
-
-                finally:
-                    file_close(bamfile)
+    binsize = 200
+    hist_distance_from_consensus = np.zeros(n_cycles + 1, int)
+    hist_dist_along = np.zeros((len(ref) // binsize + 1, n_cycles + 1), int)
+    counts = filter_read_pairs_bams(infilenames, outfilename, trashfilename, ref,
+                                    hist_distance_from_consensus,
+                                    hist_dist_along,
+                                    binsize=binsize,
+                                    threads=threads,
+                                    maxreads=maxreads,
+                                    max_mismatches=max_mismatches,
+                                    match_len_min=match_len_min,
+                                    trim_bad_cigars=trim_bad_cigars,
+                                    read_len_min=100,
+                                    isize_min=300,
+                                    VERBOSE=VERBOSE)
+    n_good = counts['good']
+    n_unmapped = counts['unmapped']
+    n_unpaired = counts['unpaired']
+    n_mutator = counts['mutator']
+    n_badcigar = counts['bad_cigar']
+    n_tiny = counts['tiny']
+
+    write_bam_statistics(outfilename, VERBOSE=VERBOSE)
 
     if VERBOSE >= 1:
         print 'Read pairs: '
@@ -251,7 +141,7 @@ def filter_mapped_reads(sample, fragment,
         sfn = get_filter_mapped_init_summary_filename(pname, samplename_pat, fragment, PCR=PCR)
         with open(sfn, 'a') as f:
             f.write('Filter results: pname '+pname+', '+samplename_pat+', '+fragment+'\n')
-            f.write('Total:\t\t\t'+str(irp + 1)+'\n')
+            f.write('Total:\t\t\t'+str(sum(counts.itervalues()))+'\n')
             f.write('Good:\t\t\t'+str(n_good)+'\n')
             f.write('Unmapped:\t\t'+str(n_unmapped)+'\n')
             f.write('Unpaired:\t\t'+str(n_unpaired)+'\n')
@@ -284,6 +174,8 @@ if __name__ == '__main__':
                         help='Do not save results in a summary file')
     parser.add_argument('--PCR', default='1',
                         help='PCR to analyze (1, 2, or all)')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of processes (one per sequenced sample)')
 
     args = parser.parse_args()
     pnames = args.patients
@@ -294,6 +186,7 @@ if __name__ == '__main__':
     n_pairs = args.maxreads
     summary = args.summary
     PCR = args.PCR
+    threads = args.threads
 
     # Collect all sequenced samples from patients
     samples_pat = lssp()
@@ -345,7 +238,8 @@ if __name__ == '__main__':
                           VERBOSE=VERBOSE,
                           n_pairs=n_pairs,
                           PCR=PCR,
-                          summary=summary)
+                          summary=summary,
+                          threads=threads)
                 continue
 
             if summary:
@@ -362,6 +256,7 @@ if __name__ == '__main__':
             filter_mapped_reads(sample_pat, fragment,
                                 PCR=PCR,
                                 VERBOSE=VERBOSE, maxreads=n_pairs,
-                                summary=summary)
+                                summary=summary,
+                                threads=threads)
 
 
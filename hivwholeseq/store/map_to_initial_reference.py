@@ -28,12 +28,15 @@ from hivwholeseq.patients.patients import load_patients, load_patient, Patient
 from hivwholeseq.patients.samples import SamplePat
 from hivwholeseq.utils.generic import mkdirs
 from hivwholeseq.utils.mapping import stampy_bin, subsrate, \
-        convert_sam_to_bam, convert_bam_to_sam, get_number_reads
+        convert_sam_to_bam, convert_bam_to_sam, get_number_reads, \
+        merge_mapped_parts, map_to_bam
+from hivwholeseq.utils.bam_statistics import write_bam_statistics
 from hivwholeseq.patients.filenames import get_initial_index_filename, \
         get_initial_hash_filename, get_initial_reference_filename, \
         get_mapped_to_initial_filename, get_mapped_to_initial_foldername, \
         get_map_initial_summary_filename
 from hivwholeseq.cluster.fork_cluster import fork_map_to_initial_reference as fork_self
+from hivwholeseq.cluster import executor, JOBLOGOUT, JOBLOGERR
 from hivwholeseq.utils.clean_temp_files import remove_mapped_init_tempfiles
 from hivwholeseq.patients.patients import load_samples_sequenced as lssp
 from hivwholeseq.sequencing.samples import load_samples_sequenced as lss
@@ -158,16 +161,16 @@ def map_stampy_singlethread(sample, fragment, VERBOSE=0, n_pairs=-1,
                                                    n_pairs, VERBOSE=VERBOSE)
 
     # Get output filename
-    output_filename = get_mapped_to_initial_filename(pname, samplename_pat, 
-                                                     samplename, fragment,
-                                                     PCR=PCR,
-                                                     type='sam', only_chunk=only_chunk)
+    output_filename_bam = get_mapped_to_initial_filename(pname, samplename_pat,
+                                                         samplename, fragment,
+                                                         type='bam',
+                                                         PCR=PCR,
+                                                         only_chunk=only_chunk)
 
-    # Map
+    # Map, piping the SAM output into a BAM file sorted by read name
     call_list = [stampy_bin,
                  '-g', get_initial_index_filename(pname, fragment, ext=False),
                  '-h', get_initial_hash_filename(pname, fragment, ext=False),
-                 '-o', output_filename,
                  '--overwrite',
                  '--substitutionrate='+subsrate,
                  '--gapopen', stampy_gapopen,
@@ -182,14 +185,8 @@ def map_stampy_singlethread(sample, fragment, VERBOSE=0, n_pairs=-1,
     call_list = map(str, call_list)
     if VERBOSE >=2:
         print ' '.join(call_list)
-    sp.call(call_list)
-
-    output_filename_bam = get_mapped_to_initial_filename(pname, samplename_pat,
-                                                         samplename, fragment,
-                                                         type='bam',
-                                                         PCR=PCR,
-                                                         only_chunk=only_chunk)
-    convert_sam_to_bam(output_filename_bam)
+    map_to_bam(call_list, output_filename_bam, VERBOSE=VERBOSE)
+    write_bam_statistics(output_filename_bam, VERBOSE=VERBOSE)
 
     if summary:
         with open(summary_filename, 'a') as f:
@@ -215,41 +212,41 @@ def map_stampy_singlethread(sample, fragment, VERBOSE=0, n_pairs=-1,
 def map_stampy_multithread(sample, fragment, VERBOSE=0, threads=2, summary=True,
                            filtered=True):
     '''Map using stampy, multithread (via cluster requests, queueing race conditions possible)'''
-    import hivwholeseq
-    JOBDIR = hivwholeseq.__path__[0].rstrip('/')+'/'
-    JOBLOGOUT = JOBDIR+'logout/'
-    JOBLOGERR = JOBDIR+'logerr/'
     cluster_time = ['23:59:59', '0:59:59']
     vmem = '8G'
 
-    pname = patient.id
-    sample = patient.sample_table.loc[samplename]
-    seq_run = sample['run']
-    data_folder = MiSeq_runs[seq_run]['folder']
-    adaID = sample['adaID']
+    pname = sample.patient
+    samplename = sample.name
+    samplename_pat = sample['patient sample']
+    data_folder = sample.sequencing_run['folder']
+    adaID = sample['adapter']
+    PCR = int(sample.PCR)
 
     if VERBOSE:
         print 'Map via stampy: '+pname+' '+samplename+' '+fragment
 
     if summary:
-        summary_filename = get_map_initial_summary_filename(pname, samplename, fragment)
+        summary_filename = get_map_initial_summary_filename(pname, samplename_pat,
+                                                            samplename, fragment,
+                                                            PCR=PCR)
 
     # Specific fragment (e.g. F5 --> F5bi)
-    frag_spec = filter(lambda x: fragment in x, sample['fragments'])
+    frag_spec = filter(lambda x: fragment in x, sample.regions_complete)
     if not len(frag_spec):
-        raise ValueError(str(patient)+', '+samplename+': fragment '+fragment+' not found.')
+        raise ValueError(samplename+': fragment '+fragment+' not found.')
     frag_spec = frag_spec[0]
 
-    input_filename = get_input_filename(data_folder, adaID, frag_spec, type='bam')
+    input_filename = get_input_filename(data_folder, adaID, frag_spec, type='bam',
+                                        filtered=filtered)
 
     # Submit map scripts in parallel to the cluster
-    jobs_done = np.zeros(threads, bool)
-    job_IDs = np.zeros(threads, 'S30')
+    job_IDs = []
     for j in xrange(threads):
     
-        output_filename = get_mapped_to_initial_filename(pname, samplename,
-                                                         fragment,
-                                                         type='sam', part=(j+1))
+        output_filename = get_mapped_to_initial_filename(pname, samplename_pat,
+                                                         samplename, fragment,
+                                                         type='sam', PCR=PCR,
+                                                         part=(j+1))
         # Map
         call_list = ['qsub','-cwd',
                      '-b', 'y',
@@ -275,88 +272,31 @@ def map_stampy_multithread(sample, fragment, VERBOSE=0, threads=2, summary=True,
         call_list = map(str, call_list)
         if VERBOSE >= 2:
             print ' '.join(call_list)
-        job_ID = sp.check_output(call_list)
-        job_ID = job_ID.split()[2]
-        job_IDs[j] = job_ID
-
-    # Monitor output
-    output_file_parts = [get_mapped_to_initial_filename(pname, samplename,
-                                                        fragment,
-                                                        type='bam', part=(j+1))
+        job_IDs.append(executor.get_job_id(executor.submit(call_list, VERBOSE=VERBOSE)))
+
+    # Convert the parts as their jobs finish, and merge them sorted by read
+    # names (to ensure the pair_generator)
+    output_file_parts = [get_mapped_to_initial_filename(pname, samplename_pat,
+                                                        samplename, fragment,
+                                                        type='bam', PCR=PCR,
+                                                        part=(j+1))
                          for j in xrange(threads)]
-    time_wait = 10 # secs
-    while not jobs_done.all():
-
-        # Sleep some time
-        time.sleep(time_wait)
-
-        # Get the output of qstat to check the status of jobs
-        qstat_output = sp.check_output(['qstat'])
-        qstat_output = qstat_output.split('\n')[:-1] # The last is an empty line
-        if len(qstat_output) < 3:
-            jobs_done[:] = True
-            break
-        else:
-            qstat_output = [line.split()[0] for line in qstat_output[2:]]
-
-        time_wait = 10 # secs
-        for j in xrange(threads):
-            if jobs_done[j]:
-                continue
-
-            if job_IDs[j] not in qstat_output:
-                # Convert to BAM for merging
-                if VERBOSE >= 1:
-                    print 'Convert mapped reads to BAM for merging: sample '+\
-                           samplename+', part '+str(j+1)+ ' of '+ \
-                           str(threads)
-                convert_sam_to_bam(output_file_parts[j])
-                # We do not need to wait if we did the conversion (it takes
-                # longer than some secs)
-                time_wait = 0
-                jobs_done[j] = True
-
+    output_filename_sorted = get_mapped_to_initial_filename(pname, samplename_pat,
+                                                            samplename, fragment,
+                                                            type='bam', PCR=PCR)
+    merge_mapped_parts(job_IDs, output_file_parts, output_filename_sorted,
+                       threads=threads, VERBOSE=VERBOSE)
+    write_bam_statistics(output_filename_sorted, VERBOSE=VERBOSE)
     if summary:
         with open(summary_filename, 'a') as f:
             f.write('Stampy mapped ('+str(threads)+' threads).\n')
-
-    # Concatenate output files
-    output_filename = get_mapped_to_initial_filename(pname, samplename,
-                                                     fragment,
-                                                     type='bam', unsorted=True)
-    if VERBOSE >= 1:
-        print 'Concatenate premapped reads: sample '+samplename
-    pysam.cat('-o', output_filename, *output_file_parts)
-    if summary:
-        with open(summary_filename, 'a') as f:
-            f.write('BAM files concatenated (unsorted).\n')
-
-    # Sort the file by read names (to ensure the pair_generator)
-    output_filename_sorted = get_mapped_to_initial_filename(pname, samplename,
-                                                            fragment,
-                                                            type='bam')
-    # NOTE: we exclude the extension and the option -f because of a bug in samtools
-    if VERBOSE >= 1:
-        print 'Sort mapped reads: sample '+samplename
-    pysam.sort('-n', output_filename, output_filename_sorted[:-4])
-    if summary:
-        with open(summary_filename, 'a') as f:
-            f.write('Joint BAM file sorted.\n')
-
-    # Reheader the file without BAM -> SAM -> BAM
-    if VERBOSE >= 1:
-        print 'Reheader mapped reads: sample '+samplename
-    header_filename = get_mapped_to_initial_filename(pname, samplename,
-                                                     fragment,
-                                                     type='sam', part=1)
-    pysam.reheader(header_filename, output_filename_sorted)
-    if summary:
-        with open(summary_filename, 'a') as f:
-            f.write('Joint BAM file reheaded.\n')
+            f.write('BAM files merged (sorted by name).\n')
 
     if VERBOSE >= 1:
         print 'Remove temporary files: sample '+samplename
-    remove_mapped_init_tempfiles(pname, samplename, fragment, VERBOSE=VERBOSE)
+    remove_mapped_init_tempfiles(pname, samplename_pat,
+                                 samplename, fragment,
+                                 PCR=PCR, VERBOSE=VERBOSE)
     if summary:
         with open(summary_filename, 'a') as f:
             f.write('Temp mapping files removed.\n')
@@ -430,6 +370,8 @@ if __name__ == '__main__':
                         help='Number of threads to use for mapping')
     parser.add_argument('--skiphash', action='store_true',
                         help=argparse.SUPPRESS)
+    parser.add_argument('--only-hash', action='store_true', dest='only_hash',
+                        help='Only build the index and hash of the references')
     parser.add_argument('--no-summary', action='store_false', dest='summary',
                         help='Do not save results in a summary file')
     parser.add_argument('--chunks', type=int, nargs='+', default=[None],
@@ -448,6 +390,7 @@ if __name__ == '__main__':
     threads = args.threads
     n_pairs = args.maxreads
     skip_hash = args.skiphash
+    only_hash = args.only_hash
     summary = args.summary
     only_chunks = args.chunks
     filtered = args.filtered
@@ -483,6 +426,18 @@ if __name__ == '__main__':
     if VERBOSE >= 3:
         print 'fragments', fragments
 
+    # Index and hash are per patient, build them once
+    if only_hash:
+        pnames_hash = sorted(set(samples_pat.loc[samples_seq['patient sample'].unique(),
+                                                 'patient']))
+        for pname in pnames_hash:
+            for fragment in fragments:
+                if VERBOSE:
+                    print 'Index and hash:', pname, fragment
+                mkdirs(os.path.dirname(get_initial_hash_filename(pname, fragment)))
+                make_index_and_hash(pname, fragment, VERBOSE=VERBOSE)
+        sys.exit()
+
     for samplename, sample in samples_seq.iterrows():
         sample = SampleSeq(sample)
 
@@ -0,0 +1,661 @@
+#!/usr/bin/env python
+# vim: fdm=marker
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Make-style pipeline. Each stage is declared as targets with their
+            input and output files and command line (i.e. parameters); the
+            stale targets are found from modification times and records of
+            past builds, and rebuilt in topological order through the cluster
+            (or local) executor.
+
+            A target is stale if an output is missing, if its parameters or
+            inputs changed since its last build (or, for targets built before
+            records were kept, if an input is newer than an output), or if a
+            target upstream is stale. E.g. after correcting the initial
+            reference of a patient, all targets downstream of it are stale.
+'''
+# Modules
+import os
+import sys
+import json
+import heapq
+import hashlib
+import argparse
+
+from hivwholeseq.cluster import JOBDIR, JOBLOGOUT, JOBLOGERR
+from hivwholeseq.utils.exceptions import PipelineError
+
+
+
+# Globals
+# Stages in topological order
+stages = ['premap', 'trim_and_divide', 'consensus', 'map', 'filter',
+          'hash_initial', 'map_initial', 'filter_initial', 'decontaminate',
+          'allele_counts', 'allele_cocounts', 'insertions',
+          'allele_counts_genomewide', 'insertions_genomewide',
+          'trajectories']
+
+fragments_all = ['F'+str(i) for i in xrange(1, 7)]
+qual_min = 30
+
+
+
+# Classes
+class Target(object):
+    '''A step of the pipeline for one unit of data (e.g. a sample and fragment)'''
+
+    def __init__(self, stage, key, outputs, inputs, script, args,
+                 cluster_time='23:59:59', vmem='2G'):
+        '''Declare a target
+
+        Parameters:
+           stage (str): the pipeline stage
+           key (tuple): the unit of data, e.g. (samplename, fragment)
+           outputs (list): files written by the target
+           inputs (list): files read by the target
+           script (str): script to run, relative to the package folder
+           args (list): command line arguments, which are the parameters of
+           the target (--verbose is added for Python scripts)
+        '''
+        self.stage = stage
+        self.key = tuple(key)
+        self.outputs = list(outputs)
+        self.inputs = list(inputs)
+        self.script = script
+        self.args = map(str, args)
+        self.cluster_time = cluster_time
+        self.vmem = vmem
+
+
+    def __repr__(self):
+        return 'Target('+self.name+')'
+
+
+    @property
+    def name(self):
+        '''Name of the target, e.g. "map_initial 12345 F1"'''
+        return ' '.join((self.stage,) + self.key)
+
+
+    def get_params_hash(self):
+        '''Hash of the script and its arguments'''
+        return hashlib.md5(json.dumps([self.script, self.args])).hexdigest()
+
+
+    def get_call_list(self, VERBOSE=0):
+        '''Get the qsub command line of the target'''
+        script = self.script
+        if not os.path.isabs(script):
+            script = JOBDIR+script
+
+        call_list = ['qsub','-cwd',
+                     '-b', 'y',
+                     '-S', '/bin/bash',
+                     '-o', JOBLOGOUT,
+                     '-e', JOBLOGERR,
+                     '-N', self.name,
+                     '-l', 'h_rt='+self.cluster_time,
+                     '-l', 'h_vmem='+self.vmem,
+                     script,
+                    ] + self.args
+        if script.endswith('.py'):
+            call_list.extend(['--verbose', VERBOSE])
+        return map(str, call_list)
+
+
+
+# Functions
+def get_file_signature(filename):
+    '''Size and modification time of a file, to tell whether it changed'''
+    st = os.stat(filename)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def get_record_filename(target):
+    '''Get the filename of the record of the last build of a target'''
+    return target.outputs[0]+'.pipeline.json'
+
+
+def read_record(target):
+    '''Read the record of the last build of a target (None if missing)'''
+    fn = get_record_filename(target)
+    if not os.path.isfile(fn):
+        return None
+
+    try:
+        with open(fn, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def write_record(target):
+    '''Write the record of a build: parameters and input signatures'''
+    record = {'params': target.get_params_hash(),
+              'inputs': {fn: get_file_signature(fn) for fn in target.inputs
+                         if os.path.isfile(fn)},
+             }
+    fn = get_record_filename(target)
+    with open(fn+'.tmp', 'w') as f:
+        json.dump(record, f)
+    os.rename(fn+'.tmp', fn)
+
+
+def get_stale_reason(target):
+    '''Tell why a target is out of date, regardless of targets upstream
+
+    Returns:
+       reason (str or None): None if the target is up to date
+    '''
+    for fn in target.outputs:
+        if not os.path.isfile(fn):
+            return 'missing output '+fn
+
+    inputs = [fn for fn in target.inputs if os.path.isfile(fn)]
+
+    record = read_record(target)
+    if record is not None:
+        if record['params'] != target.get_params_hash():
+            return 'parameters changed'
+        if set(record['inputs']) != set(inputs):
+            return 'inputs changed'
+        for fn in inputs:
+            if record['inputs'][fn] != get_file_signature(fn):
+                return 'input changed '+fn
+        return None
+
+    # Targets built without records: compare modification times, like make
+    mtime_out = min(os.path.getmtime(fn) for fn in target.outputs)
+    for fn in inputs:
+        if os.path.getmtime(fn) > mtime_out:
+            return 'input newer '+fn
+    return None
+
+
+def get_dependencies(targets):
+    '''Get the targets that produce the inputs of each target
+
+    Returns:
+       deps (dict): target -> list of targets upstream
+    '''
+    producers = {}
+    for target in targets:
+        for fn in target.outputs:
+            if fn in producers:
+                raise PipelineError('File produced by two targets: '+fn+' ('+\
+                                    producers[fn].name+', '+target.name+')')
+            producers[fn] = target
+
+    deps = {}
+    for target in targets:
+        deps[target] = [producers[fn] for fn in target.inputs
+                        if (fn in producers) and (producers[fn] is not target)]
+    return deps
+
+
+def sort_targets(targets):
+    '''Sort targets topologically (ties by stage and key)'''
+    deps = get_dependencies(targets)
+    n_deps = {target: len(set(deps[target])) for target in targets}
+    children = {target: [] for target in targets}
+    for target in targets:
+        for dep in set(deps[target]):
+            children[dep].append(target)
+
+    def get_priority(target):
+        if target.stage in stages:
+            return (stages.index(target.stage), target.key)
+        return (len(stages), target.key)
+
+    ready = [(get_priority(t), i, t) for i, t in enumerate(targets) if not n_deps[t]]
+    heapq.heapify(ready)
+    ind = {t: i for i, t in enumerate(targets)}
+    targets_sorted = []
+    while ready:
+        target = heapq.heappop(ready)[2]
+        targets_sorted.append(target)
+        for child in children[target]:
+            n_deps[child] -= 1
+            if not n_deps[child]:
+                heapq.heappush(ready, (get_priority(child), ind[child], child))
+
+    if len(targets_sorted) != len(targets):
+        raise PipelineError('The pipeline has a cycle')
+
+    return targets_sorted
+
+
+def get_stale_targets(targets):
+    '''Find the minimal set of targets to rebuild
+
+    Returns:
+       stale (list): (target, reason) in topological order
+    '''
+    deps = get_dependencies(targets)
+    reasons = {}
+    stale = []
+    for target in sort_targets(targets):
+        reason = get_stale_reason(target)
+        if reason is None:
+            for dep in deps[target]:
+                if dep in reasons:
+                    reason = 'upstream '+dep.name
+                    break
+
+        if reason is not None:
+            reasons[target] = reason
+            stale.append((target, reason))
+
+    return stale
+
+
+def prune_inputs(targets):
+    '''Drop inputs that neither exist nor are produced by any target
+
+    Inputs are declared generously (e.g. all fragments of a genomewide merge),
+    the scripts themselves skip missing files.
+    '''
+    outputs = set(fn for target in targets for fn in target.outputs)
+    for target in targets:
+        target.inputs = [fn for fn in target.inputs
+                         if (fn in outputs) or os.path.isfile(fn)]
+    return targets
+
+
+def run_targets(targets, interval=None, VERBOSE=0):
+    '''Build targets in topological order through the executor
+
+    Parameters:
+       targets (list): targets to build, e.g. the stale ones
+       interval (float): seconds between checks of the job statuses
+
+    Returns:
+       statuses (dict): target -> 'done', 'failed', 'killed', 'missing input',
+       or 'skipped' (a target upstream was not built)
+
+    Each target is submitted as soon as the targets it depends on are built,
+    and its record is written when its job is done.
+    '''
+    from hivwholeseq.utils.generic import mkdirs
+    from hivwholeseq.cluster.executor import submit, get_job_id, iter_finished
+
+    deps = get_dependencies(targets)
+    pending = sort_targets(targets)
+    running = {}
+    statuses = {}
+    while pending or running:
+
+        # Submit the targets whose dependencies are built, skip the doomed ones
+        pending_new = []
+        for target in pending:
+            statuses_deps = [statuses.get(dep) for dep in deps[target]]
+            if any((s is not None) and (s != 'done') for s in statuses_deps):
+                statuses[target] = 'skipped'
+                continue
+
+            if None in statuses_deps:
+                pending_new.append(target)
+                continue
+
+            missing = [fn for fn in target.inputs if not os.path.isfile(fn)]
+            if missing:
+                if VERBOSE >= 1:
+                    print 'Missing input:', target.name, missing[0]
+                statuses[target] = 'missing input'
+                continue
+
+            for fn in target.outputs:
+                mkdirs(os.path.dirname(fn))
+
+            if VERBOSE >= 1:
+                print 'Submit:', target.name
+            jobid = get_job_id(submit(target.get_call_list(VERBOSE=VERBOSE),
+                                      VERBOSE=VERBOSE))
+            running[jobid] = target
+        pending = pending_new
+
+        if not running:
+            continue
+
+        (jobid, status) = next(iter_finished(running.keys(), interval=interval,
+                                             VERBOSE=VERBOSE))
+        target = running.pop(jobid)
+        if (status == 'done') and all(map(os.path.isfile, target.outputs)):
+            write_record(target)
+        elif status == 'done':
+            status = 'failed'
+        statuses[target] = status
+
+        if VERBOSE >= 1:
+            print 'Finished:', target.name, status
+
+    return statuses
+
+
+def get_targets_sample_seq(sample):
+    '''Get the targets of a sequenced sample (premap to filter)'''
+    seq_run = sample['seq run']
+    adaID = sample['adapter']
+    samplename = sample.name
+    fragments = sample.regions_generic
+
+    # Suspected contaminations are skipped by the filter and mapping scripts
+    contstr = sample['suspected contamination']
+    if isinstance(contstr, basestring):
+        fragments_good = [fr for fr in fragments if fr not in contstr]
+    else:
+        fragments_good = fragments
+
+    args_sample = ['--run', seq_run, '--adaIDs', adaID]
+    targets = []
+    targets.append(Target('premap', [samplename],
+                          [sample.get_premapped_filename()],
+                          sample.get_read_filenames(gzip=True) + \
+                          sample.get_read_filenames(gzip=False),
+                          'sequencing/premap_to_reference.py',
+                          args_sample,
+                          cluster_time='71:59:59', vmem='8G'))
+
+    targets.append(Target('trim_and_divide', [samplename],
+                          [sample.get_divided_filename(fr)
+                           for fr in sample.regions_complete],
+                          [sample.get_premapped_filename()],
+                          'sequencing/trim_and_divide.py',
+                          args_sample,
+                          cluster_time='2:59:59', vmem='1G'))
+
+    for fragment in fragments:
+        key = [samplename, fragment]
+        fn_divided = sample.get_divided_filename(sample.convert_region(fragment))
+        targets.append(Target('consensus', key,
+                              [sample.get_consensus_filename(fragment)],
+                              [fn_divided],
+                              'sequencing/build_consensus.py',
+                              args_sample + ['--fragments', fragment],
+                              cluster_time='0:59:59', vmem='2G'))
+
+        targets.append(Target('map', key,
+                              [sample.get_mapped_filename(fragment, filtered=False)],
+                              [fn_divided, sample.get_consensus_filename(fragment)],
+                              'sequencing/map_to_consensus.py',
+                              args_sample + ['--fragments', fragment],
+                              cluster_time='23:59:59', vmem='8G'))
+
+    for fragment in fragments_good:
+        key = [samplename, fragment]
+        targets.append(Target('filter', key,
+                              [sample.get_mapped_filename(fragment, filtered=True)],
+                              [sample.get_mapped_filename(fragment, filtered=False)],
+                              'sequencing/filter_mapped_reads.py',
+                              args_sample + ['--fragments', fragment],
+                              cluster_time='71:59:59', vmem='2G'))
+
+    # Mapping to the patient initial reference
+    if str(sample['patient sample']) == 'nan':
+        return targets
+
+    from hivwholeseq.patients.filenames import get_initial_reference_filename, \
+            get_initial_index_filename, get_initial_hash_filename
+    pname = sample.patientname
+    for fragment in fragments_good:
+        key = [samplename, fragment]
+        targets.append(Target('map_initial', key,
+                              [sample.get_mapped_to_initial_filename(fragment)],
+                              [sample.get_mapped_filename(fragment, filtered=True),
+                               get_initial_reference_filename(pname, fragment),
+                               get_initial_index_filename(pname, fragment),
+                               get_initial_hash_filename(pname, fragment)],
+                              'store/map_to_initial_reference.py',
+                              ['--samples', samplename,
+                               '--fragments', fragment,
+                               '--skiphash'],
+                              cluster_time='23:59:59', vmem='8G'))
+
+    return targets
+
+
+def get_targets_sample_pat(sample, samples_seq):
+    '''Get the targets of a patient sample (filter to genomewide merges)
+
+    Parameters:
+       sample (SamplePat): the patient sample
+       samples_seq (DataFrame): its sequenced samples
+    '''
+    from hivwholeseq.sequencing.samples import SampleSeq
+    from hivwholeseq.patients.filenames import get_initial_reference_filename
+
+    pname = sample.patient
+    samplename = sample.name
+
+    # Mapped reads of the sequenced samples by PCR type and fragment
+    fns_mapped = {}
+    for samplename_seq, sample_seq in samples_seq.iterrows():
+        sample_seq = SampleSeq(sample_seq)
+        if str(sample_seq.PCR) == 'nan':
+            continue
+        PCR = int(sample_seq.PCR)
+        for fragment in sample_seq.regions_generic:
+            fn = sample_seq.get_mapped_to_initial_filename(fragment)
+            fns_mapped.setdefault((PCR, fragment), []).append(fn)
+
+    targets = []
+    for (PCR, fragment) in sorted(fns_mapped):
+        key = [samplename, fragment, 'PCR'+str(PCR)]
+        args_sample = ['--samples', samplename, '--fragments', fragment, '--PCR', PCR]
+        fn_ref = get_initial_reference_filename(pname, fragment)
+        fn_filtered = sample.get_mapped_filtered_filename(fragment, PCR=PCR,
+                                                          decontaminated=False)
+        fn_decont = sample.get_mapped_filtered_filename(fragment, PCR=PCR,
+                                                        decontaminated=True)
+
+        targets.append(Target('filter_initial', key,
+                              [fn_filtered],
+                              fns_mapped[(PCR, fragment)] + [fn_ref],
+                              'store/filter_mapped_reads.py',
+                              args_sample,
+                              cluster_time='23:59:59', vmem='8G'))
+
+        targets.append(Target('decontaminate', key,
+                              [fn_decont],
+                              [fn_filtered],
+                              'store/decontaminate_reads.py',
+                              args_sample,
+                              cluster_time='71:59:59', vmem='2G'))
+
+        args_counts = args_sample + ['--qualmin', qual_min, '--save']
+        targets.append(Target('allele_counts', key,
+                              [sample.get_allele_counts_filename(fragment, PCR=PCR,
+                                                                 qual_min=qual_min)],
+                              [fn_decont, fn_ref],
+                              'store/store_allele_counts.py',
+                              args_counts,
+                              cluster_time='0:59:59', vmem='2G'))
+
+        targets.append(Target('allele_cocounts', key,
+                              [sample.get_allele_cocounts_filename(fragment, PCR=PCR,
+                                                                   qual_min=qual_min)],
+                              [fn_decont, fn_ref],
+                              'store/store_allele_cocounts.py',
+                              args_counts,
+                              cluster_time='23:59:59', vmem='8G'))
+
+        targets.append(Target('insertions', key,
+                              [sample.get_insertions_filename(fragment, PCR=PCR,
+                                                              qual_min=qual_min)],
+                              [fn_decont, fn_ref],
+                              'store/store_insertions.py',
+                              args_counts,
+                              cluster_time='0:59:59', vmem='2G'))
+
+    # The genomewide merges are only for PCR1
+    PCR = 1
+    if not any(PCR_fr == PCR for (PCR_fr, fragment) in fns_mapped):
+        return targets
+
+    key = [samplename, 'genomewide', 'PCR'+str(PCR)]
+    args_sample = ['--samples', samplename, '--PCR', PCR, '--save']
+    fn_ref = get_initial_reference_filename(pname, 'genomewide')
+    targets.append(Target('allele_counts_genomewide', key,
+                          [sample.get_allele_counts_filename('genomewide', PCR=PCR)],
+                          [sample.get_allele_counts_filename(fr, PCR=PCR)
+                           for fr in fragments_all] + [fn_ref],
+                          'store/store_allele_counts_genomewide.py',
+                          args_sample,
+                          cluster_time='0:59:59', vmem='2G'))
+
+    targets.append(Target('insertions_genomewide', key,
+                          [sample.get_insertions_filename('genomewide', PCR=PCR)],
+                          [sample.get_insertions_filename(fr, PCR=PCR)
+                           for fr in fragments_all] + [fn_ref],
+                          'store/store_insertions_genomewide.py',
+                          args_sample,
+                          cluster_time='0:59:59', vmem='2G'))
+
+    return targets
+
+
+def get_targets_patient(pname, samples_pat):
+    '''Get the targets of a patient (reference hashes, trajectories)
+
+    Parameters:
+       samples_pat (DataFrame): the patient samples in the pipeline
+    '''
+    from hivwholeseq.patients.filenames import get_initial_reference_filename, \
+            get_initial_index_filename, get_initial_hash_filename, \
+            get_allele_count_trajectories_store_filename, \
+            get_allele_counts_filename
+
+    targets = []
+    for fragment in fragments_all:
+        key = [pname, fragment]
+        targets.append(Target('hash_initial', key,
+                              [get_initial_index_filename(pname, fragment),
+                               get_initial_hash_filename(pname, fragment)],
+                              [get_initial_reference_filename(pname, fragment)],
+                              'store/map_to_initial_reference.py',
+                              ['--patients', pname,
+                               '--fragments', fragment,
+                               '--only-hash'],
+                              cluster_time='0:59:59', vmem='2G'))
+
+        targets.append(Target('trajectories', key,
+                              [get_allele_count_trajectories_store_filename(pname, fragment,
+                                                                            qual_min=qual_min),
+                               get_allele_count_trajectories_store_filename(pname, fragment,
+                                                                            qual_min=qual_min,
+                                                                            index=True)],
+                              [get_allele_counts_filename(pname, samplename, fragment,
+                                                          qual_min=qual_min)
+                               for samplename in samples_pat.index],
+                              'store/store_allele_count_trajectories.py',
+                              ['--patients', pname,
+                               '--fragments', fragment,
+                               '--qualmin', qual_min],
+                              cluster_time='0:59:59', vmem='2G'))
+
+    return targets
+
+
+def build_pipeline(samples_pat, samples_seq, stages_selected=None, VERBOSE=0):
+    '''Build the targets of the pipeline for some samples
+
+    Parameters:
+       samples_pat (DataFrame): patient samples
+       samples_seq (DataFrame): sequenced samples (incl. the ones of samples_pat)
+       stages_selected (list): keep only the targets of these stages (the
+       others are still used to tell staleness)
+
+    Returns:
+       targets (list): all targets, with inputs pruned
+       targets_selected (list): the targets of the selected stages
+    '''
+    from hivwholeseq.sequencing.samples import SampleSeq
+    from hivwholeseq.patients.samples import SamplePat
+
+    targets = []
+    for samplename, sample in samples_seq.iterrows():
+        targets.extend(get_targets_sample_seq(SampleSeq(sample)))
+
+    for samplename, sample in samples_pat.iterrows():
+        sample = SamplePat(sample)
+        samples_seq_pat = samples_seq.loc[samples_seq['patient sample'] == samplename]
+        targets.extend(get_targets_sample_pat(sample, samples_seq_pat))
+
+    for pname, samples_pname in samples_pat.groupby('patient'):
+        targets.extend(get_targets_patient(pname, samples_pname))
+
+    prune_inputs(targets)
+
+    if stages_selected is None:
+        targets_selected = targets
+    else:
+        targets_selected = [t for t in targets if t.stage in stages_selected]
+
+    if VERBOSE >= 2:
+        print 'Targets:', len(targets), 'selected:', len(targets_selected)
+
+    return (targets, targets_selected)
+
+
+
+# Script
+if __name__ == '__main__':
+
+    from hivwholeseq.utils.argparse import PatientsAction
+
+    # Parse input args
+    parser = argparse.ArgumentParser(description='Find and rebuild stale parts of the pipeline',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    pats_or_samples = parser.add_mutually_exclusive_group(required=True)
+    pats_or_samples.add_argument('--patients', action=PatientsAction,
+                                 help='Patients to analyze')
+    pats_or_samples.add_argument('--samples', nargs='+',
+                                 help='Patient samples to analyze')
+    parser.add_argument('--stages', nargs='+', choices=stages,
+                        help='Rebuild only these stages (default: all)')
+    parser.add_argument('--run', action='store_true',
+                        help='Rebuild the stale targets (default: only list them)')
+    parser.add_argument('--verbose', type=int, default=0,
+                        help='Verbosity level [0-3]')
+
+    args = parser.parse_args()
+    pnames = args.patients
+    samplenames = args.samples
+    stages_selected = args.stages
+    use_run = args.run
+    VERBOSE = args.verbose
+
+    from hivwholeseq.patients.patients import load_samples_sequenced as lssp
+    from hivwholeseq.sequencing.samples import load_samples_sequenced as lss
+
+    samples_pat = lssp()
+    if pnames is not None:
+        samples_pat = samples_pat.loc[samples_pat.patient.isin(pnames)]
+    else:
+        samples_pat = samples_pat.loc[samples_pat.index.isin(samplenames)]
+
+    samples_seq = lss()
+    samples_seq = samples_seq.loc[samples_seq['patient sample'].isin(samples_pat.index)]
+
+    (targets, targets_selected) = build_pipeline(samples_pat, samples_seq,
+                                                 stages_selected=stages_selected,
+                                                 VERBOSE=VERBOSE)
+
+    targets_selected = set(targets_selected)
+    stale = [(t, r) for (t, r) in get_stale_targets(targets) if t in targets_selected]
+
+    for (target, reason) in stale:
+        print '{:<40s}'.format(target.name), reason
+    if VERBOSE >= 1:
+        print 'Stale targets:', len(stale), 'of', len(targets_selected)
+
+    if not use_run:
+        sys.exit()
+
+    statuses = run_targets([t for (t, r) in stale], VERBOSE=VERBOSE)
+    n_done = sum(s == 'done' for s in statuses.itervalues())
+    print 'Targets built:', n_done, 'of', len(stale)
+    for (target, reason) in stale:
+        if statuses[target] != 'done':
+            print '{:<40s}'.format(target.name), statuses[target]
@@ -17,6 +17,7 @@ from hivwholeseq.patients.samples import load_samples_sequenced as lssp
 from hivwholeseq.patients.samples import SamplePat
 from hivwholeseq.patients.filenames import get_initial_reference_filename
 from hivwholeseq.utils.two_site_statistics import get_coallele_counts_from_file as gac
+from hivwholeseq.utils.two_site_statistics import save_coallele_counts_sparse
 from hivwholeseq.cluster.fork_cluster import fork_get_cocounts_patient as fork_self
 
 
@@ -48,6 +49,8 @@ if __name__ == '__main__':
                         help='Minimal quality of base to call')
     parser.add_argument('--PCR', type=int, default=1,
                         help='Analyze only reads from this PCR (1 or 2)')
+    parser.add_argument('--sparse', action='store_true',
+                        help='Compute and store the compact cocounts only')
 
     args = parser.parse_args()
     pnames = args.patients
@@ -60,6 +63,7 @@ if __name__ == '__main__':
     save_to_file = args.save
     qual_min = args.qualmin
     PCR = args.PCR
+    sparse = args.sparse
 
     samples = lssp()
     if pnames is not None:
@@ -80,7 +84,8 @@ if __name__ == '__main__':
             for samplename, sample in samples.iterrows():
                 fork_self(samplename, fragment, VERBOSE=VERBOSE,
                           qual_min=qual_min, PCR=PCR,
-                          maxreads=maxreads, use_tests=use_tests)
+                          maxreads=maxreads, use_tests=use_tests,
+                          sparse=sparse)
         sys.exit()
 
     counts_all = []
@@ -97,7 +102,8 @@ if __name__ == '__main__':
 
             fn_out = sample.get_allele_cocounts_filename(fragment, PCR=PCR,
                                                          qual_min=qual_min,
-                                                         compressed=True)
+                                                         compressed=True,
+                                                         sparse=sparse)
             fn = sample.get_mapped_filtered_filename(fragment, PCR=PCR,
                                                      decontaminated=True) #FIXME
             if save_to_file:
@@ -105,9 +111,13 @@ if __name__ == '__main__':
                               maxreads=maxreads,
                               VERBOSE=VERBOSE,
                               qual_min=qual_min,
-                              use_tests=use_tests)
+                              use_tests=use_tests,
+                              sparse=sparse)
 
-                np.savez_compressed(fn_out, cocounts=cocount)
+                if sparse:
+                    save_coallele_counts_sparse(fn_out, cocount)
+                else:
+                    np.savez_compressed(fn_out, cocounts=cocount)
 
                 if VERBOSE >= 2:
                     print 'Allele cocounts saved:', samplename, fragment
@@ -115,7 +125,9 @@ if __name__ == '__main__':
                 counts.append(cocount)
 
             elif os.path.isfile(fn_out):
-                cocount = np.load(fn_out)['cocounts']
+                cocount = sample.get_allele_cocounts(fragment, PCR=PCR,
+                                                     qual_min=qual_min,
+                                                     sparse=sparse)
                 counts.append(cocount)
 
             elif os.path.isfile(fn):
@@ -123,5 +135,6 @@ if __name__ == '__main__':
                               maxreads=maxreads,
                               VERBOSE=VERBOSE,
                               qual_min=qual_min,
-                              use_tests=use_tests)
+                              use_tests=use_tests,
+                              sparse=sparse)
                 counts.append(cocount)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# vim: fdm=marker
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Build the memory-mapped store of allele count trajectories of a
+            patient from the allele counts of its samples.
+'''
+# Modules
+import os
+import argparse
+
+from hivwholeseq.utils.argparse import PatientsAction
+from hivwholeseq.patients.patients import load_patients, Patient
+from hivwholeseq.patients.filenames import \
+        get_allele_count_trajectories_store_filename as get_store_filename
+from hivwholeseq.patients.allele_count_store import build_allele_count_store
+
+
+
+# Script
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Store allele count trajectories',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--patients', action=PatientsAction,
+                        help='Patients to analyze')
+    parser.add_argument('--fragments', nargs='+',
+                        help='Fragments to analyze (e.g. F1 F6)')
+    parser.add_argument('--verbose', type=int, default=0,
+                        help='Verbosity level [0-4]')
+    parser.add_argument('--qualmin', type=int, default=30,
+                        help='Minimal quality of base to call')
+
+    args = parser.parse_args()
+    pnames = args.patients
+    fragments = args.fragments
+    VERBOSE = args.verbose
+    qual_min = args.qualmin
+
+    patients = load_patients()
+    if pnames is not None:
+        patients = patients.loc[pnames]
+
+    if not fragments:
+        fragments = ['F'+str(i) for i in xrange(1, 7)]
+    if VERBOSE >= 3:
+        print 'fragments', fragments
+
+    for pname, patient in patients.iterrows():
+        patient = Patient(patient)
+
+        for fragment in fragments:
+            if VERBOSE >= 1:
+                print pname, fragment
+
+            # Rebuild from scratch, the sample files are the primary data
+            for index in (False, True):
+                fn = get_store_filename(pname, fragment, qual_min=qual_min,
+                                        index=index)
+                if os.path.isfile(fn):
+                    os.remove(fn)
+
+            build_allele_count_store(pname, patient.samples.index, fragment,
+                                     qual_min=qual_min, VERBOSE=VERBOSE)
@@ -20,6 +20,7 @@ from hivwholeseq.patients.samples import SamplePat
 from hivwholeseq.patients.filenames import get_initial_reference_filename, \
         get_mapped_filtered_filename, get_allele_counts_filename
 from hivwholeseq.utils.one_site_statistics import get_allele_counts_insertions_from_file as gac
+from hivwholeseq.patients.allele_count_store import add_allele_counts_to_store
 from hivwholeseq.cluster.fork_cluster import fork_get_allele_counts_patient as fork_self 
 
 
@@ -100,3 +101,7 @@ if __name__ == '__main__':
 
                 if VERBOSE >= 2:
                     print 'Allele counts saved:', samplename, fragment
+
+                add_allele_counts_to_store(pname, samplename, fragment, count,
+                                           PCR=PCR, qual_min=qual_min,
+                                           VERBOSE=VERBOSE)
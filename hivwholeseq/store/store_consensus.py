@@ -21,13 +21,48 @@ from hivwholeseq.cluster.fork_cluster import fork_build_consensus_patient as for
 
 
 # Function
+def get_trim_coordinates(read, edges):
+    '''Find the coordinates in the read of a region it fully covers'''
+    pos_ref = edges[0]
+    block_len = edges[1] - edges[0]
+
+    pos_reft = read.pos
+    start_found = False
+    pos_read_start = 0
+    pos_read_end = 0
+    for (bt, bl) in read.cigar:
+        if bt == 1:
+            if not start_found:
+                pos_read_start += bl
+            pos_read_end += bl
+        elif bt == 2:
+            if (not start_found) and (pos_reft + bl > pos_ref):
+                start_found = True
+            if pos_reft + bl > pos_ref + block_len:
+                break
+            pos_reft += bl
+        else:
+            if (not start_found) and (pos_reft + bl > pos_ref):
+                pos_read_start += pos_ref - pos_reft
+                start_found = True
+            if pos_reft + bl > pos_ref + block_len:
+                pos_read_end += pos_ref + block_len - pos_reft
+                break
+
+            if not start_found:
+                pos_read_start += bl
+            pos_read_end += bl
+            pos_reft += bl
+
+    return (pos_read_start, pos_read_end)
+
+
 def pileup_trim_reads_coverfull(bamfile, edges, VERBOSE=0):
     '''Collect reads that fully cover a region, and trim them to the same
     
     Note: this function does not look at the full read pair!
     '''
     pos_ref = edges[0]
-    block_len = edges[1] - edges[0]
 
     seqs = []
     for read in bamfile:
@@ -39,35 +74,7 @@ def pileup_trim_reads_coverfull(bamfile, edges, VERBOSE=0):
         if end_read < edges[1]:
             continue
 
-        # Find start of the block in the read
-        pos_reft = read.pos
-        start_found = False
-        pos_read_start = 0
-        pos_read_end = 0
-        for (bt, bl) in read.cigar:
-            if bt == 1:
-                if not start_found:
-                    pos_read_start += bl
-                pos_read_end += bl
-            elif bt == 2:
-                if (not start_found) and (pos_reft + bl > pos_ref):
-                    start_found = True
-                if pos_reft + bl > pos_ref + block_len:
-                    break
-                pos_reft += bl
-            else:
-                if (not start_found) and (pos_reft + bl > pos_ref):
-                    pos_read_start += pos_ref - pos_reft
-                    start_found = True
-                if pos_reft + bl > pos_ref + block_len:
-                    pos_read_end += pos_ref + block_len - pos_reft
-                    break
-
-                if not start_found:
-                    pos_read_start += bl
-                pos_read_end += bl
-                pos_reft += bl
-        
+        (pos_read_start, pos_read_end) = get_trim_coordinates(read, edges)
         seq = read.seq[pos_read_start: pos_read_end]
         seqs.append(seq)
 
@@ -76,6 +83,85 @@ def pileup_trim_reads_coverfull(bamfile, edges, VERBOSE=0):
     return seqs
 
 
+def get_first_block_reads(bamfile, block_len=100, VERBOSE=0):
+    '''Find the first block covered, even if partially, in a single pass
+
+    The first block starts at the first multiple of block_len // 2 at or after
+    the leftmost read, and all reads starting at or before it are collected.
+
+    Returns:
+       (start_block, seqs): start of the block and list of (read start, sequence)
+    '''
+    half = block_len // 2
+    start_block = None
+    seqs = []
+    for read in bamfile:
+        # A read further left moves the first block, forget the reads after it
+        if (start_block is None) or (read.pos < start_block - half + 1):
+            start_block = half * (-(-read.pos // half))
+            seqs = [(pos, seq) for (pos, seq) in seqs if pos <= start_block]
+
+        if read.pos <= start_block:
+            seqs.append((read.pos, ('N' * read.pos) + read.seq[:block_len - read.pos]))
+
+    bamfile.reset()
+
+    if start_block is None:
+        raise ValueError('No reads found')
+
+    return (start_block, seqs)
+
+
+def collect_block_reads(bamfile, len_reference, start_block, block_len=100,
+                        reads_per_alignment=31, VERBOSE=0):
+    '''Collect reads that fully cover each block, in a single pass
+
+    Blocks start at start_block and every 2 * block_len // 3 bases after it.
+    Each block keeps a uniform random sample (reservoir) of at most
+    reads_per_alignment reads, trimmed to the block; reads are trimmed only
+    when they enter the sample.
+
+    Returns:
+       seqs_blocks (list): for each block, the trimmed read sequences
+    '''
+    step = 2 * block_len // 3
+    starts = range(start_block, len_reference, step)
+    edges_blocks = [(start, min(len_reference, start + block_len)) for start in starts]
+    n_blocks = len(edges_blocks)
+    seqs_blocks = [[] for edges in edges_blocks]
+    n_seen = [0 for edges in edges_blocks]
+
+    for read in bamfile:
+        start_read = read.pos
+        end_read = start_read + sum(bl for bt, bl in read.cigar if bt in (0, 2))
+
+        # The first block starting at or after the read, then on until the
+        # read does not reach the end of the block anymore
+        i = max(0, -(-(start_read - start_block) // step))
+        while (i < n_blocks) and (end_read >= edges_blocks[i][1]):
+            seqs = seqs_blocks[i]
+            n_seen[i] += 1
+            if len(seqs) < reads_per_alignment:
+                j = len(seqs)
+                seqs.append(None)
+            else:
+                j = np.random.randint(n_seen[i])
+
+            if j < reads_per_alignment:
+                (pos_read_start, pos_read_end) = get_trim_coordinates(read,
+                                                                      edges_blocks[i])
+                seqs[j] = read.seq[pos_read_start: pos_read_end]
+
+            i += 1
+
+    bamfile.reset()
+
+    if VERBOSE >= 3:
+        print 'Reads per block:', n_seen
+
+    return seqs_blocks
+
+
 def pileup_trim_reads_coverstart(bamfile, start, VERBOSE=0):
     '''Collect reads that cover the start of a region, and trim them to the same
     
@@ -179,16 +265,9 @@ def build_consensus(bamfilename, len_reference, VERBOSE=0,
         if VERBOSE >= 2:
             print 'First block'
 
-        block_len = block_len
-        seqs = []
-        n_block = 0
-        while not seqs:
-            start_block = n_block * (block_len // 2)
-            for read in bamfile:
-                if read.pos <= start_block:
-                    seqs.append((read.pos, ('N' * read.pos) + read.seq[:block_len - read.pos]))
-            bamfile.reset()
-            n_block += 1
+        (start_block, seqs) = get_first_block_reads(bamfile, block_len=block_len,
+                                                    VERBOSE=VERBOSE)
+        n_block = start_block // (block_len // 2) + 1
         
         # If there are too many reads, take the reads that start earliest
         if len(seqs) > reads_per_alignment:
@@ -200,25 +279,26 @@ def build_consensus(bamfilename, len_reference, VERBOSE=0,
                    for i, (pos, s) in enumerate(seqs)]
         consensus = build_local_consensus(seqrecs, VERBOSE=VERBOSE, full_cover=False)
 
+        # Divide reads by block in one scan (instead of one scan per block)
+        seqs_blocks = collect_block_reads(bamfile, len_reference, start_block,
+                                          block_len=block_len,
+                                          reads_per_alignment=reads_per_alignment,
+                                          VERBOSE=VERBOSE)
+
         # Block, by block, make local alignment and join to previous consensus
         # There are two ways of finishing the loop:
         # 1. if we cover all the way to the end of the reference, good
         # 2. if we find no reads fully covering a block BEFORE that, add a final block
-        while start_block < len_reference:
+        for seqs in seqs_blocks:
             edges = (start_block, min(len_reference, start_block + block_len))
 
             if VERBOSE >= 2:
                 print 'block n.', n_block, 'region:', edges
 
-            seqs = pileup_trim_reads_coverfull(bamfile, edges, VERBOSE=VERBOSE)
-
             # If we do not find reads that fully cover, consider it the end of
             # the consensus, only the final block is missing
             if not seqs:
                 break
-            elif len(seqs) > reads_per_alignment:
-                np.random.shuffle(seqs)
-                seqs = seqs[:reads_per_alignment]
 
             # Make local consensus using a multiple sequence alignment
             # --------------
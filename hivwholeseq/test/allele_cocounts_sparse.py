@@ -0,0 +1,68 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Test suite for the compact representation of allele cocounts.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import unittest
+import tempfile
+import numpy as np
+
+from hivwholeseq.utils.miseq import alphal
+from hivwholeseq.utils.two_site_statistics import sparsify_coallele_counts, \
+        densify_coallele_counts, save_coallele_counts_sparse, \
+        load_coallele_counts_sparse
+
+
+
+# Tests
+class TestCocountsSparse(unittest.TestCase):
+    length = 50
+
+    def setUp(self):
+        # Symmetric cocounts of a few fake read pairs
+        counts = np.zeros((len(alphal), len(alphal), self.length, self.length), int)
+        rng = np.random.RandomState(0)
+        for i in xrange(20):
+            start = rng.randint(self.length - 10)
+            pos = np.arange(start, start + 10)
+            aind = rng.randint(4, size=len(pos))
+            counts[aind[:, None], aind, pos[:, None], pos] += 1
+        self.counts = counts
+
+
+    def test_roundtrip(self):
+        '''Test dense to sparse and back'''
+        cocounts = sparsify_coallele_counts(self.counts)
+        self.assertTrue((cocounts['pos1'] <= cocounts['pos2']).all())
+        self.assertEqual(cocounts['counts'].dtype, np.uint8)
+        np.testing.assert_array_equal(densify_coallele_counts(cocounts),
+                                      self.counts)
+
+
+    def test_file_range(self):
+        '''Test loading a position range from file'''
+        cocounts = sparsify_coallele_counts(self.counts)
+        (fd, fn) = tempfile.mkstemp(suffix='.npz')
+        os.close(fd)
+        try:
+            save_coallele_counts_sparse(fn, cocounts, blocksize=7)
+            cocounts_range = load_coallele_counts_sparse(fn, start=12, end=31)
+        finally:
+            os.remove(fn)
+
+        np.testing.assert_array_equal(densify_coallele_counts(cocounts_range),
+                                      self.counts[:, :, 12: 31, 12: 31])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Test suite for the memory-mapped store of allele count trajectories.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import time
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from hivwholeseq.patients import filenames
+from hivwholeseq.patients import allele_count_store as acs
+from hivwholeseq.patients.one_site_statistics import get_allele_count_trajectories
+
+
+
+# Tests
+class TestAlleleCountStore(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()+'/'
+        folder = self.folder
+
+        # Keep all files of the patient in the temporary folder
+        def get_store_filename(pname, fragment, qual_min=30, index=False):
+            return folder+'store_'+fragment+('.json' if index else '.npy')
+        def get_allele_counts_filename(pname, samplename_pat, fragment, PCR=1,
+                                       qual_min=30, type='nuc'):
+            return folder+'allele_counts_'+samplename_pat+'_'+fragment+\
+                    '_PCR'+str(PCR)+'.npy'
+        def get_initial_reference_filename(pname, fragment, format='fasta'):
+            return folder+'reference_'+fragment+'.'+format
+
+        self.patched = [(acs, 'get_store_filename', get_store_filename),
+                        (filenames, 'get_allele_count_trajectories_store_filename',
+                         get_store_filename),
+                        (filenames, 'get_allele_counts_filename',
+                         get_allele_counts_filename),
+                        (filenames, 'get_initial_reference_filename',
+                         get_initial_reference_filename)]
+        self.originals = [getattr(module, name) for (module, name, _) in self.patched]
+        for (module, name, func) in self.patched:
+            setattr(module, name, func)
+
+        self.set_reference(20)
+
+
+    def tearDown(self):
+        for ((module, name, _), func) in zip(self.patched, self.originals):
+            setattr(module, name, func)
+        shutil.rmtree(self.folder)
+
+
+    def set_reference(self, length):
+        with open(self.folder+'reference_F1.fasta', 'w') as f:
+            f.write('>ref\n'+'A' * length+'\n')
+
+
+    def get_counts(self, value, length=20):
+        return np.ones((4, 6, length), int) * value
+
+
+    def save_counts(self, samplename, counts):
+        np.save(filenames.get_allele_counts_filename('p1', samplename, 'F1'),
+                counts)
+
+
+    def test_add(self):
+        '''Test the addition and replacement of samples'''
+        for (i, samplename) in enumerate(('s1', 's2', 's3')):
+            acs.add_allele_counts_to_store('p1', samplename, 'F1',
+                                           self.get_counts(i + 1))
+        acs.add_allele_counts_to_store('p1', 's2', 'F1', self.get_counts(5))
+
+        (samples, counts) = acs.load_allele_count_store('p1', 'F1')
+        self.assertEqual(samples, [('s1', 1), ('s2', 1), ('s3', 1)])
+        self.assertEqual(counts[:, 0, 0, 0].tolist(), [1, 5, 3])
+
+
+    def test_orphan_data(self):
+        '''Test an append after data left over by a job that died'''
+        acs.add_allele_counts_to_store('p1', 's1', 'F1', self.get_counts(1))
+        with open(acs.get_store_filename('p1', 'F1'), 'ab') as f:
+            f.write(self.get_counts(9).tostring())
+
+        acs.add_allele_counts_to_store('p1', 's2', 'F1', self.get_counts(2))
+        (samples, counts) = acs.load_allele_count_store('p1', 'F1')
+        self.assertEqual(counts[:, 0, 0, 0].tolist(), [1, 2])
+        self.assertEqual(os.path.getsize(acs.get_store_filename('p1', 'F1')),
+                         2 * self.get_counts(1).nbytes)
+
+
+    def test_new_reference(self):
+        '''Test allele counts after a correction of the reference length'''
+        for (i, samplename) in enumerate(('s1', 's2')):
+            self.save_counts(samplename, self.get_counts(i + 1))
+            acs.add_allele_counts_to_store('p1', samplename, 'F1',
+                                           self.get_counts(i + 1))
+
+        (samples, act) = get_allele_count_trajectories('p1', ['s1', 's2'], 'F1')
+        self.assertEqual(act[:, 0, 0].tolist(), [4, 8])
+
+        # A sample counted again with the same reference is newer than the store
+        time.sleep(0.01)
+        self.save_counts('s2', self.get_counts(3))
+        (samples, act) = get_allele_count_trajectories('p1', ['s1', 's2'], 'F1')
+        self.assertEqual(act[:, 0, 0].tolist(), [4, 12])
+
+        # A longer reference: the old store is ignored, then replaced
+        self.set_reference(25)
+        for (i, samplename) in enumerate(('s1', 's2')):
+            self.save_counts(samplename, self.get_counts(i + 5, length=25))
+        (samples, act) = get_allele_count_trajectories('p1', ['s1', 's2'], 'F1')
+        self.assertEqual(act.shape, (2, 6, 25))
+        self.assertEqual(act[:, 0, 0].tolist(), [20, 24])
+
+        acs.add_allele_counts_to_store('p1', 's1', 'F1',
+                                       self.get_counts(5, length=25))
+        (samples, counts) = acs.load_allele_count_store('p1', 'F1')
+        self.assertEqual(samples, [('s1', 1)])
+        self.assertEqual(counts.shape, (1, 4, 6, 25))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
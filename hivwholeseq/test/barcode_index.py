@@ -0,0 +1,67 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Test suite for the error-tolerant barcode index for demultiplexing.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import unittest
+
+from hivwholeseq.sequencing.adapter_info import build_barcode_index
+
+
+
+# Tests
+class TestBarcodeIndex(unittest.TestCase):
+
+    def test_single(self):
+        '''Test single index barcodes with one mismatch'''
+        index = build_barcode_index([('TS1', 'AAAAAA'), ('TS2', 'AAAACC')],
+                                    max_distance=1)
+
+        self.assertEqual(index['AAAAAA'], ('TS1', 0))
+        self.assertEqual(index['AAAAAT'], ('TS1', 1))
+        self.assertEqual(index['AAAANA'], ('TS1', 1))
+        self.assertEqual(index['AAAACC'], ('TS2', 0))
+
+        # Equally far from both adapters
+        self.assertNotIn('AAAAAC', index)
+        self.assertNotIn('AAAACA', index)
+
+        # Too far
+        self.assertNotIn('AAAATT', index)
+
+
+    def test_exact_wins(self):
+        '''Test that an exact match beats a neighbor of another adapter'''
+        index = build_barcode_index([('TS1', 'AAAAAA'), ('TS2', 'AAAAAC')],
+                                    max_distance=1)
+        self.assertEqual(index['AAAAAA'], ('TS1', 0))
+        self.assertEqual(index['AAAAAC'], ('TS2', 0))
+        self.assertNotIn('AAAAAG', index)
+
+
+    def test_dual(self):
+        '''Test dual index barcodes'''
+        index = build_barcode_index([('N1-S1', 'TAAGGCGA-TAGATCGC')],
+                                    max_distance=1)
+        self.assertEqual(index['TAAGGCGA-TAGATCGA'], ('N1-S1', 1))
+        self.assertEqual(len(index), 1 + 16 * 4)
+
+
+    def test_exact_only(self):
+        '''Test that distance zero is the plain exact match'''
+        index = build_barcode_index([('TS1', 'AAAAAA')], max_distance=0)
+        self.assertEqual(index, {'AAAAAA': ('TS1', 0)})
+
+
+
+if __name__ == '__main__':
+    unittest.main()
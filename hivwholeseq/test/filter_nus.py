@@ -0,0 +1,96 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Test suite for the strand-bias filter of allele frequencies.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import unittest
+import numpy as np
+from scipy.stats import chi2_contingency
+
+from hivwholeseq.utils.one_site_statistics import filter_nus, \
+        get_strand_bias_pvalues
+
+
+
+# Functions
+def get_pvalue_yates(table):
+    '''Chi2 test with Yates' correction, each count shifted at most to the expected one
+
+    Old scipy versions shift by 0.5 even past the expected count.
+    '''
+    expected = chi2_contingency(table, correction=False)[3]
+    shift = np.minimum(0.5, np.abs(table - expected))
+    table = table + shift * np.sign(expected - table)
+    return chi2_contingency(table, correction=False)[1]
+
+
+
+# Tests
+class TestFilterNus(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        L = 50
+        counts = rng.randint(0, 30, size=(4, 6, L))
+        # Strand bias at some positions, low coverage at others
+        counts[[1, 3], 2, :10] *= 20
+        counts[[0, 2], :, 10:15] = 0
+        counts[:, :, 15:18] = 0
+        self.counts = counts
+
+
+    def test_pvalues(self):
+        '''Test the vectorized chi2 tests against scipy'''
+        tables = np.random.RandomState(1).randint(1, 200, size=(4, 100))
+        pvals = get_strand_bias_pvalues(*tables)
+        for i in xrange(tables.shape[1]):
+            table = tables[:, i].reshape((2, 2))
+            self.assertAlmostEqual(pvals[i], get_pvalue_yates(table))
+
+
+    def test_pvalues_yates(self):
+        '''Test the continuity correction when |O - E| is below 0.5'''
+        tables = np.array([[10, 10, 10, 11],
+                           [10, 10, 10, 10],
+                           [50, 49, 51, 50],
+                           [3, 1, 1, 2]]).T
+        pvals = get_strand_bias_pvalues(*tables)
+        for i in xrange(tables.shape[1]):
+            table = tables[:, i].reshape((2, 2))
+            self.assertAlmostEqual(pvals[i], get_pvalue_yates(table))
+
+
+    def test_filter(self):
+        '''Test the masking and blending of forward and reverse'''
+        counts = self.counts
+        nu = filter_nus(counts)
+        self.assertTrue(nu.mask[:, 15:18].all())
+        self.assertFalse(nu.mask[:, :15].any())
+        np.testing.assert_allclose(nu.sum(axis=0)[:15], 1)
+
+        # Covered only once: blend
+        cou = counts[:, :, 10:15].sum(axis=0)
+        np.testing.assert_allclose(nu[:, 10:15], 1.0 * cou / cou.sum(axis=0))
+
+
+    def test_trajectory(self):
+        '''Test a whole trajectory tensor in one call'''
+        counts = np.array([self.counts, self.counts[:, ::-1]])
+        nus = filter_nus(counts)
+        for it in xrange(len(counts)):
+            np.testing.assert_allclose(nus[it].filled(-1),
+                                       filter_nus(counts[it]).filled(-1))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
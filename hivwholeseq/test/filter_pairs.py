@@ -0,0 +1,201 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Test suite for the batch filter of read pairs.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import shutil
+import tempfile
+import unittest
+from copy import deepcopy
+import numpy as np
+import pysam
+
+from hivwholeseq.utils.filter_pairs import get_distance_from_consensus_batch, \
+        filter_read_pairs_batch, filter_read_pairs_bams
+
+from hivwholeseq.test.utils import Read, fix_pair
+
+
+
+# Functions
+def get_distance_from_consensus(ref, reads):
+    '''Distance from consensus, read by read'''
+    ds = []
+    for read in reads:
+        d = 0
+        pos_ref = read.pos
+        pos_read = 0
+        for (bt, bl) in read.cigar:
+            if bt in (1, 2):
+                d += 1
+            if bt in (0, 1):
+                pos_read += bl
+            if bt in (0, 2):
+                pos_ref += bl
+            if bt == 0:
+                d += sum(a != b for (a, b) in zip(read.seq[pos_read - bl: pos_read],
+                                                  ref[pos_ref - bl: pos_ref]))
+        ds.append(d)
+    return ds
+
+
+def make_pairs(ref, n_pairs, seed=0):
+    '''Make random read pairs with mutations, indels and bad flags'''
+    rng = np.random.RandomState(seed)
+    alpha = np.array(list('ACGT'))
+    pairs = []
+    for ip in xrange(n_pairs):
+        reads = []
+        start = rng.randint(len(ref) - 400)
+        for (pos, is_reverse) in ((start, False), (start + 200, True)):
+            cigar = [(0, 150)]
+            if rng.rand() < 0.2:
+                cigar = [(0, 60), (1, 2), (0, 88)]
+            elif rng.rand() < 0.1:
+                cigar = [(0, 70), (2, 3), (0, 80)]
+            elif rng.rand() < 0.1:
+                cigar = [(0, 10), (1, 5), (0, 135)]
+
+            seq = []
+            pos_ref = pos
+            for (bt, bl) in cigar:
+                if bt == 0:
+                    seq.extend(ref[pos_ref: pos_ref + bl])
+                    pos_ref += bl
+                elif bt == 1:
+                    seq.extend(alpha[rng.randint(4, size=bl)])
+                else:
+                    pos_ref += bl
+            seq = np.array(seq)
+            n_mut = rng.randint(0, 12) if rng.rand() < 0.2 else rng.randint(3)
+            ind = rng.randint(len(seq), size=n_mut)
+            seq[ind] = alpha[rng.randint(4, size=n_mut)]
+
+            reads.append(Read(''.join(seq), pos=pos, qname='pair'+str(ip), cigar=cigar,
+                              is_reverse=is_reverse, is_unmapped=False,
+                              is_proper_pair=rng.rand() > 0.05))
+        reads[1].is_unmapped = rng.rand() < 0.05
+        fix_pair(reads)
+        pairs.append(reads)
+    return pairs
+
+
+
+# Tests
+class TestFilterPairs(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.ref = ''.join(np.array(list('ACGT'))[rng.randint(4, size=1000)])
+        self.pairs = make_pairs(self.ref, 300)
+
+
+    def test_distance(self):
+        '''Test the batch distance against the read-by-read one'''
+        reads = [read for reads in self.pairs for read in reads]
+        self.assertEqual(get_distance_from_consensus_batch(self.ref, reads).tolist(),
+                         get_distance_from_consensus(self.ref, reads))
+
+
+    def test_classify(self):
+        '''Test the classification of pairs and the histograms'''
+        pairs = deepcopy(self.pairs)
+        hist = np.zeros(301, int)
+        hist_along = np.zeros((1000 // 200 + 1, 301), int)
+        types = filter_read_pairs_batch(pairs, self.ref,
+                                        hist_distance_from_consensus=hist,
+                                        hist_dist_along=hist_along,
+                                        max_mismatches=10,
+                                        read_len_min=100,
+                                        isize_min=300)
+
+        for (reads, reads_orig, pair_type) in zip(pairs, self.pairs, types):
+            if reads_orig[0].is_unmapped or reads_orig[1].is_unmapped:
+                self.assertEqual(pair_type, 'unmapped')
+            elif not (reads_orig[0].is_proper_pair and reads_orig[1].is_proper_pair):
+                self.assertEqual(pair_type, 'unpaired')
+            elif sum(get_distance_from_consensus(self.ref, reads_orig)) > 10:
+                self.assertEqual(pair_type, 'mutator')
+            elif (reads_orig[0].cigar[0] == (0, 10)) or (reads_orig[1].cigar[0] == (0, 10)):
+                # The short block at the start is trimmed
+                self.assertEqual(pair_type, 'good')
+                for (read, read_orig) in zip(reads, reads_orig):
+                    if read_orig.cigar[0] == (0, 10):
+                        self.assertEqual(read.cigar, [(0, 132)])
+                        self.assertEqual(read.pos, read_orig.pos + 13)
+            else:
+                self.assertEqual(pair_type, 'good')
+                self.assertEqual(reads, reads_orig)
+
+        n_dist = sum(t not in ('unmapped', 'unpaired') for t in types)
+        self.assertEqual(hist.sum(), n_dist)
+        self.assertEqual(hist_along.sum(), n_dist)
+        self.assertTrue(set(types) >= set(['good', 'mutator', 'unmapped', 'unpaired']))
+
+
+    def test_bams(self):
+        '''Test the filter of several BAM files, serial and in a pool'''
+        folder = tempfile.mkdtemp()+'/'
+        try:
+            header = {'HD': {'VN': '1.0'}, 'SQ': [{'SN': 'ref', 'LN': len(self.ref)}]}
+            infilenames = []
+            for ifn in xrange(3):
+                fn = folder+'mapped'+str(ifn)+'.bam'
+                with pysam.Samfile(fn, 'wb', header=header) as f:
+                    for reads in self.pairs[ifn * 100: (ifn + 1) * 100]:
+                        for read in reads:
+                            r = pysam.AlignedSegment()
+                            r.qname = read.qname
+                            r.seq = read.seq
+                            r.qual = read.qual
+                            r.flag = (1 + 2 * read.is_proper_pair + 4 * read.is_unmapped +
+                                      16 * read.is_reverse + (128 if read.is_reverse else 64))
+                            r.tid = 0
+                            r.pos = read.pos
+                            r.cigar = read.cigar
+                            r.isize = read.isize
+                            f.write(r)
+                infilenames.append(fn)
+
+            results = []
+            for threads in (1, 2):
+                hist = np.zeros(301, int)
+                hist_along = np.zeros((6, 301), int)
+                outfilename = folder+'filtered'+str(threads)+'.bam'
+                counts = filter_read_pairs_bams(infilenames, outfilename,
+                                                outfilename[:-4]+'_trashed.bam',
+                                                self.ref, hist, hist_along,
+                                                threads=threads,
+                                                maxreads=80,
+                                                chunksize=30,
+                                                max_mismatches=10)
+                reads = []
+                for fn in (outfilename, outfilename[:-4]+'_trashed.bam'):
+                    with pysam.Samfile(fn, 'rb') as f:
+                        reads.append([(r.qname, r.pos, r.cigarstring) for r in f])
+                results.append((counts, hist, hist_along, reads))
+
+            self.assertEqual(sum(results[0][0].itervalues()), 240)
+            self.assertEqual(len(results[0][3][0]), 2 * results[0][0]['good'])
+            self.assertEqual(results[0][0], results[1][0])
+            self.assertTrue((results[0][1] == results[1][1]).all())
+            self.assertTrue((results[0][2] == results[1][2]).all())
+            self.assertEqual(results[0][3], results[1][3])
+            self.assertFalse(os.path.isfile(folder+'filtered2_shard1.bam'))
+
+        finally:
+            shutil.rmtree(folder)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
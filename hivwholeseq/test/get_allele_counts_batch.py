@@ -0,0 +1,86 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Test suite for batched allele counts calls from the reads.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import unittest
+from collections import Counter
+import numpy as np
+
+from hivwholeseq.utils.miseq import alphal, read_types
+from hivwholeseq.utils.one_site_statistics import get_allele_counts_read, \
+        get_allele_counts_reads_batch
+
+from hivwholeseq.test.utils import Read
+
+
+
+# Tests
+class TestAlleleCountsBatch(unittest.TestCase):
+    length = 40
+
+    def setUp(self):
+        reads = []
+
+        # Trivial read, only matches
+        reads.append(Read('AAAGGGTTTCCC', pos=1))
+
+        # Read with an insertion and a deletion, reverse
+        read = Read('AAAGGGTTTCCC', pos=2, is_reverse=True)
+        read.cigar = [(0, 3), (1, 3), (0, 3), (2, 4), (0, 3)]
+        reads.append(read)
+
+        # Read 2 with a low-quality stretch
+        read = Read('ACGTACGTACGTNN', pos=5, is_read2=True)
+        read.qual = 'G' * 6 + '#' * 4 + 'G' * 4
+        reads.append(read)
+
+        for read in reads:
+            if not hasattr(read, 'is_read2'):
+                read.is_read2 = False
+
+        self.reads = reads
+
+
+    def test(self):
+        '''Test batched allele counts against single reads'''
+        counts = np.zeros((len(read_types), len(alphal), self.length), int)
+        inserts = [Counter() for rt in read_types]
+
+        # Expected result
+        counts_check = counts.copy()
+        inserts_check = [Counter() for rt in read_types]
+        for read in self.reads:
+            js = 2 * read.is_read2 + read.is_reverse
+            get_allele_counts_read(read, counts_check[js], inserts_check[js],
+                                   length=self.length)
+
+        # Call the function
+        get_allele_counts_reads_batch(self.reads, counts, inserts,
+                                      length=self.length)
+
+        # Equality test (they are ints)
+        np.testing.assert_array_equal(counts, counts_check)
+        self.assertEqual(inserts, inserts_check)
+
+
+    def test_length(self):
+        '''Test that reads beyond the fragment length are rejected'''
+        counts = np.zeros((len(read_types), len(alphal), 10), int)
+        inserts = [Counter() for rt in read_types]
+        with self.assertRaises(ValueError):
+            get_allele_counts_reads_batch(self.reads, counts, inserts, length=10)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Test suite for the k-mer index used to shortlist contaminants.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import unittest
+
+from hivwholeseq.utils.kmers import KmerIndex, get_kmer_codes
+
+
+
+# Tests
+class TestKmerIndex(unittest.TestCase):
+
+    def test_codes(self):
+        '''Test the encoding of k-mers and the skipping of ambiguous ones'''
+        self.assertEqual(get_kmer_codes('ACGT', 2).tolist(), [1, 6, 11])
+        self.assertEqual(get_kmer_codes('ACNGT', 2).tolist(), [1, 11])
+        self.assertEqual(len(get_kmer_codes('AC', 3)), 0)
+
+
+    def test_scores(self):
+        '''Test the number of shared k-mers'''
+        index = KmerIndex({'s1': 'AAAACCCCGGGG', 's2': 'AAAATTTTGGGG'}, k=4)
+        scores = dict(zip(index.names, index.get_scores('AAAACCCC')))
+        self.assertEqual(scores, {'s1': 5, 's2': 1})
+
+
+    def test_candidates(self):
+        '''Test the ranking and restriction of candidates'''
+        index = KmerIndex({'s1': 'AAAACCCCGGGG', 's2': 'AAAATTTTGGGG',
+                           's3': 'CCCCCCCCCCCC'}, k=4)
+        self.assertEqual(index.get_candidates('AAAATTTTG', n=1), ['s2'])
+        self.assertEqual(index.get_candidates('AAAATTTTG', n=1,
+                                              names=['s1', 's3']), ['s1'])
+        self.assertEqual(index.get_candidates('AAAATTTTG', names=[]), [])
+
+
+    def test_seqrecord(self):
+        '''Test the index of consensi loaded as SeqRecords'''
+        from Bio.Seq import Seq
+        from Bio.SeqRecord import SeqRecord
+
+        rec = SeqRecord(Seq('AAAACCCCGGGG'), id='s1', description='consensus')
+        self.assertEqual(get_kmer_codes(rec, 4).tolist(),
+                         get_kmer_codes('AAAACCCCGGGG', 4).tolist())
+
+        index = KmerIndex({'s1': rec, 's2': 'AAAATTTTGGGG'}, k=4)
+        scores = dict(zip(index.names, index.get_scores(Seq('AAAACCCC'))))
+        self.assertEqual(scores, {'s1': 5, 's2': 1})
+
+
+
+if __name__ == '__main__':
+    unittest.main()
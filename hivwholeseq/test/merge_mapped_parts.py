@@ -0,0 +1,189 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Test suite for the collection of the parts of multithread mappings.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import shutil
+import tempfile
+import unittest
+import pysam
+
+from hivwholeseq.utils.mapping import convert_sam_to_bam_sorted_name, \
+        merge_bam_sorted_name, merge_mapped_parts, map_to_bam
+
+
+
+# Tests
+class TestMergeMappedParts(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.header = {'HD': {'VN': '1.0'},
+                       'SQ': [{'SN': 'ref', 'LN': 100}]}
+
+        # Two parts with interleaved pair names, pairs unsorted within a part
+        self.parts = [['p3', 'p1', 'p5'], ['p4', 'p0', 'p2']]
+        self.sam_fns = []
+        for j, names in enumerate(self.parts):
+            fn = os.path.join(self.folder, 'part'+str(j+1)+'.sam')
+            with pysam.Samfile(fn, 'wh', header=self.header) as samfile:
+                for name in names:
+                    for mate in (0, 1):
+                        read = pysam.AlignedSegment()
+                        read.qname = name
+                        read.seq = 'ACGT'
+                        read.qual = 'IIII'
+                        read.flag = 1 + (64 if mate == 0 else 128)
+                        read.tid = 0
+                        read.pos = 10 * mate
+                        read.cigar = [(0, 4)]
+                        samfile.write(read)
+            self.sam_fns.append(fn)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+
+    def check_output(self, bamfilename):
+        with pysam.Samfile(bamfilename, 'rb') as bamfile:
+            self.assertEqual(bamfile.references, ('ref',))
+            reads = list(bamfile)
+
+        self.assertEqual([read.qname for read in reads],
+                         [n for n in sorted(sum(self.parts, [])) for mate in (0, 1)])
+        self.assertTrue(all(read.is_read1 for read in reads[::2]))
+        self.assertTrue(all(read.is_read2 for read in reads[1::2]))
+
+
+    def test_convert_merge(self):
+        '''Test the conversion of the parts and their merge by name'''
+        bam_fns = [fn[:-3]+'bam' for fn in self.sam_fns]
+        for fn in bam_fns:
+            convert_sam_to_bam_sorted_name(fn)
+
+        output_fn = os.path.join(self.folder, 'merged.bam')
+        merge_bam_sorted_name(output_fn, bam_fns)
+        self.check_output(output_fn)
+
+
+    def test_pipe(self):
+        '''Test the pipe from a mapper into a name-sorted BAM file'''
+        output_fn = os.path.join(self.folder, 'piped.bam')
+        map_to_bam(['cat'] + self.sam_fns[:1], output_fn)
+        with pysam.Samfile(output_fn, 'rb') as bamfile:
+            self.assertEqual([read.qname for read in bamfile],
+                             [n for n in sorted(self.parts[0]) for mate in (0, 1)])
+
+        with self.assertRaises(RuntimeError):
+            map_to_bam(['false'], output_fn)
+
+
+    def test_local_jobs(self):
+        '''Test the collection of parts from local jobs'''
+        from hivwholeseq.cluster.executor import submit, get_job_id, executor_env
+
+        executor = os.environ.get(executor_env)
+        os.environ[executor_env] = 'local'
+        try:
+            # The jobs just produce the SAM files of the parts
+            job_IDs = []
+            bam_fns = []
+            for j, fn in enumerate(self.sam_fns):
+                bam_fn = os.path.join(self.folder, 'mapped'+str(j+1)+'.bam')
+                call_list = ['qsub', '-cwd',
+                             '-o', os.devnull,
+                             '-e', os.devnull,
+                             '-N', 'part'+str(j+1),
+                             'cp', fn, bam_fn[:-3]+'sam']
+                job_IDs.append(get_job_id(submit(call_list)))
+                bam_fns.append(bam_fn)
+
+            output_fn = os.path.join(self.folder, 'mapped.bam')
+            merge_mapped_parts(job_IDs, bam_fns, output_fn, threads=2,
+                               interval=0.1)
+        finally:
+            if executor is None:
+                del os.environ[executor_env]
+            else:
+                os.environ[executor_env] = executor
+
+        self.check_output(output_fn)
+
+
+    def test_premap_multithread(self):
+        '''Test a multithread premap, with a fake stampy, through local jobs'''
+        from hivwholeseq.cluster.executor import executor_env
+        from hivwholeseq.sequencing import premap_to_reference
+        from hivwholeseq.sequencing.filenames import get_read_filenames, \
+                get_premapped_filename
+
+        # The fake stampy writes the pairs of its part, unsorted
+        stampy_fn = os.path.join(self.folder, 'stampy')
+        with open(stampy_fn, 'w') as f:
+            f.write('''#!'''+sys.executable+'''
+import sys
+import pysam
+args = sys.argv[1:]
+output_fn = args[args.index('-o') + 1]
+[part] = [a for a in args if a.startswith('--processpart=')]
+j, threads = map(int, part.split('=')[1].split('/'))
+header = {'HD': {'VN': '1.0'}, 'SQ': [{'SN': 'ref', 'LN': 100}]}
+with pysam.Samfile(output_fn, 'wh', header=header) as samfile:
+    for i in xrange(5, -1, -1):
+        if i % threads != j - 1:
+            continue
+        for mate in (0, 1):
+            read = pysam.AlignedSegment()
+            read.qname = 'p'+str(i)
+            read.seq = 'ACGT'
+            read.qual = 'IIII'
+            read.flag = 1 + (64 if mate == 0 else 128)
+            read.tid = 0
+            read.pos = 10 * mate
+            read.cigar = [(0, 4)]
+            samfile.write(read)
+''')
+        os.chmod(stampy_fn, 0755)
+
+        data_folder = self.folder+'/'
+        adaID = 'N1-S1'
+        premap_to_reference.make_output_folders(data_folder, adaID, summary=False)
+        for fn in get_read_filenames(data_folder, adaID):
+            open(fn, 'w').close()
+
+        stampy_bin = premap_to_reference.stampy_bin
+        executor = os.environ.get(executor_env)
+        premap_to_reference.stampy_bin = stampy_fn
+        os.environ[executor_env] = 'local'
+        # As in the script, where the --submit flag is a module global
+        premap_to_reference.submit = False
+        try:
+            premap_to_reference.premap_stampy(data_folder, adaID, threads=2,
+                                              summary=False)
+        finally:
+            premap_to_reference.stampy_bin = stampy_bin
+            del premap_to_reference.submit
+            if executor is None:
+                del os.environ[executor_env]
+            else:
+                os.environ[executor_env] = executor
+
+        self.parts = [['p5', 'p3', 'p1'], ['p4', 'p2', 'p0']]
+        self.check_output(get_premapped_filename(data_folder, adaID))
+        self.assertEqual(sorted(os.listdir(os.path.dirname(get_premapped_filename(data_folder, adaID)))),
+                         ['premapped.bam'])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Test suite for the make-style pipeline.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import time
+import shutil
+import tempfile
+import unittest
+
+from hivwholeseq.utils.exceptions import PipelineError
+from hivwholeseq.store.pipeline import Target, sort_targets, get_stale_targets, \
+        run_targets
+
+
+
+# Classes
+class LocalTarget(Target):
+    '''Target with its job logs discarded'''
+    def get_call_list(self, VERBOSE=0):
+        return ['qsub', '-o', os.devnull, '-e', os.devnull, '-N', self.stage,
+                self.script] + self.args
+
+
+
+# Tests
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()+'/'
+        self.fn_ref = self.folder+'reference.fasta'
+        with open(self.fn_ref, 'w') as f:
+            f.write('>ref\nACGT\n')
+
+        # reference -> mapped -> counts, each a copy of the previous file
+        self.fn_mapped = self.folder+'mapped/F1.bam'
+        self.fn_counts = self.folder+'counts/F1.npy'
+        self.targets = [LocalTarget('allele_counts', ['s1', 'F1'], [self.fn_counts],
+                                    [self.fn_mapped], '/bin/cp',
+                                    [self.fn_mapped, self.fn_counts]),
+                        LocalTarget('map_initial', ['s1', 'F1'], [self.fn_mapped],
+                                    [self.fn_ref], '/bin/cp',
+                                    [self.fn_ref, self.fn_mapped]),
+                       ]
+
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+
+    def build(self):
+        executor = os.environ.get('HIVWHOLESEQ_EXECUTOR')
+        os.environ['HIVWHOLESEQ_EXECUTOR'] = 'local'
+        try:
+            stale = get_stale_targets(self.targets)
+            return run_targets([t for (t, r) in stale], interval=0.05)
+        finally:
+            if executor is None:
+                del os.environ['HIVWHOLESEQ_EXECUTOR']
+            else:
+                os.environ['HIVWHOLESEQ_EXECUTOR'] = executor
+
+
+    def test_sort(self):
+        '''Test the topological sort and the detection of cycles'''
+        self.assertEqual([t.stage for t in sort_targets(self.targets)],
+                         ['map_initial', 'allele_counts'])
+
+        self.targets[1].inputs.append(self.fn_counts)
+        with self.assertRaises(PipelineError):
+            sort_targets(self.targets)
+
+
+    def test_build(self):
+        '''Test the build of stale targets through the local executor'''
+        stale = get_stale_targets(self.targets)
+        self.assertEqual([r.split()[0] for (t, r) in stale], ['missing', 'missing'])
+
+        statuses = self.build()
+        self.assertEqual(sorted(statuses.values()), ['done', 'done'])
+        with open(self.fn_counts) as f:
+            self.assertEqual(f.read(), '>ref\nACGT\n')
+        self.assertEqual(get_stale_targets(self.targets), [])
+
+        # A corrected reference makes all targets downstream stale
+        time.sleep(0.01)
+        with open(self.fn_ref, 'w') as f:
+            f.write('>ref\nACGTT\n')
+        stale = get_stale_targets(self.targets)
+        self.assertEqual([r for (t, r) in stale],
+                         ['input changed '+self.fn_ref,
+                          'upstream map_initial s1 F1'])
+
+
+    def test_params(self):
+        '''Test the staleness from parameters and modification times'''
+        self.build()
+        self.targets[0].args.append('-p')
+        stale = get_stale_targets(self.targets)
+        self.assertEqual([r for (t, r) in stale], ['parameters changed'])
+
+        # Without records, like make
+        for fn in (self.fn_mapped, self.fn_counts):
+            os.remove(fn+'.pipeline.json')
+        os.utime(self.fn_counts, (0, 0))
+        stale = get_stale_targets(self.targets)
+        self.assertEqual([r for (t, r) in stale], ['input newer '+self.fn_mapped])
+
+
+    def test_failure(self):
+        '''Test that targets downstream of a failed one are skipped'''
+        self.targets[1].script = '/bin/false'
+        statuses = self.build()
+        self.assertEqual(statuses[self.targets[1]], 'failed')
+        self.assertEqual(statuses[self.targets[0]], 'skipped')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Test suite for the division of read pairs into fragments in chunks.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pysam
+
+from hivwholeseq.sequencing.trim_and_divide import divide_read_pairs, \
+        divide_read_pairs_parallel
+
+
+
+# Functions
+def write_pairs(filename, ref, n_pairs, seed=0):
+    '''Write a BAM file of random read pairs, mates consecutive'''
+    rng = np.random.RandomState(seed)
+    header = {'HD': {'VN': '1.0'}, 'SQ': [{'SN': 'ref', 'LN': len(ref)}]}
+    with pysam.Samfile(filename, 'wb', header=header) as f:
+        for ip in xrange(n_pairs):
+            start = rng.randint(len(ref) - 400)
+            isize = rng.randint(150, 400)
+            poss = (start, start + isize - 150)
+            is_proper_pair = rng.rand() > 0.05
+            for (pos, is_reverse) in zip(poss, (False, True)):
+                read = pysam.AlignedSegment()
+                read.qname = 'pair'+str(ip)
+                read.seq = ref[pos: pos + 150]
+                if rng.rand() < 0.1:
+                    read.qual = '#' * 150
+                else:
+                    read.qual = 'I' * 150
+                read.flag = (1 + 2 * is_proper_pair + 16 * is_reverse +
+                             32 * (not is_reverse) + (128 if is_reverse else 64))
+                read.tid = 0
+                read.pos = pos
+                read.mpos = poss[not is_reverse]
+                read.mapq = 60
+                read.cigar = [(0, 150)]
+                read.isize = -isize if is_reverse else isize
+                f.write(read)
+
+
+
+# Tests
+class TestDivideParallel(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.ref = ''.join(np.array(list('ACGT'))[rng.randint(4, size=1000)])
+        self.folder = tempfile.mkdtemp()+'/'
+        self.input_filename = self.folder+'premapped.bam'
+        self.trim_kwargs = {'frags_pos': {'full': [[0, 550], [450, 1000]],
+                                          'trim': [[20, 530], [470, 980]]},
+                            'primers_out_pos': {'fwd': [], 'rev': []},
+                            'primers_out_seq': {'fwd': [], 'rev': []},
+                            'len_reference': len(self.ref),
+                            'minisize': 100,
+                            'include_tests': False,
+                           }
+
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+
+    def divide(self, threads, maxreads=-1):
+        output_filenames = [self.folder+'divided'+str(threads)+'_'+name+'.bam'
+                            for name in ('F1', 'F2', 'ambiguous', 'cross',
+                                         'unmapped', 'lowq')]
+        if threads == 1:
+            with pysam.Samfile(self.input_filename, 'rb') as bamfile:
+                counts = divide_read_pairs(bamfile, output_filenames, 2,
+                                           self.trim_kwargs, maxreads=maxreads)
+        else:
+            counts = divide_read_pairs_parallel(self.input_filename,
+                                                output_filenames, 2,
+                                                self.trim_kwargs,
+                                                threads=threads, chunksize=7,
+                                                maxreads=maxreads)
+
+        reads = []
+        for fn in output_filenames:
+            with pysam.Samfile(fn, 'rb') as f:
+                self.assertEqual(f.references, ('ref',))
+                reads.append([(r.qname, r.flag, r.pos, r.cigarstring, r.seq,
+                               r.isize) for r in f])
+        self.assertFalse([fn for fn in os.listdir(self.folder) if '_part' in fn])
+        return (counts, reads)
+
+
+    def test_parallel(self):
+        '''Test that parallel and serial divisions write the same output'''
+        write_pairs(self.input_filename, self.ref, 100)
+        for maxreads in (-1, 30, 0):
+            (counts, reads) = self.divide(1, maxreads=maxreads)
+            self.assertEqual(self.divide(2, maxreads=maxreads), (counts, reads))
+            self.assertEqual(counts['total'], 100 if maxreads == -1 else maxreads)
+
+        (counts, reads) = self.divide(1)
+        self.assertTrue(sum(counts['mapped']) > 0)
+        self.assertTrue(counts['unmapped'] > 0)
+
+
+    def test_empty(self):
+        '''Test the division of an empty BAM file'''
+        write_pairs(self.input_filename, self.ref, 0)
+        (counts, reads) = self.divide(2)
+        self.assertEqual(counts['total'], 0)
+        self.assertEqual(self.divide(1), (counts, reads))
+
+
+    def test_include_tests(self):
+        '''Test that sanity checks are refused in worker processes'''
+        write_pairs(self.input_filename, self.ref, 10)
+        self.trim_kwargs['include_tests'] = True
+        with self.assertRaises(ValueError):
+            self.divide(2)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Read statistics of BAM files, stored in a small JSON file next to
+            each BAM so that counting reads does not require a full scan.
+'''
+# Modules
+from __future__ import absolute_import
+import os
+import json
+
+
+
+# Classes
+class BamStatistics(object):
+    '''Accumulator of read statistics of a BAM file'''
+
+    def __init__(self):
+        self.n_reads = 0
+        self.n_mapped = 0
+        self.n_unmapped = 0
+        self.n_proper_pair = 0
+        self.n_mapped_reference = {}
+        self.insert_sizes = []
+
+
+    def add(self, read, refname=None):
+        '''Add a read to the statistics'''
+        self.n_reads += 1
+        if read.is_unmapped:
+            self.n_unmapped += 1
+            return
+
+        self.n_mapped += 1
+        if refname is not None:
+            self.n_mapped_reference[refname] = self.n_mapped_reference.get(refname, 0) + 1
+
+        if read.is_proper_pair:
+            self.n_proper_pair += 1
+            # Count each insert once, from the read with positive isize
+            if read.isize > 0:
+                self.insert_sizes.append(read.isize)
+
+
+    def to_dict(self):
+        '''Summary of the statistics as a dict'''
+        import numpy as np
+
+        isizes = np.array(self.insert_sizes, int)
+        if len(isizes):
+            isize_summary = {'n': len(isizes),
+                             'mean': float(isizes.mean()),
+                             'min': int(isizes.min()),
+                             'max': int(isizes.max()),
+                             'quantiles': dict(zip(['0.05', '0.25', '0.5', '0.75', '0.95'],
+                                                   map(float, np.percentile(isizes,
+                                                       [5, 25, 50, 75, 95])))),
+                            }
+        else:
+            isize_summary = {'n': 0}
+
+        return {'reads': self.n_reads,
+                'mapped': self.n_mapped,
+                'unmapped': self.n_unmapped,
+                'proper pair': self.n_proper_pair,
+                'mapped per reference': self.n_mapped_reference,
+                'insert size': isize_summary,
+               }
+
+
+
+# Functions
+def get_bam_statistics_filename(bamfilename):
+    '''Get the filename of the statistics of a BAM file'''
+    return bamfilename+'.stats.json'
+
+
+def _get_file_signature(bamfilename):
+    '''Size and modification time of a file, to tell whether it changed'''
+    st = os.stat(bamfilename)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def compute_bam_statistics_open(bamfile, stride=2000):
+    '''Compute the statistics of an open BAM file in a single scan
+
+    Parameters:
+       stride (int): store the virtual offset of every stride-th read, to
+       allow random access to the reads (and, if even, to the read pairs)
+    '''
+    refnames = bamfile.references
+    is_bam = getattr(bamfile, 'is_bam', False)
+    stats = BamStatistics()
+    offsets = []
+    while True:
+        if is_bam and not (stats.n_reads % stride):
+            offset = bamfile.tell()
+
+        try:
+            read = next(bamfile)
+        except StopIteration:
+            break
+
+        if is_bam and not (stats.n_reads % stride):
+            offsets.append(offset)
+
+        if read.tid >= 0:
+            stats.add(read, refnames[read.tid])
+        else:
+            stats.add(read)
+
+    stats = stats.to_dict()
+    if is_bam:
+        stats['read offsets'] = {'stride': stride, 'offsets': offsets}
+    return stats
+
+
+def write_bam_statistics(bamfilename, stats=None, VERBOSE=0):
+    '''Write the statistics sidecar of a BAM file
+
+    Parameters:
+       stats (dict): statistics to write, computed from the file if None
+
+    Call this right after writing the BAM file, as the sidecar is valid only
+    as long as the file size and modification time are unchanged.
+    '''
+    import pysam
+
+    if stats is None:
+        with pysam.Samfile(bamfilename, 'rb') as bamfile:
+            stats = compute_bam_statistics_open(bamfile)
+
+    stats = dict(stats)
+    stats['file'] = _get_file_signature(bamfilename)
+
+    fn = get_bam_statistics_filename(bamfilename)
+    try:
+        with open(fn+'.tmp', 'w') as f:
+            json.dump(stats, f)
+        os.rename(fn+'.tmp', fn)
+    except (IOError, OSError):
+        if VERBOSE >= 1:
+            print 'Could not write BAM statistics:', fn
+    else:
+        if VERBOSE >= 2:
+            print 'BAM statistics written:', fn
+
+    return stats
+
+
+def read_bam_statistics(bamfilename):
+    '''Read the statistics sidecar of a BAM file
+
+    Returns:
+       stats (dict or None): None if the sidecar is missing or out of date
+    '''
+    fn = get_bam_statistics_filename(bamfilename)
+    if not os.path.isfile(fn):
+        return None
+
+    try:
+        with open(fn, 'r') as f:
+            stats = json.load(f)
+    except ValueError:
+        return None
+
+    if stats.get('file') != _get_file_signature(bamfilename):
+        return None
+
+    return stats
+
+
+def get_bam_statistics(bamfilename, VERBOSE=0):
+    '''Get the statistics of a BAM file, rebuilding the sidecar if needed'''
+    stats = read_bam_statistics(bamfilename)
+    if stats is None:
+        if VERBOSE >= 2:
+            print 'Scanning BAM file for statistics:', bamfilename
+        stats = write_bam_statistics(bamfilename, VERBOSE=VERBOSE)
+    return stats
+
+
+def get_bam_statistics_open(bamfile, VERBOSE=0):
+    '''Get the statistics of an open BAM file, scanning it only if needed
+
+    The file is reset to the start if it was scanned.
+    '''
+    bamfilename = getattr(bamfile, 'filename', None)
+    is_bam = getattr(bamfile, 'is_bam', False)
+    if is_bam and bamfilename and os.path.isfile(bamfilename):
+        stats = read_bam_statistics(bamfilename)
+        if stats is not None:
+            return stats
+
+    offset = bamfile.tell() if is_bam else None
+    stats = compute_bam_statistics_open(bamfile)
+    bamfile.reset()
+
+    # Store the statistics only if the whole file was scanned
+    if is_bam and bamfilename and os.path.isfile(bamfilename) and \
+       (offset == bamfile.tell()):
+        stats = write_bam_statistics(bamfilename, stats=stats, VERBOSE=VERBOSE)
+    return stats
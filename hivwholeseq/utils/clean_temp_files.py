@@ -21,6 +21,9 @@ def remove_premapped_tempfiles(data_folder, adaID, VERBOSE=0):
           glob.glob(dirname+'premapped_*unsorted*')  
     fns.append(dirname+'premapped.sam')
     for fn in fns:
+        # Single thread mappings pipe into BAM and leave no SAM behind
+        if not os.path.isfile(fn):
+            continue
         os.remove(fn)
         if VERBOSE >= 3:
             print 'File removed:', fn
@@ -39,6 +42,8 @@ def remove_mapped_tempfiles(data_folder, adaID, fragment='F', VERBOSE=0, rescue=
         fns.append(dirname+fragment+'_rescue.sam')
 
     for fn in fns:
+        if not os.path.isfile(fn):
+            continue
         os.remove(fn)
         if VERBOSE >= 3:
             print 'File removed:', fn
@@ -0,0 +1,409 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Batch filter of mapped read pairs. Chunks of pairs are decoded into
+            flat arrays, their distance from the reference (mismatches plus
+            indels) is computed in one step per chunk, and the pairs are
+            classified in bulk (unmapped, unpaired, mismapped_edge, mutator,
+            suspect, bad_cigar, tiny, good). Several input BAM files can be
+            filtered by a pool of processes, one file per worker.
+'''
+# Modules
+import os
+from collections import Counter
+from itertools import islice, izip
+import numpy as np
+
+
+
+
+# Globals
+pair_types = ('unmapped', 'unpaired', 'mismapped_edge', 'mutator', 'suspect',
+              'bad_cigar', 'tiny', 'good')
+
+
+
+# Functions
+def get_reference_codes(ref):
+    '''Get the reference as an array of ASCII codes'''
+    if isinstance(ref, basestring):
+        return np.fromstring(ref, np.uint8)
+    return np.fromstring(''.join(ref), np.uint8)
+
+
+def get_distance_from_consensus_batch(ref, reads, threshold=None):
+    '''Get the number of mismatches (ins = 1, del = 1) from reference for many reads
+
+    Parameters:
+       ref (ndarray or str): the reference
+       reads (list): the reads
+       threshold (int): count only mismatches with at least this phred quality
+
+    Returns:
+       ds (ndarray): the distance of each read, as get_distance_from_consensus
+    '''
+    refc = get_reference_codes(ref)
+    n_reads = len(reads)
+
+    # Collect the match blocks as (start in the concatenated reads, start in
+    # the reference, length), and count the indels directly
+    seqs = []
+    quals = []
+    blocks = []
+    offsets = np.zeros(n_reads + 1, int)
+    ds = np.zeros(n_reads, int)
+    for ir, read in enumerate(reads):
+        offset = offsets[ir]
+        pos_ref = read.pos
+        pos_read = 0
+        for (bt, bl) in read.cigar:
+            if bt == 1:
+                ds[ir] += 1
+                pos_read += bl
+            elif bt == 2:
+                ds[ir] += 1
+                pos_ref += bl
+            elif bt == 0:
+                blocks.append((offset + pos_read, pos_ref, bl))
+                pos_ref += bl
+                pos_read += bl
+        seq = read.seq
+        seqs.append(seq)
+        if threshold is not None:
+            quals.append(read.qual)
+        offsets[ir + 1] = offset + len(seq)
+
+    if not blocks:
+        return ds
+
+    # Map each base of the concatenated reads onto the reference: within a
+    # match block the shift between read and reference is constant, so both
+    # the shift and the match mask are cumulative sums of changes at the block
+    # edges (no per-base expansion of the blocks)
+    n_bases = offsets[-1]
+    blocks = np.array(blocks, int)
+    starts = blocks[:, 0]
+    ends = starts + blocks[:, 2]
+    shifts = blocks[:, 1] - starts
+    shifts[1:] -= shifts[:-1].copy()
+    edges = np.zeros(n_bases + 1, np.int8)
+    edges[starts] += 1
+    edges[ends] -= 1
+    is_match = np.cumsum(edges[:n_bases], dtype=np.int8).astype(bool)
+    ind_ref = np.zeros(n_bases, int)
+    ind_ref[starts] = shifts
+    ind_ref = np.cumsum(ind_ref, out=ind_ref)
+    ind_ref += np.arange(n_bases)
+
+    # Bases beyond the end of the reference are mismatches
+    in_ref = ind_ref < len(refc)
+    seqc = np.fromstring(''.join(seqs), np.uint8)
+    diffs = seqc != refc[np.where(in_ref, ind_ref, 0)]
+    diffs |= ~in_ref
+    diffs &= is_match
+    if threshold is not None:
+        diffs &= (np.fromstring(''.join(quals), np.int8) - 33) >= threshold
+
+    # Sum by read (reduceat needs nonempty reads)
+    ind = (offsets[1:] > offsets[:-1]).nonzero()[0]
+    ds[ind] += np.add.reduceat(diffs, offsets[ind], dtype=int)
+    return ds
+
+
+def check_overhanging_pairs(pairs, refl):
+    '''Check for reads overhanging beyond the fragment edges, for many pairs'''
+    skip = np.zeros(len(pairs), bool)
+    for ip, reads in enumerate(pairs):
+        for read in reads:
+            cigar = read.cigar
+            if ((read.pos == 0) and (cigar[0][0] == 1)):
+                skip[ip] = True
+                break
+            if cigar[-1][0] == 1:
+                read_end = read.pos + sum(bl for (bt, bl) in cigar if bt != 1)
+                if read_end == refl:
+                    skip[ip] = True
+                    break
+    return skip
+
+
+def trim_pair_short_cigars(reads, match_len_min=30, trim_bad_cigars=3):
+    '''Trim short CIGARs from the edges of a pair, True if the pair is to skip'''
+    from hivwholeseq.utils.mapping import trim_short_cigars_pair
+    return trim_short_cigars_pair(reads, match_len_min=match_len_min,
+                                  trim_pad=trim_bad_cigars, throw=False)
+
+
+def filter_read_pairs_batch(pairs, ref,
+                            hist_distance_from_consensus=None,
+                            hist_dist_along=None,
+                            binsize=200,
+                            max_mismatches=100,
+                            susp_mismatches=None,
+                            check_suspect=None,
+                            check_edges=False,
+                            trim_pair=trim_pair_short_cigars,
+                            match_len_min=30,
+                            trim_bad_cigars=3,
+                            read_len_min=None,
+                            isize_min=None,
+                            VERBOSE=0):
+    '''Classify a batch of read pairs
+
+    Parameters:
+       pairs (list): the read pairs, which are trimmed in place if good
+       ref (ndarray or str): the reference
+       hist_distance_from_consensus (ndarray): histogram of distances to update
+       hist_dist_along (ndarray): histogram of distances along the reference,
+       in bins of binsize, to update
+       max_mismatches (int): pairs further from the reference are 'mutator'
+       susp_mismatches (int): pairs further from the reference are 'suspect'
+       if check_suspect(reads) is True (or if check_suspect is None)
+       check_edges (bool): pairs with insertions at the reference edges are
+       'mismapped_edge'
+       trim_pair (callable): trim a pair, returns True if the pair is to skip
+       ('bad_cigar'), called as trim_pair(reads, match_len_min, trim_bad_cigars)
+       read_len_min (int): pairs with a shorter read after trimming are 'tiny'
+       isize_min (int): pairs with a shorter insert after trimming are 'tiny'
+
+    Returns:
+       pair_types (list): the type of each pair
+    '''
+    n_pairs = len(pairs)
+    if not n_pairs:
+        return []
+
+    types = np.repeat('good', n_pairs).astype('S14')
+
+    # Check names to make sure we are looking at paired reads, this would
+    # screw up the whole bamfile
+    for reads in pairs:
+        if reads[0].qname != reads[1].qname:
+            raise ValueError('Read pair '+reads[0].qname+': reads have different names!')
+
+    # Ignore unmapped and not properly paired reads (this includes mates
+    # sitting on different fragments)
+    flags = np.array([(r1.is_unmapped, r2.is_unmapped,
+                       r1.is_proper_pair, r2.is_proper_pair)
+                      for (r1, r2) in pairs], bool, ndmin=2)
+    is_unmapped = flags[:, 0] | flags[:, 1]
+    types[is_unmapped] = 'unmapped'
+    types[(~is_unmapped) & ~(flags[:, 2] & flags[:, 3])] = 'unpaired'
+
+    # Mismappings are sometimes at fragment edges
+    if check_edges:
+        ind = (types == 'good').nonzero()[0]
+        edge = check_overhanging_pairs([pairs[i] for i in ind], len(ref))
+        types[ind[edge]] = 'mismapped_edge'
+
+    # Mismappings are often characterized by many mutations
+    ind = (types == 'good').nonzero()[0]
+    if len(ind):
+        reads = [read for i in ind for read in pairs[i]]
+        dc = get_distance_from_consensus_batch(ref, reads).reshape((len(ind), 2))
+        dcs = dc.sum(axis=1)
+
+        if hist_distance_from_consensus is not None:
+            n_hist = len(hist_distance_from_consensus)
+            if dcs.max() >= n_hist:
+                raise IndexError('Distance from consensus beyond the histogram')
+            hist_distance_from_consensus += np.bincount(dcs, minlength=n_hist)
+
+        if hist_dist_along is not None:
+            i_fwd = np.array([pairs[i][0].is_reverse for i in ind], int)
+            posf = np.array([pairs[i][j].pos for (i, j) in izip(ind, i_fwd)], int)
+            isizef = np.array([pairs[i][j].isize for (i, j) in izip(ind, i_fwd)], int)
+            hbins = (posf + isizef // 2) // binsize
+            np.add.at(hist_dist_along, (hbins, dcs), 1)
+
+        is_mutator = dcs > max_mismatches
+        types[ind[is_mutator]] = 'mutator'
+        if VERBOSE >= 2:
+            for i in ind[is_mutator]:
+                print 'Read pair '+pairs[i][0].qname+': too many mismatches'
+
+        # Check for contamination from other PCR plates: only the few
+        # suspicious pairs are checked one by one
+        if susp_mismatches is not None:
+            for i in ind[(~is_mutator) & (dcs > susp_mismatches)]:
+                if (check_suspect is None) or check_suspect(pairs[i]):
+                    types[i] = 'suspect'
+
+    # Trim the bad CIGARs from the sides, if there are any good ones
+    if trim_pair is not None:
+        for i in (types == 'good').nonzero()[0]:
+            if trim_pair(pairs[i], match_len_min=match_len_min,
+                         trim_bad_cigars=trim_bad_cigars):
+                types[i] = 'bad_cigar'
+
+    # Check the reads and inserts are still long enough after trimming
+    if (read_len_min is not None) or (isize_min is not None):
+        ind = (types == 'good').nonzero()[0]
+        if len(ind):
+            if read_len_min is not None:
+                lens = np.array([[len(read.seq) for read in pairs[i]] for i in ind], int)
+                types[ind[(lens < read_len_min).any(axis=1)]] = 'tiny'
+            if isize_min is not None:
+                isizef = np.array([pairs[i][pairs[i][0].is_reverse].isize for i in ind], int)
+                types[ind[isizef < isize_min]] = 'tiny'
+
+    if VERBOSE >= 2:
+        for (reads, pair_type) in izip(pairs, types):
+            if pair_type not in ('good', 'mutator'):
+                print 'Read pair '+reads[0].qname+': '+pair_type
+
+    return types.tolist()
+
+
+def filter_read_pairs_bam(bamfile, outfile, trashfile, ref,
+                          suspfile=None,
+                          maxreads=-1,
+                          chunksize=10000,
+                          hist_distance_from_consensus=None,
+                          hist_dist_along=None,
+                          VERBOSE=0,
+                          **kwargs):
+    '''Filter the read pairs of an open BAM file, chunk by chunk
+
+    Parameters:
+       bamfile (Samfile): the input, with pairs interleaved
+       outfile, trashfile, suspfile (Samfile): outputs for good, bad, and
+       suspect pairs (suspect pairs go to the trash if suspfile is None)
+       maxreads (int): maximal number of pairs to filter (-1 for all)
+       **kwargs: passed down to filter_read_pairs_batch
+
+    Returns:
+       counts (Counter): number of pairs of each type
+    '''
+    from hivwholeseq.utils.mapping import pair_generator
+
+    pairs_iter = pair_generator(bamfile)
+    if maxreads != -1:
+        pairs_iter = islice(pairs_iter, maxreads)
+
+    counts = Counter()
+    while True:
+        pairs = list(islice(pairs_iter, chunksize))
+        if not pairs:
+            break
+
+        types = filter_read_pairs_batch(pairs, ref,
+                                        hist_distance_from_consensus=hist_distance_from_consensus,
+                                        hist_dist_along=hist_dist_along,
+                                        VERBOSE=VERBOSE,
+                                        **kwargs)
+        counts.update(types)
+        for (reads, pair_type) in izip(pairs, types):
+            if pair_type == 'good':
+                f = outfile
+            elif (pair_type == 'suspect') and (suspfile is not None):
+                f = suspfile
+            else:
+                f = trashfile
+            f.write(reads[0])
+            f.write(reads[1])
+
+        if VERBOSE >= 2:
+            print 'Pairs filtered:', sum(counts.itervalues()), 'good:', counts['good']
+
+    return counts
+
+
+def _filter_read_pairs_shard(args):
+    '''Filter one input BAM file into its own output files (for the pool)'''
+    import pysam
+
+    (infilename, outfilename, trashfilename, ref, n_hist, shape_along, kwargs) = args
+
+    hist = np.zeros(n_hist, int)
+    hist_along = np.zeros(shape_along, int)
+    with pysam.Samfile(infilename, 'rb') as bamfile, \
+         pysam.Samfile(outfilename, 'wb', template=bamfile) as outfile, \
+         pysam.Samfile(trashfilename, 'wb', template=bamfile) as trashfile:
+        counts = filter_read_pairs_bam(bamfile, outfile, trashfile, ref,
+                                       hist_distance_from_consensus=hist,
+                                       hist_dist_along=hist_along,
+                                       **kwargs)
+    return (counts, hist, hist_along)
+
+
+def filter_read_pairs_bams(infilenames, outfilename, trashfilename, ref,
+                           hist_distance_from_consensus,
+                           hist_dist_along,
+                           threads=1,
+                           VERBOSE=0,
+                           **kwargs):
+    '''Filter the read pairs of several BAM files into one output
+
+    Parameters:
+       infilenames (list): input BAM files, in the order of the output
+       hist_distance_from_consensus, hist_dist_along (ndarray): histograms
+       to update
+       threads (int): number of worker processes; each filters one input file
+       into temporary outputs, which are then concatenated in input order
+       **kwargs: passed down to filter_read_pairs_bam
+
+    Returns:
+       counts (Counter): number of pairs of each type
+
+    The output is the same for any number of threads.
+    '''
+    import pysam
+
+    counts = Counter()
+    threads = min(threads, len(infilenames))
+    if threads <= 1:
+        with pysam.Samfile(infilenames[0], 'rb') as bamfile:
+            with pysam.Samfile(outfilename, 'wb', template=bamfile) as outfile, \
+                 pysam.Samfile(trashfilename, 'wb', template=bamfile) as trashfile:
+                for infilename in infilenames:
+                    if VERBOSE >= 2:
+                        print 'Filtering:', infilename
+                    with pysam.Samfile(infilename, 'rb') as bamfile:
+                        counts += filter_read_pairs_bam(bamfile, outfile, trashfile, ref,
+                                                        hist_distance_from_consensus=hist_distance_from_consensus,
+                                                        hist_dist_along=hist_dist_along,
+                                                        VERBOSE=VERBOSE,
+                                                        **kwargs)
+        return counts
+
+    from multiprocessing import Pool
+
+    kwargs['VERBOSE'] = VERBOSE
+    shards = [(infilename,
+               outfilename[:-4]+'_shard'+str(i+1)+'.bam',
+               trashfilename[:-4]+'_shard'+str(i+1)+'.bam',
+               ref,
+               len(hist_distance_from_consensus),
+               hist_dist_along.shape,
+               kwargs)
+              for i, infilename in enumerate(infilenames)]
+
+    pool = Pool(processes=threads)
+    try:
+        results = pool.map(_filter_read_pairs_shard, shards, chunksize=1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    try:
+        for (counts_shard, hist, hist_along) in results:
+            counts += counts_shard
+            hist_distance_from_consensus += hist
+            hist_dist_along += hist_along
+
+        # The header of the first input is the template, as for one thread
+        for (fn_out, ishard) in ((outfilename, 1), (trashfilename, 2)):
+            args = ['-h', infilenames[0], '-o', fn_out] + [shard[ishard] for shard in shards]
+            pysam.cat(*args, catch_stdout=False)
+    finally:
+        for shard in shards:
+            for fn in shard[1:3]:
+                if os.path.isfile(fn):
+                    os.remove(fn)
+
+    return counts
@@ -0,0 +1,118 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Index of the k-mers of a set of sequences, to find quickly which of
+            them share most k-mers with a query (e.g. a read).
+'''
+# Modules
+from __future__ import absolute_import
+import numpy as np
+
+
+
+# Globals
+_nuc_codes = np.zeros(256, np.int64) - 1
+for _i, _a in enumerate('ACGT'):
+    _nuc_codes[ord(_a)] = _i
+    _nuc_codes[ord(_a.lower())] = _i
+
+
+
+# Functions
+def get_kmer_codes(seq, k):
+    '''Get the unique k-mers of a sequence as integers (2 bits per nucleotide)
+
+    K-mers including anything else than ACGT are skipped. The sequence can be
+    a string, a Bio.Seq or a Bio.SeqRecord.
+    '''
+    # str of a SeqRecord is its summary, not the sequence
+    seq = getattr(seq, 'seq', seq)
+    seq = np.fromstring(str(seq), np.uint8)
+    if len(seq) < k:
+        return np.zeros(0, np.int64)
+
+    codes = _nuc_codes[seq]
+    n = len(seq) - k + 1
+
+    # A k-mer is valid if no ambiguous nucleotide falls in it
+    bad = np.concatenate([[0], np.cumsum(codes < 0)])
+    valid = (bad[k:] - bad[:n]) == 0
+
+    kmers = np.zeros(n, np.int64)
+    codes = np.maximum(codes, 0)
+    for i in xrange(k):
+        kmers <<= 2
+        kmers |= codes[i: i + n]
+
+    return np.unique(kmers[valid])
+
+
+
+# Classes
+class KmerIndex(object):
+    '''Index of the k-mers of a set of named sequences'''
+
+    def __init__(self, seqs, k=12):
+        '''Build the index
+
+        Parameters:
+           seqs (dict): name -> sequence
+           k (int): k-mer length (at most 31)
+        '''
+        if not (0 < k < 32):
+            raise ValueError('k must be between 1 and 31')
+
+        self.k = k
+        self.names = list(seqs.keys())
+        self._name_ids = {name: i for i, name in enumerate(self.names)}
+
+        kmers = [get_kmer_codes(seqs[name], k) for name in self.names]
+        ids = np.repeat(np.arange(len(self.names)), map(len, kmers))
+        if len(kmers):
+            kmers = np.concatenate(kmers)
+        else:
+            kmers = np.zeros(0, np.int64)
+        ind = np.argsort(kmers, kind='mergesort')
+        self._kmers = kmers[ind]
+        self._ids = ids[ind]
+
+
+    def get_scores(self, seq):
+        '''Number of distinct k-mers shared by a query with each sequence'''
+        query = get_kmer_codes(seq, self.k)
+        start = np.searchsorted(self._kmers, query, side='left')
+        end = np.searchsorted(self._kmers, query, side='right')
+        lengths = end - start
+
+        # Concatenate the ranges [start, end) of all query k-mers
+        n_hits = lengths.sum()
+        if not n_hits:
+            return np.zeros(len(self.names), int)
+        offsets = np.repeat(start - np.cumsum(lengths) + lengths, lengths)
+        ind = offsets + np.arange(n_hits)
+        return np.bincount(self._ids[ind], minlength=len(self.names))
+
+
+    def get_candidates(self, seq, n=5, names=None):
+        '''Get the sequences that share most k-mers with a query
+
+        Parameters:
+           n (int): maximal number of candidates
+           names (iterable): consider only these sequences (default: all)
+
+        Returns:
+           candidates (list): names of the candidates, best first
+        '''
+        scores = self.get_scores(seq)
+        if names is None:
+            ids = np.arange(len(self.names))
+        else:
+            ids = np.array([self._name_ids[name] for name in names], int)
+
+        if not len(ids):
+            return []
+
+        # Stable sort: ties are broken by order in the index
+        ids = ids[np.argsort(-scores[ids], kind='mergesort')][:n]
+        return [self.names[i] for i in ids]
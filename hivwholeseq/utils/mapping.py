@@ -5,12 +5,16 @@ date:       22/08/13
 content:    Settings of stampy used by our mapping scripts.
 '''
 # Modules
+import os
 from .sequence import align_muscle
 
 # Globals
 from hivwholeseq.sequencing.filenames import stampy_bin, bwa_bin, spades_bin
 subsrate = '0.05'
 
+# Threads for the BGZF compression and sorting of BAM files
+bam_threads_env = 'HIVWHOLESEQ_BAM_THREADS'
+
 
 
 # Functions
@@ -230,36 +234,52 @@ def fix_read_pair(reads):
 
 
 def trim_short_cigars_pair(reads, **kwargs):
-    '''Trim short cigars from both reads of a pair and fix isize'''
+    '''Trim short cigars from both reads of a pair and fix isize
+
+    With throw=False, return True if either read could not be trimmed.
+    '''
     for read in reads:
-        trim_short_cigars(read, **kwargs)
+        if trim_short_cigars(read, **kwargs):
+            return True
     fix_read_pair(reads)
+    if kwargs.get('throw', True) is False:
+        return False
+
+
+def get_bam_threads(threads=None):
+    '''Get the number of threads for BAM compression and sorting
+
+    The default is taken from the environment variable HIVWHOLESEQ_BAM_THREADS,
+    or 1 if not set.
+    '''
+    if threads is None:
+        threads = int(os.getenv(bam_threads_env, 1))
+    return max(1, threads)
+
 
+def _get_samtools_threads_args(threads=None):
+    '''Get the samtools -@ option (threads on top of the main one)'''
+    return ['-@', str(get_bam_threads(threads) - 1)]
 
-def convert_sam_to_bam(bamfilename, samfilename=None):
-    '''Convert SAM file to BAM file format'''
+
+def convert_sam_to_bam(bamfilename, samfilename=None, threads=None):
+    '''Convert SAM file to BAM file format (native, multithreaded compression)'''
     import pysam
     if samfilename is None:
         samfilename = bamfilename[:-3]+'sam'
 
-    samfile = pysam.Samfile(samfilename, 'r')
-    bamfile = pysam.Samfile(bamfilename, 'wb', template=samfile)
-    for s in samfile: bamfile.write(s)
-    samfile.close()
-    bamfile.close()
+    args = ['-b'] + _get_samtools_threads_args(threads) + ['-o', bamfilename, samfilename]
+    pysam.view(*args, catch_stdout=False)
 
 
-def convert_bam_to_sam(samfilename, bamfilename=None):
-    '''Convert BAM file to SAM file format'''
+def convert_bam_to_sam(samfilename, bamfilename=None, threads=None):
+    '''Convert BAM file to SAM file format (native, multithreaded decompression)'''
     import pysam
     if bamfilename is None:
         bamfilename = samfilename[:-3]+'bam'
 
-    bamfile = pysam.Samfile(bamfilename, 'rb')
-    samfile = pysam.Samfile(samfilename, 'w', template=bamfile)
-    for s in bamfile: samfile.write(s)
-    bamfile.close()
-    samfile.close()
+    args = ['-h'] + _get_samtools_threads_args(threads) + ['-o', samfilename, bamfilename]
+    pysam.view(*args, catch_stdout=False)
 
 
 def get_fragment_list(data_folder, adaID):
@@ -322,14 +342,22 @@ def reads_to_seqrecord(reads):
     return seqs
 
 
-def sort_bam(bamfilename_sorted, bamfilename_unsorted=None):
-    '''Sort BAM file'''
+def sort_bam(bamfilename_sorted, bamfilename_unsorted=None, by_name=False,
+             threads=None):
+    '''Sort BAM file
+
+    Parameters:
+       by_name (bool): sort by read name instead of coordinate
+       threads (int): threads for sorting and compression
+    '''
     import pysam
 
     if bamfilename_unsorted is None:
         bamfilename_unsorted = bamfilename_sorted[:-11]+'.bam'
 
-    pysam.sort(bamfilename_unsorted, bamfilename_sorted[:-4])
+    args = (['-n'] if by_name else []) + _get_samtools_threads_args(threads)
+    args = args + ['-o', bamfilename_sorted, bamfilename_unsorted]
+    pysam.sort(*args, catch_stdout=False)
 
 
 def index_bam(bamfilename_sorted):
@@ -339,6 +367,174 @@ def index_bam(bamfilename_sorted):
     pysam.index(bamfilename_sorted)
 
 
+def convert_sam_to_bam_sorted_name(bamfilename, samfilename=None, threads=None):
+    '''Convert SAM file to BAM file format, sorting the reads by name'''
+    if samfilename is None:
+        samfilename = bamfilename[:-3]+'sam'
+
+    sort_bam(bamfilename, samfilename, by_name=True, threads=threads)
+
+
+def merge_bam_sorted_name(bamfilename, bamfilenames_parts, threads=None):
+    '''Merge BAM files sorted by read name into one, in a single stream
+
+    The header is taken from the first file.
+    '''
+    import pysam
+
+    args = ['-n', '-f'] + _get_samtools_threads_args(threads)
+    args = args + [bamfilename] + list(bamfilenames_parts)
+    pysam.merge(*args, catch_stdout=False)
+
+
+def get_samtools_command(args):
+    '''Get the command line of samtools, as bundled with pysam'''
+    import sys
+    return [sys.executable, '-c',
+            'import sys, pysam; '+\
+            'getattr(pysam, sys.argv[1])(*sys.argv[2:], catch_stdout=False)'] + \
+           map(str, args)
+
+
+def map_to_bam(call_list, bamfilename, sort_by_name=True, threads=None, VERBOSE=0):
+    '''Run a mapper and pipe its SAM output into a compressed BAM file
+
+    Parameters:
+       call_list (list): command line of the mapper, writing SAM to stdout
+       bamfilename (str): output BAM file
+       sort_by_name (bool): sort the reads by name (else keep the mapper order)
+       threads (int): threads for sorting and compression
+
+    No uncompressed SAM file is written to disk.
+    '''
+    import subprocess as sp
+
+    if sort_by_name:
+        args = ['sort', '-n']
+    else:
+        args = ['view', '-b']
+    args = args + _get_samtools_threads_args(threads) + ['-o', bamfilename, '-']
+
+    call_list = map(str, call_list)
+    if VERBOSE >= 2:
+        print ' '.join(call_list), '|', 'samtools', ' '.join(args)
+
+    mapper = sp.Popen(call_list, stdout=sp.PIPE)
+    converter = sp.Popen(get_samtools_command(args), stdin=mapper.stdout)
+    # Let the mapper get SIGPIPE if the converter dies
+    mapper.stdout.close()
+    converter.wait()
+    mapper.wait()
+
+    if mapper.returncode:
+        raise RuntimeError('Mapper failed: '+' '.join(call_list))
+    if converter.returncode:
+        raise RuntimeError('SAM to BAM conversion failed: '+bamfilename)
+
+
+def _convert_sam_to_bam_python(bamfilename, samfilename):
+    '''Convert SAM file to BAM file format read by read (for benchmarks)'''
+    import pysam
+    with pysam.Samfile(samfilename, 'r') as samfile:
+        with pysam.Samfile(bamfilename, 'wb', template=samfile) as bamfile:
+            for read in samfile:
+                bamfile.write(read)
+
+
+def benchmark_sam_to_bam(samfilename, threads_list=(1, 2, 4), VERBOSE=0):
+    '''Benchmark the conversion of a SAM file (e.g. a stampy output) to BAM
+
+    Returns:
+       results (list): (method, seconds, bytes written to and read from disk)
+       for the conversion read by read, the native conversion, and the pipe
+       from the mapper (simulated by cat) into a name-sorted BAM
+    '''
+    import time
+    import shutil
+    import tempfile
+
+    size_sam = os.stat(samfilename).st_size
+    folder = tempfile.mkdtemp()
+    bamfilename = os.path.join(folder, 'benchmark.bam')
+    results = []
+    try:
+        def run(method, func, *args, **kwargs):
+            t0 = time.time()
+            func(*args, **kwargs)
+            t = time.time() - t0
+            # The mapper output is written to and read from disk, unless piped
+            size_io = os.stat(bamfilename).st_size
+            if not method.startswith('pipe'):
+                size_io += 2 * size_sam
+            results.append((method, t, size_io))
+            if VERBOSE >= 2:
+                print method, 'done in', t, 's'
+
+        run('python', _convert_sam_to_bam_python, bamfilename, samfilename)
+        for threads in threads_list:
+            run('native, threads '+str(threads), convert_sam_to_bam,
+                bamfilename, samfilename, threads=threads)
+        for threads in threads_list:
+            run('native + sort, threads '+str(threads), convert_sam_to_bam_sorted_name,
+                bamfilename, samfilename, threads=threads)
+            run('pipe + sort, threads '+str(threads), map_to_bam,
+                ['cat', samfilename], bamfilename, threads=threads)
+    finally:
+        shutil.rmtree(folder)
+
+    return results
+
+
+def merge_mapped_parts(job_IDs, bamfilenames_parts, bamfilename, threads=1,
+                       interval=None, VERBOSE=0):
+    '''Collect the parts of a multithread mapping as soon as their jobs finish
+
+    Parameters:
+       job_IDs (list): IDs of the mapping jobs, one per part
+       bamfilenames_parts (list): BAM files of the parts (the mapper writes the
+       SAM files with the same name)
+       bamfilename (str): output BAM file, sorted by read name
+       threads (int): number of parts to convert at the same time
+       interval (float): seconds between checks of the job statuses
+
+    Each SAM part is converted to a name-sorted BAM in a pool of processes as
+    soon as its job is done, while the other jobs are still running; the parts
+    are then merged into the output without an unsorted intermediate file.
+    '''
+    import multiprocessing as mp
+    from hivwholeseq.cluster.executor import iter_finished
+
+    parts = {jobid: j for j, jobid in enumerate(job_IDs)}
+    pool = mp.Pool(max(1, min(threads, len(job_IDs))))
+    try:
+        results = []
+        for (jobid, status) in iter_finished(job_IDs, interval=interval,
+                                             VERBOSE=VERBOSE):
+            j = parts[jobid]
+            if status in ('failed', 'killed'):
+                raise RuntimeError('Mapping job '+jobid+' '+status+': part '+\
+                                   str(j+1)+' of '+str(len(job_IDs)))
+
+            if VERBOSE >= 1:
+                print 'Convert mapped reads to BAM for merging: part '+str(j+1)+\
+                      ' of '+str(len(job_IDs))
+            results.append(pool.apply_async(convert_sam_to_bam_sorted_name,
+                                            (bamfilenames_parts[j],)))
+
+        pool.close()
+        for result in results:
+            result.get()
+        pool.join()
+
+    except:
+        pool.terminate()
+        raise
+
+    if VERBOSE >= 1:
+        print 'Merge mapped reads: '+bamfilename
+    merge_bam_sorted_name(bamfilename, bamfilenames_parts)
+
+
 def get_number_reads_fastq_open(handle):
     '''Get the number of reads from a fastq file'''
     from Bio.SeqIO.QualityIO import FastqGeneralIterator as FGI
@@ -351,14 +547,21 @@ def get_number_reads_fastq_open(handle):
 
 def get_number_reads_open(bamfile):
     '''Count the reads (not pairs) in an open BAM/SAM file'''
-    n_reads = sum(1 for read in bamfile)
-    bamfile.reset()
-    return n_reads
+    from .bam_statistics import get_bam_statistics_open
+    return get_bam_statistics_open(bamfile)['reads']
 
 
 def get_number_reads(bamfilename, format='bam'):
-    '''Count the reads (not pairs) in a BAM/SAM file'''
+    '''Count the reads (not pairs) in a BAM/SAM file
+
+    Note: for BAM files, the count is read from the statistics sidecar if up
+    to date, else the file is scanned once and the sidecar written.
+    '''
     import pysam
+    if format == 'bam':
+        from .bam_statistics import get_bam_statistics
+        return get_bam_statistics(bamfilename)['reads']
+
     file_modes = {'bam': 'rb', 'sam': 'r'}
     with pysam.Samfile(bamfilename, file_modes[format]) as bamfile:
         n_reads = get_number_reads_open(bamfile)
@@ -367,14 +570,17 @@ def get_number_reads(bamfilename, format='bam'):
 
 def get_number_unmapped_reads_open(bamfile, format='bam'):
     '''Count the number of unmapped reads (not pairs) in an open BAM/SAM file'''
-    n_reads = sum(1 for read in bamfile if read.is_unmapped)
-    bamfile.reset()
-    return n_reads
+    from .bam_statistics import get_bam_statistics_open
+    return get_bam_statistics_open(bamfile)['unmapped']
 
 
 def get_number_unmapped_reads(bamfilename, format='bam'):
     '''Count the number of unmapped reads (not pairs) in a BAM/SAM file'''
     import pysam
+    if format == 'bam':
+        from .bam_statistics import get_bam_statistics
+        return get_bam_statistics(bamfilename)['unmapped']
+
     file_modes = {'bam': 'rb', 'sam': 'r'}
     with pysam.Samfile(bamfilename, file_modes[format]) as bamfile:
         n_reads = get_number_unmapped_reads_open(bamfile)
@@ -383,223 +589,238 @@ def get_number_unmapped_reads(bamfilename, format='bam'):
 
 def get_number_mapped_reads_open(bamfile, format='bam'):
     '''Count the number of mapped reads (not pairs) in an open BAM/SAM file'''
-    n_reads = sum(1 for read in bamfile if not read.is_unmapped)
-    bamfile.reset()
-    return n_reads
+    from .bam_statistics import get_bam_statistics_open
+    return get_bam_statistics_open(bamfile)['mapped']
 
 
 def get_number_mapped_reads(bamfilename, format='bam'):
     '''Count the number of mapped reads (not pairs) in a BAM/SAM file'''
     import pysam
+    if format == 'bam':
+        from .bam_statistics import get_bam_statistics
+        return get_bam_statistics(bamfilename)['mapped']
+
     file_modes = {'bam': 'rb', 'sam': 'r'}
     with pysam.Samfile(bamfilename, file_modes[format]) as bamfile:
         n_reads = get_number_mapped_reads_open(bamfile)
     return n_reads
 
 
-def extract_mapped_pairs_subsample_open(bamfile_in, n_reads, maxreads=-1, VERBOSE=0):
-    '''Extract random read pairs (pointers) from an open BAM file'''
+def _get_random_state(seed=None):
+    '''Get a random generator, the global numpy one if no seed is given'''
     import numpy as np
+    if seed is None:
+        return np.random
+    return np.random.RandomState(seed)
 
-    n_pairs_tot = get_number_reads_open(bamfile_in) // 2
 
-    if n_pairs_tot <= n_reads:
-        bamfile_in.reset()
-        return pair_generator(bamfile_in)
+def _iter_units(bamfile, pairs=True):
+    '''Iterate over read pairs or reads of an open BAM/SAM file'''
+    if pairs:
+        return pair_generator(bamfile)
+    return iter(bamfile)
 
-    # Limit to the first part of the file
-    if maxreads == -1:
-        maxreads = n_pairs_tot
-    else:
-        maxreads = min(n_pairs_tot, maxreads)
 
-    # Get the random indices of the reads to store
-    ind_store = np.arange(maxreads)
-    np.random.shuffle(ind_store)
-    ind_store = ind_store[:n_reads]
-    ind_store.sort()
+def reservoir_sample(iterable, n, maxitems=-1, seed=None):
+    '''Uniform random sample of n items of an iterable in a single pass
 
-    if VERBOSE >= 2:
-        print 'Random indices between '+str(ind_store[0])+' and '+str(ind_store[-1]),
-        print '(pairs is True)'
+    Returns:
+       sample (list): the items, in the order of the iterable
 
-    output_reads = []
-    n_written = 0
-    for i, (read1, read2) in enumerate(pair_generator(bamfile_in)):
-        if VERBOSE >= 2:
-            if not ((i+1) % 10000):
-                print i+1, n_written, ind_store[n_written]
-    
-        if i == ind_store[n_written]:
-            output_reads.append((read1, read2))
-            n_written += 1
-    
-        if n_written >= n_reads:
+    Note: this is reservoir sampling with geometric skips (Li's algorithm L),
+    which takes O(n) memory and draws random numbers only on replacements.
+    '''
+    from math import exp, log, floor
+
+    rng = _get_random_state(seed)
+    reservoir = []
+    if n <= 0:
+        return reservoir
+
+    it = iter(iterable)
+    i_next = n
+    w = 1.0
+    for i, item in enumerate(it):
+        if i == maxitems:
             break
 
-    bamfile_in.reset()
-    return output_reads
+        if i < n:
+            reservoir.append((i, item))
+            if i == n - 1:
+                w = exp(log(1 - rng.random_sample()) / n)
+                i_next = i + int(floor(log(1 - rng.random_sample()) / log(1 - w))) + 1
+            continue
 
+        if i == i_next:
+            reservoir[rng.randint(n)] = (i, item)
+            w *= exp(log(1 - rng.random_sample()) / n)
+            i_next += int(floor(log(1 - rng.random_sample()) / log(1 - w))) + 1
+
+    reservoir.sort(key=lambda x: x[0])
+    return [item for (i, item) in reservoir]
+
+
+def _sample_indices(n_tot, n, seed=None):
+    '''Sample n distinct integers in [0, n_tot), sorted (Floyd's algorithm)'''
+    rng = _get_random_state(seed)
+    ind = set()
+    for j in xrange(n_tot - n, n_tot):
+        t = rng.randint(j + 1)
+        ind.add(t if t not in ind else j)
+    return sorted(ind)
+
+
+def _sample_seek(bamfile, n, stats, pairs=True, maxreads=-1, seed=None):
+    '''Random sample of reads or pairs via virtual offsets, or None if not possible'''
+    offsets = stats.get('read offsets')
+    if offsets is None:
+        return None
+
+    stride = offsets['stride']
+    offsets = offsets['offsets']
+    unit = 2 if pairs else 1
+    if pairs and (stride % 2):
+        return None
+
+    n_tot = stats['reads'] // unit
+    if maxreads != -1:
+        n_tot = min(n_tot, maxreads)
+
+    # Seeking pays off only if we skip most of the file
+    if (n_tot <= n) or (n * stride > n_tot * unit):
+        return None
+
+    output = []
+    pos = None
+    for ind in _sample_indices(n_tot, n, seed=seed):
+        ind_read = ind * unit
+        ind_check = ind_read // stride
+        if (pos is None) or (pos > ind_read) or (pos < ind_check * stride):
+            bamfile.seek(offsets[ind_check])
+            pos = ind_check * stride
+
+        for k in xrange(ind_read - pos):
+            next(bamfile)
+
+        if pairs:
+            output.append((next(bamfile), next(bamfile)))
+        else:
+            output.append(next(bamfile))
+        pos = ind_read + unit
 
-def extract_mapped_reads_subsample_open(bamfile_in, n_reads, maxreads=-1, VERBOSE=0,
-                                        pairs=True):
-    '''Extract random reads or read pairs (pointers) from an open BAM file'''
-    import numpy as np
+    return output
 
-    if pairs:
-        return extract_mapped_pairs_subsample_open(bamfile_in, n_reads,
-                                                   maxreads=maxreads,
-                                                   VERBOSE=VERBOSE)
-
-    n_reads_tot = get_number_reads_open(bamfile_in)
-    if n_reads_tot <= n_reads:
-        bamfile_in.reset()
-        return bamfile_in
-
-    # Limit to the first part of the file
-    if maxreads == -1:
-        maxreads = n_reads_tot
-    else:
-        maxreads = min(n_reads_tot, maxreads)
 
-    ind_store = np.arange(maxreads)
-    np.random.shuffle(ind_store)
-    ind_store = ind_store[:n_reads]
-    ind_store.sort()
+def sample_reads_open(bamfile, n, pairs=True, maxreads=-1, seed=None, VERBOSE=0):
+    '''Uniform random sample of reads or read pairs from an open BAM/SAM file
 
-    if VERBOSE >= 2:
-        print 'Random indices between '+str(ind_store[0])+' and '+str(ind_store[-1]),
-        print '(pairs is False)'
+    Parameters:
+       n (int): number of reads or read pairs to sample
+       pairs (bool): sample read pairs (the file must have mates next to each other)
+       maxreads (int): sample only from the first maxreads reads/pairs
+       seed (int): seed of the random generator (default: numpy global state)
 
-    output_reads = []
-    n_written = 0
-    for i, read in enumerate(bamfile_in):
+    Returns:
+       sample (list): reads or read pairs, in the order of the file
+
+    If the BAM statistics sidecar is up to date, the reads are picked by random
+    seeks; else, the file is scanned once with reservoir sampling. The file is
+    reset to the start afterwards.
+    '''
+    from .bam_statistics import read_bam_statistics
+
+    output = None
+    bamfilename = getattr(bamfile, 'filename', None)
+    if getattr(bamfile, 'is_bam', False) and bamfilename:
+        import os
+        if os.path.isfile(bamfilename):
+            stats = read_bam_statistics(bamfilename)
+            if stats is not None:
+                output = _sample_seek(bamfile, n, stats, pairs=pairs,
+                                      maxreads=maxreads, seed=seed)
+                if (output is not None) and (VERBOSE >= 2):
+                    print 'Random sample by seeking (pairs is '+str(pairs)+')'
+
+    if output is None:
         if VERBOSE >= 2:
-            if not ((i+1) % 10000):
-                print i+1, n_written, ind_store[n_written]
-    
-        if i == ind_store[n_written]:
-            output_reads.append(read)
-            n_written += 1
-    
-        if n_written >= n_reads:
-            break
+            print 'Random sample by reservoir (pairs is '+str(pairs)+')'
+        output = reservoir_sample(_iter_units(bamfile, pairs=pairs), n,
+                                  maxitems=maxreads, seed=seed)
 
-    bamfile_in.reset()
-    return output_reads
+    bamfile.reset()
+    return output
+
+
+def extract_mapped_pairs_subsample_open(bamfile_in, n_reads, maxreads=-1, VERBOSE=0,
+                                        seed=None):
+    '''Extract random read pairs (pointers) from an open BAM file'''
+    return sample_reads_open(bamfile_in, n_reads, pairs=True, maxreads=maxreads,
+                             seed=seed, VERBOSE=VERBOSE)
+
+
+def extract_mapped_reads_subsample_open(bamfile_in, n_reads, maxreads=-1, VERBOSE=0,
+                                        pairs=True, seed=None):
+    '''Extract random reads or read pairs (pointers) from an open BAM file'''
+    return sample_reads_open(bamfile_in, n_reads, pairs=pairs, maxreads=maxreads,
+                             seed=seed, VERBOSE=VERBOSE)
 
 
 def extract_mapped_reads_subsample_object(input_filename, n_reads,
                                           maxreads=-1,
-                                          VERBOSE=0):
+                                          VERBOSE=0, seed=None):
     '''Extract a subset of read pairs into new objects'''
-    import numpy as np
     import pysam
     file_modes = {'read': {'bam': 'rb', 'sam': 'r'},
                   'write': {'bam': 'wb', 'sam': 'w'}}
     input_format = input_filename[-3:]
 
-    n_reads_tot = get_number_reads(input_filename, input_format) / 2
-
-    # Limit to the first part of the file
-    if maxreads == -1:
-        maxreads = n_reads_tot
-    else:
-        maxreads = min(n_reads_tot, maxreads)
-
-    # Pick random numbers among those
-    # Get the random indices of the reads to store
-    ind_store = np.arange(maxreads)
-    np.random.shuffle(ind_store)
-    ind_store = ind_store[:n_reads]
-    ind_store.sort()
-
-    if VERBOSE >= 2:
-        print 'Random indices between '+str(ind_store[0])+' and '+str(ind_store[-1])
-
     # Copy reads
     output_reads = []
     with pysam.Samfile(input_filename, file_modes['read'][input_format]) as bamfile_in:
-
-            n_written = 0
-            for i, (read1, read2) in enumerate(pair_generator(bamfile_in)):
-
-                if VERBOSE >= 2:
-                    if not ((i+1) % 10000):
-                        print i+1, n_written, ind_store[n_written]
-    
-                # If you hit a read pair, add it
-                if i == ind_store[n_written]:
-
-                    read_pair = []
-                    for read in (read1, read2):
-                        read_new = pysam.AlignedRead()
-                        read_new.qname = read.qname
-                        read_new.seq = read.seq
-                        read_new.qual = read.qual
-                        read_new.flag = read.flag
-                        read_new.pos = read.pos
-                        read_new.mapq = read.mapq
-                        read_new.cigar = read.cigar
-                        read_new.mrnm = read.mrnm
-                        read_new.mpos = read.mpos
-                        read_new.isize = read.isize
-                        read_new.tags = read.tags
-                        read_pair.append(read_new)
-
-                    output_reads.append(read_pair)
-                    n_written += 1
-    
-                # Break after the last one
-                if n_written >= n_reads:
-                    break
+        for (read1, read2) in sample_reads_open(bamfile_in, n_reads, pairs=True,
+                                                maxreads=maxreads, seed=seed,
+                                                VERBOSE=VERBOSE):
+            read_pair = []
+            for read in (read1, read2):
+                read_new = pysam.AlignedRead()
+                read_new.qname = read.qname
+                read_new.seq = read.seq
+                read_new.qual = read.qual
+                read_new.flag = read.flag
+                read_new.pos = read.pos
+                read_new.mapq = read.mapq
+                read_new.cigar = read.cigar
+                read_new.mrnm = read.mrnm
+                read_new.mpos = read.mpos
+                read_new.isize = read.isize
+                read_new.tags = read.tags
+                read_pair.append(read_new)
+
+            output_reads.append(read_pair)
 
     return output_reads
 
 
 def extract_mapped_reads_subsample(input_filename, output_filename, n_reads,
-                                   VERBOSE=0):
+                                   VERBOSE=0, seed=None):
     '''Extract a subset of reads into a new file'''
-    import numpy as np
     import pysam
     file_modes = {'read': {'bam': 'rb', 'sam': 'r'},
                   'write': {'bam': 'wb', 'sam': 'w'}}
     input_format = input_filename[-3:]
     output_format = output_filename[-3:]
 
-    n_reads_tot = get_number_reads(input_filename, input_format) / 2
-
-    # Pick random numbers among those
-    # Get the random indices of the reads to store
-    ind_store = np.arange(int(0.00 * n_reads_tot), int(1 * n_reads_tot))
-    np.random.shuffle(ind_store)
-    ind_store = ind_store[:n_reads]
-    ind_store.sort()
-
-    if VERBOSE >= 2:
-        print 'Random indices between '+str(ind_store[0])+' and '+str(ind_store[-1])
-
     # Copy reads
     with pysam.Samfile(input_filename, file_modes['read'][input_format]) as bamfile_in:
         with pysam.Samfile(output_filename, file_modes['write'][output_format],
                            template=bamfile_in) as bamfile_out:
 
             n_written = 0
-            for i, (read1, read2) in enumerate(pair_generator(bamfile_in)):
-
-                if VERBOSE >= 2:
-                    if not ((i+1) % 10000):
-                        print i+1, n_written, ind_store[n_written]
-    
-                # If you hit a read pair, write it
-                if i == ind_store[n_written]:
-                    bamfile_out.write(read1)
-                    bamfile_out.write(read2)
-                    n_written += 1
-    
-                # Break after the last one
-                if n_written >= n_reads:
-                    break
+            for (read1, read2) in sample_reads_open(bamfile_in, n_reads, pairs=True,
+                                                    seed=seed, VERBOSE=VERBOSE):
+                bamfile_out.write(read1)
+                bamfile_out.write(read2)
+                n_written += 1
 
     return n_written
 
@@ -1069,3 +1290,25 @@ def trim_read_pair_crossoverhangs(read_pair, trim=5, include_tests=False):
             import ipdb; ipdb.set_trace()
 
 
+
+# Script
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark SAM to BAM conversions',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('samfile',
+                        help='SAM file to convert, e.g. a stampy output')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4],
+                        help='Numbers of threads to test')
+    parser.add_argument('--verbose', type=int, default=0,
+                        help='Verbosity level [0-3]')
+
+    args = parser.parse_args()
+
+    results = benchmark_sam_to_bam(args.samfile, threads_list=args.threads,
+                                   VERBOSE=args.verbose)
+    for (method, t, size_io) in results:
+        print '{:<24s}'.format(method), \
+              'time: {:.2f} s'.format(t), \
+              'disk I/O: {:.1f} MB'.format(1e-6 * size_io)
@@ -0,0 +1,312 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Backends for the many small multiple sequence alignments (consensus
+            blocks, local haplotypes): an in-process center-star aligner and
+            batches of concurrent MUSCLE processes.
+'''
+# Modules
+from __future__ import absolute_import
+import os
+import time
+import subprocess as sp
+from itertools import izip
+import numpy as np
+
+from hivwholeseq.utils.kmers import get_kmer_codes
+
+
+
+# Globals
+msa_backends = ('muscle', 'center_star')
+
+
+
+# Functions
+def get_seqrecords(seqs):
+    '''Convert sequences to SeqRecords, if required'''
+    if (not len(seqs)) or (not isinstance(seqs[0], basestring)):
+        return list(seqs)
+
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
+    from Bio.Alphabet import single_letter_alphabet
+    return [SeqRecord(Seq(s, single_letter_alphabet),
+                      id='seq'+str(i+1),
+                      name='seq'+str(i+1),
+                      description='seq'+str(i+1))
+            for i, s in enumerate(seqs)]
+
+
+def sort_alignment(align, seqs):
+    '''Sort the rows of an alignment as the input sequences'''
+    from Bio.Align import MultipleSeqAlignment as MSA
+    alisort = []
+    for seq in seqs:
+        for row in align:
+            if row.id == seq.id:
+                alisort.append(row)
+                break
+    return MSA(alisort)
+
+
+def get_center_index(seqs, k=6):
+    '''Pick the center sequence, i.e. the one sharing most k-mers with the others'''
+    kmers = [get_kmer_codes(seq, k) for seq in seqs]
+    scores = [sum(np.in1d(km, km2, assume_unique=True).sum() for km2 in kmers)
+              for km in kmers]
+    return int(np.argmax(scores))
+
+
+def merge_center_star(center, alis):
+    '''Merge pairwise alignments to a center sequence into an MSA
+
+    Parameters:
+       center (str): the center sequence
+       alis (list): pairwise alignments (center, sequence) as pairs of strings
+
+    Returns:
+       rows (list): the aligned center, then the aligned sequences
+
+    Gaps in the center of any pairwise alignment are gaps in all rows ("once
+    a gap, always a gap"); inserted bases are left-aligned within the gaps.
+    '''
+    L = len(center)
+    n_gaps = np.zeros(L + 1, int)
+    parsed = []
+    for (ali_center, ali_seq) in alis:
+        inserts = [[] for i in xrange(L + 1)]
+        columns = ['-'] * L
+        i = 0
+        for (ac, a) in izip(ali_center, ali_seq):
+            if ac == '-':
+                inserts[i].append(a)
+            else:
+                columns[i] = a
+                i += 1
+        n_gaps = np.maximum(n_gaps, map(len, inserts))
+        parsed.append((inserts, columns))
+
+    rows = [''.join(('-' * n_gaps[i]) + center[i] for i in xrange(L)) + ('-' * n_gaps[L])]
+    for (inserts, columns) in parsed:
+        row = []
+        for i in xrange(L + 1):
+            row.append(''.join(inserts[i]) + ('-' * (n_gaps[i] - len(inserts[i]))))
+            if i < L:
+                row.append(columns[i])
+        rows.append(''.join(row))
+    return rows
+
+
+def align_center_star(seqs, **kwargs):
+    '''Progressive center-star MSA built on pairwise global alignments (in process)
+
+    Parameters:
+       seqs (list): sequences as strings or SeqRecords
+       **kwargs: passed down to seqanpy.align_global
+
+    Returns:
+       ali (MultipleSeqAlignment): rows in the same order as the input
+    '''
+    from seqanpy import align_global
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
+    from Bio.Align import MultipleSeqAlignment as MSA
+
+    seqs = get_seqrecords(seqs)
+    seqstrs = [str(seq.seq) for seq in seqs]
+
+    icenter = get_center_index(seqstrs)
+    center = seqstrs[icenter]
+    alis = []
+    for i, seqstr in enumerate(seqstrs):
+        if i == icenter:
+            alis.append((center, center))
+        else:
+            (score, ali1, ali2) = align_global(center, seqstr, **kwargs)
+            alis.append((ali1, ali2))
+
+    rows = merge_center_star(center, alis)[1:]
+    return MSA([SeqRecord(Seq(row, seq.seq.alphabet), id=seq.id, name=seq.name,
+                          description=seq.description)
+                for (row, seq) in izip(rows, seqs)])
+
+
+def get_muscle_command():
+    '''Get the MUSCLE command line, without a shell'''
+    from Bio.Align.Applications import MuscleCommandline
+    return str(MuscleCommandline(diags=True, quiet=True)).split()
+
+
+def start_muscle(seqs):
+    '''Start a MUSCLE process and feed it the sequences over a pipe'''
+    from Bio import SeqIO
+
+    with open(os.devnull, 'w') as devnull:
+        child = sp.Popen(get_muscle_command(),
+                         stdin=sp.PIPE,
+                         stdout=sp.PIPE,
+                         stderr=devnull)
+    SeqIO.write(seqs, child.stdin, "fasta")
+    child.stdin.close()
+    return child
+
+
+def finish_muscle(child):
+    '''Read the alignment from a MUSCLE process'''
+    from Bio import AlignIO
+
+    align = AlignIO.read(child.stdout, "fasta")
+    child.stdout.close()
+    child.wait()
+    return align
+
+
+def align_muscle_batch(seqs_list, backend=None, threads=1, sort=False, **kwargs):
+    '''Align many small sets of sequences
+
+    Parameters:
+       seqs_list (list): sets of sequences, each as in align_muscle
+       backend (str): 'muscle' or 'center_star' (default: as align_muscle)
+       threads (int): number of MUSCLE processes running at the same time
+       sort (bool): sort the rows of each alignment as the input
+       **kwargs: passed down to the center-star aligner
+
+    Returns:
+       alis (list): one MultipleSeqAlignment per set (None for empty sets)
+    '''
+    from collections import deque
+    from hivwholeseq.utils import sequence
+
+    if backend is None:
+        backend = sequence.msa_backend
+    if backend not in msa_backends:
+        raise ValueError('MSA backend not found: '+str(backend))
+
+    seqs_list = map(get_seqrecords, seqs_list)
+
+    if backend == 'center_star':
+        return [align_center_star(seqs, **kwargs) if len(seqs) else None
+                for seqs in seqs_list]
+
+    # Keep up to threads processes running, collect their alignments in order
+    alis = [None for seqs in seqs_list]
+    running = deque()
+    for i, seqs in enumerate(seqs_list):
+        if not len(seqs):
+            continue
+        if len(running) >= threads:
+            (j, child) = running.popleft()
+            alis[j] = finish_muscle(child)
+        running.append((i, start_muscle(seqs)))
+
+    while running:
+        (j, child) = running.popleft()
+        alis[j] = finish_muscle(child)
+
+    if sort:
+        alis = [sort_alignment(ali, seqs) if ali is not None else None
+                for (ali, seqs) in izip(alis, seqs_list)]
+
+    return alis
+
+
+def get_majority_consensus(ali):
+    '''Get the majority consensus of an alignment, without gaps'''
+    alim = np.array(ali, 'S1', ndmin=2)
+    cons = []
+    for col in alim.T:
+        (alleles, counts) = np.unique(col, return_counts=True)
+        cons.append(alleles[np.argmax(counts)])
+    return ''.join(cons).replace('-', '')
+
+
+def benchmark_msa_backends(seqs_list, backends=msa_backends, threads=1,
+                           reference='muscle', VERBOSE=0):
+    '''Compare alignments and speed of the MSA backends
+
+    Returns:
+       results (dict): for each backend, the time in seconds and the fraction of
+       alignments identical to, or with the same majority consensus as, the
+       reference backend
+    '''
+    alis = {}
+    results = {}
+    for backend in backends:
+        t0 = time.time()
+        alis[backend] = align_muscle_batch(seqs_list, backend=backend,
+                                           threads=threads, sort=True)
+        results[backend] = {'time': time.time() - t0}
+        if VERBOSE >= 2:
+            print backend, 'done in', results[backend]['time'], 's'
+
+    for backend in backends:
+        n_same = 0
+        n_same_cons = 0
+        for (ali, ali_ref) in izip(alis[backend], alis[reference]):
+            rows = [str(row.seq) for row in ali]
+            rows_ref = [str(row.seq) for row in ali_ref]
+            n_same += rows == rows_ref
+            n_same_cons += get_majority_consensus(ali) == get_majority_consensus(ali_ref)
+        results[backend]['identical'] = 1.0 * n_same / len(seqs_list)
+        results[backend]['same consensus'] = 1.0 * n_same_cons / len(seqs_list)
+
+    return results
+
+
+def make_synthetic_blocks(n_blocks=100, n_seqs=31, length=100,
+                          error_rate=0.01, indel_rate=0.002, seed=0):
+    '''Make sets of noisy copies of random sequences, like consensus blocks'''
+    rng = np.random.RandomState(seed)
+    alpha = np.array(list('ACGT'))
+    seqs_list = []
+    for ib in xrange(n_blocks):
+        ref = alpha[rng.randint(4, size=length)]
+        seqs = []
+        for i in xrange(n_seqs):
+            seq = ref.copy()
+            ind = rng.rand(length) < error_rate
+            seq[ind] = alpha[rng.randint(4, size=ind.sum())]
+            seq = list(seq)
+            for pos in sorted((rng.rand(length) < indel_rate).nonzero()[0], reverse=True):
+                if rng.rand() < 0.5:
+                    del seq[pos]
+                else:
+                    seq.insert(pos, alpha[rng.randint(4)])
+            seqs.append(''.join(seq))
+        seqs_list.append(seqs)
+    return seqs_list
+
+
+
+# Script
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark MSA backends',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--n-alignments', type=int, default=100, dest='n_blocks',
+                        help='Number of alignments')
+    parser.add_argument('--n-seqs', type=int, default=31,
+                        help='Number of sequences per alignment')
+    parser.add_argument('--length', type=int, default=100,
+                        help='Length of the sequences')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of MUSCLE processes at the same time')
+    parser.add_argument('--verbose', type=int, default=0,
+                        help='Verbosity level [0-3]')
+
+    args = parser.parse_args()
+
+    seqs_list = make_synthetic_blocks(n_blocks=args.n_blocks,
+                                      n_seqs=args.n_seqs,
+                                      length=args.length)
+    results = benchmark_msa_backends(seqs_list, threads=args.threads,
+                                     VERBOSE=args.verbose)
+    for backend in msa_backends:
+        res = results[backend]
+        print '{:<12s}'.format(backend), \
+              'time: {:.2f} s'.format(res['time']), \
+              'identical: {:.2f}'.format(res['identical']), \
+              'same consensus: {:.2f}'.format(res['same consensus'])
@@ -13,7 +13,7 @@ from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from Bio.Alphabet.IUPAC import ambiguous_dna
 
-from .sequence import alpha, alphaa
+from .sequence import alpha, alphal, alphaa
 from .miseq import read_types
 from .mapping import get_ind_good_cigars
 from .mapping import align_muscle
@@ -86,6 +86,120 @@ def get_allele_counts_read(read, counts_out, inserts_out,
             raise ValueError('CIGAR type '+str(block_type)+' not recognized')
 
 
+def _expand_blocks(starts, lengths):
+    '''Expand a list of (start, length) blocks into a flat array of indices'''
+    ends = np.cumsum(lengths)
+    if not len(ends):
+        return np.zeros(0, int)
+    return np.arange(ends[-1]) + np.repeat(starts - (ends - lengths), lengths)
+
+
+def get_allele_counts_reads_batch(reads, counts_out, inserts_out,
+                                  qual_min=30, length=None, VERBOSE=0):
+    '''Get allele counts and insertions from a batch of reads
+
+    This gives the same result as get_allele_counts_read for each read, but the
+    batch is decoded into flat arrays of reference position, allele, quality and
+    read type, which are then added to the counts in a single step.
+
+    Parameters:
+       reads (list): the reads to count
+       counts_out (ndarray, read types x alphabet x sequence length): output data
+       structure for counts
+       inserts_out (list of counter dicts): output data structures for
+       insertions, one per read type. The key of each dictionary is the
+       signature of the insertion, (position, insertion)
+    '''
+    if not len(reads):
+        return
+
+    (n_types, n_alpha, length_counts) = counts_out.shape
+    if length is None:
+        length = length_counts
+
+    # Concatenate all sequences and qualities, and collect the CIGAR blocks as
+    # (read type, start in the concatenated read, start in the reference, length)
+    seqs = []
+    quals = []
+    blocks_match = []
+    blocks_del = []
+    offset = 0
+    for read in reads:
+        js = 2 * read.is_read2 + read.is_reverse
+        seq = read.seq
+        qual = read.qual
+        pos = read.pos
+        pos_read = 0
+        for (block_type, block_len) in read.cigar:
+
+            # Check for pos: it should never exceed the length of the fragment
+            if (block_type in [0, 1, 2]) and (pos >= length):
+                raise ValueError('Pos exceeded the length of the fragment')
+
+            # Inline block
+            if block_type == 0:
+                blocks_match.append((js, offset + pos_read, pos, block_len))
+                pos_read += block_len
+                pos += block_len
+
+            # Deletion
+            elif block_type == 2:
+                blocks_del.append((js, 0, pos, block_len))
+                pos += block_len
+
+            # Insertion (rare, so we can afford to check them one by one)
+            elif block_type == 1:
+                qualb = np.fromstring(qual[pos_read: pos_read + block_len], np.int8) - 33
+                if (qualb >= qual_min).all():
+                    inserts_out[js][(pos, seq[pos_read: pos_read + block_len])] += 1
+                pos_read += block_len
+
+            # Other types of cigar?
+            else:
+                raise ValueError('CIGAR type '+str(block_type)+' not recognized')
+
+        seqs.append(seq)
+        quals.append(qual)
+        offset += len(seq)
+
+    # Lookup table from ASCII to allele index
+    alpha_table = np.repeat(-1, 256)
+    alpha_table[np.fromstring(alpha.tostring(), np.uint8)] = np.arange(len(alpha))
+
+    poss = []
+    alls = []
+    rts = []
+    if blocks_match:
+        blocks_match = np.array(blocks_match, int)
+        lens = blocks_match[:, 3]
+        ind_read = _expand_blocks(blocks_match[:, 1], lens)
+        seq = alpha_table[np.fromstring(''.join(seqs), np.uint8)[ind_read]]
+        qual = np.fromstring(''.join(quals), np.int8)[ind_read] - 33
+        ind = (seq != -1) & (qual >= qual_min)
+
+        poss.append(_expand_blocks(blocks_match[:, 2], lens)[ind])
+        alls.append(seq[ind])
+        rts.append(np.repeat(blocks_match[:, 0], lens)[ind])
+
+    if blocks_del:
+        blocks_del = np.array(blocks_del, int)
+        lens = blocks_del[:, 3]
+        poss.append(_expand_blocks(blocks_del[:, 2], lens))
+        alls.append(np.repeat(alphal.index('-'), lens.sum()))
+        rts.append(np.repeat(blocks_del[:, 0], lens))
+
+    if not poss:
+        return
+
+    poss = np.concatenate(poss)
+    if len(poss) and (poss.max() >= length_counts):
+        raise ValueError('Pos exceeded the length of the fragment')
+
+    ind_flat = (np.concatenate(rts) * n_alpha + np.concatenate(alls)) * length_counts + poss
+    counts_out += np.bincount(ind_flat,
+                              minlength=counts_out.size).reshape(counts_out.shape)
+
+
 def get_allele_counts_aa_read(read, start, end, counts_out, qual_min=30,
                               VERBOSE=0):
     '''Get allele counts as amino acids from a single read.
@@ -200,7 +314,8 @@ def get_allele_counts_aa_read(read, start, end, counts_out, qual_min=30,
 
 def get_allele_counts_insertions_from_file(bamfilename, length, qual_min=30,
                                            maxreads=-1, VERBOSE=0,
-                                           merge_read_types=False):
+                                           merge_read_types=False,
+                                           chunksize=10000):
     '''Get the allele counts and insertions
     
     Parameters
@@ -210,6 +325,7 @@ def get_allele_counts_insertions_from_file(bamfilename, length, qual_min=30,
        qual_min (int): minimal PHRED quality of the base to be counted
        maxreads (int): maximal number of reads to scan (-1: all reads)
        VERBOSE (int): verbosity level
+       chunksize (int): number of reads counted together in one batch
 
     Returns
        counts (matrix): allele count matrix, <alphabet size> x length
@@ -223,6 +339,7 @@ def get_allele_counts_insertions_from_file(bamfilename, length, qual_min=30,
 
     # Note: the reads should already be filtered of unmapped stuff at this point
     with pysam.Samfile(bamfilename, 'rb') as bamfile:
+        reads = []
         for i, read in enumerate(bamfile):
 
             # Max number of reads
@@ -234,14 +351,20 @@ def get_allele_counts_insertions_from_file(bamfilename, length, qual_min=30,
             # Print output
             if (VERBOSE >= 3) and (not ((i +1) % 1000)):
                 print (i+1)
-        
-            # Divide by read 1/2 and forward/reverse
-            js = 2 * read.is_read2 + read.is_reverse
 
-            get_allele_counts_read(read, counts[js], inserts[js],
-                                   length=length,
-                                   qual_min=qual_min,
-                                   VERBOSE=VERBOSE)
+            # Reads are divided by read 1/2 and forward/reverse in the batch
+            reads.append(read)
+            if len(reads) == chunksize:
+                get_allele_counts_reads_batch(reads, counts, inserts,
+                                              length=length,
+                                              qual_min=qual_min,
+                                              VERBOSE=VERBOSE)
+                reads = []
+
+        get_allele_counts_reads_batch(reads, counts, inserts,
+                                      length=length,
+                                      qual_min=qual_min,
+                                      VERBOSE=VERBOSE)
 
     if merge_read_types:
         counts = counts.sum(axis=0)
@@ -419,73 +542,94 @@ def get_allele_counts_insertions_from_file_unfiltered(bamfilename, length, qual_
     return (counts, inserts)
 
 
+def get_strand_bias_pvalues(counts_f, nocounts_f, counts_b, nocounts_b):
+    '''P-values of chi2 tests of forward vs reverse counts, for many 2x2 tables
+
+    Parameters:
+       counts_f, nocounts_f, counts_b, nocounts_b (arrays): the four cells of the
+       contingency tables, all with the same shape
+
+    This is the same as calling scipy.stats.chi2_contingency on each table (with
+    Yates' correction), but vectorized. Like recent scipy versions, the correction
+    never shifts the observed counts past the expected ones.
+    '''
+    from scipy.stats import chi2
+
+    tables = [np.asarray(x, float) for x in (counts_f, nocounts_f, counts_b, nocounts_b)]
+    (a, b, c, d) = tables
+    n = a + b + c + d
+
+    # Expected counts under independence, and the deviation |O - E| (the same
+    # for all four cells of a 2x2 table), with Yates' continuity correction
+    # (shifting each observed count by 0.5 towards the expected one, but not
+    # past it)
+    expected = [(a + b) * (a + c) / n,
+                (a + b) * (b + d) / n,
+                (c + d) * (a + c) / n,
+                (c + d) * (b + d) / n]
+    delta = np.abs(a * d - b * c) / n
+    delta = np.maximum(delta - 0.5, 0)
+    stat = delta**2 * sum(1.0 / e for e in expected)
+    return chi2.sf(stat, 1)
+
+
 def filter_nus(counts, coverage=None, VERBOSE=0):
-    '''Filter allele frequencies from the four read types'''
-    from scipy.stats import chi2_contingency
+    '''Filter allele frequencies from the four read types
+
+    Parameters:
+       counts (ndarray): allele counts, shape (read types, alleles, L), or any
+       number of leading dimensions in addition, e.g. (time, read types, alleles, L)
+       coverage (ndarray): coverage, shape as counts without the allele axis
 
+    Returns:
+       nu_filtered (ndarray or masked array): frequencies, shape as counts
+       without the read type axis; positions covered by neither strand are masked
+    '''
+    counts = np.asarray(counts)
     if coverage is None:
-        coverage = counts.sum(axis=1)
+        coverage = counts.sum(axis=-2)
 
     # Divide binarily
-    nocounts = (coverage - counts.swapaxes(0, 1)).swapaxes(0, 1)
+    nocounts = coverage[..., np.newaxis, :] - counts
 
     # Set counts and similia: sum read1 and read2
-    counts_f = counts[0] + counts[2]
-    counts_b = counts[1] + counts[3]
-    nocounts_f = nocounts[0] + nocounts[2]
-    nocounts_b = nocounts[1] + nocounts[3]
-    cov_f = coverage[0] + coverage[2]
-    cov_b = coverage[1] + coverage[3]
+    counts_f = counts[..., 0, :, :] + counts[..., 2, :, :]
+    counts_b = counts[..., 1, :, :] + counts[..., 3, :, :]
+    nocounts_f = nocounts[..., 0, :, :] + nocounts[..., 2, :, :]
+    nocounts_b = nocounts[..., 1, :, :] + nocounts[..., 3, :, :]
+    cov_f = (coverage[..., 0, :] + coverage[..., 2, :])[..., np.newaxis, :]
+    cov_b = (coverage[..., 1, :] + coverage[..., 3, :])[..., np.newaxis, :]
+    cov = coverage.sum(axis=-2)[..., np.newaxis, :]
     ind_low_cov_f = cov_f < 10
     ind_low_cov_b = cov_b < 10
-    ind_high_cov_both = (-ind_low_cov_f) & (-ind_low_cov_b)
-
-    nu_filtered = np.ma.masked_all((len(alpha), counts.shape[-1]))
 
-    # Iterate over positions
-    for i in xrange(counts.shape[-1]):
-        
-        # 1. if we cover neither fwd nor rev, keep masked
-        if ind_low_cov_f[i] and ind_low_cov_b[i]:
-            if VERBOSE >= 4:
-                print 'pos', i, 'not covered'
-            pass
-
-        # 2. if we cover only one of them, well, just take the
-        # arithmetic sum of counts
-        elif ind_low_cov_f[i] != ind_low_cov_b[i]:
-            nu_filtered[:, i] = 1.0 * counts[:, :, i].sum(axis=0) / coverage[:, i].sum()
-            if VERBOSE >= 4:
-                print 'pos', i, 'covered only once'
-                
-        # 3. If we cover both, check whether the counts are significantly different
-        else:
-
-            # Check all alleles
-            for j in xrange(len(alpha)):
-                # To make a table, you must have coverage for both
-                cm = np.array([[counts_f[j, i], nocounts_f[j, i]],
-                               [counts_b[j, i], nocounts_b[j, i]]], int)
-                chi2, pval = chi2_contingency(cm + 1)[:2]
-    
-                # If they are not significantly different, sum the counts
-                if (pval > 1e-6):
-                    nu_filtered[j, i] = 1.0 * counts[:, j, i].sum(axis=0) / coverage[:, i].sum()
-                # If they are different by a significant and reasonable amount, take
-                # the value further away from 0.5
-                else:
-                    nu_f = 1.0 * counts_f[j, i] / cov_f[i]
-                    nu_b = 1.0 * counts_b[j, i] / cov_b[i]
-                    if np.abs(nu_f - 0.5) > np.abs(nu_b - 0.5):
-                        nu_filtered[j, i] = nu_f
-                    else:
-                        nu_filtered[j, i] = nu_b
-
-                    if VERBOSE >= 3:
-                        print 'pos', i, 'base', alpha[j], 'nu_f', nu_f, 'nu_b', nu_b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nu_sum = 1.0 * counts.sum(axis=-3) / cov
+        nu_f = 1.0 * counts_f / cov_f
+        nu_b = 1.0 * counts_b / cov_b
+        nu_strand = np.where(np.abs(nu_f - 0.5) > np.abs(nu_b - 0.5), nu_f, nu_b)
+
+    # 1. if we cover neither fwd nor rev, keep masked
+    # 2. if we cover only one of them, well, just take the
+    # arithmetic sum of counts
+    # 3. If we cover both, check whether the counts are significantly different:
+    # if they are not, sum the counts; if they are, take the value further
+    # away from 0.5 (pseudocounts make all tables valid)
+    pvals = get_strand_bias_pvalues(counts_f + 1, nocounts_f + 1,
+                                    counts_b + 1, nocounts_b + 1)
+    ind_biased = (pvals <= 1e-6) & (~ind_low_cov_f) & (~ind_low_cov_b)
+    nu_filtered = np.where(ind_biased, nu_strand, nu_sum)
+
+    mask = np.broadcast_to(ind_low_cov_f & ind_low_cov_b, nu_filtered.shape)
+    nu_filtered = np.ma.masked_array(nu_filtered, mask=mask.copy())
+
+    if VERBOSE >= 3:
+        print 'Positions not covered:', (ind_low_cov_f & ind_low_cov_b).sum()
+        print 'Positions covered only once:', (ind_low_cov_f != ind_low_cov_b).sum()
+        print 'Alleles with strand bias:', ind_biased.sum()
 
     # Renormalize to 1
-    nu_filtered /= nu_filtered.sum(axis=0)
+    nu_filtered /= nu_filtered.sum(axis=-2)[..., np.newaxis, :]
 
     # Get rid of the mask if not needed
     if not nu_filtered.mask.any():
@@ -699,12 +843,16 @@ def build_consensus_from_allele_counts_insertions(counts, inserts,
 
 def build_consensus_from_mapped_reads(bamfilename, maxreads=2000, block_len=100,
                                       min_reads_per_group=30,
-                                      len_fragment=2000, VERBOSE=0):
+                                      len_fragment=2000, VERBOSE=0, threads=1):
     '''Build a better consensus from an assembly of a few mapped reads
     
     This method exploits local linkage information to get frameshifts right.
+
+    Parameters:
+       threads (int): number of alignment processes running at the same time
     '''
     from hivwholeseq.utils.mapping import extract_mapped_reads_subsample_object
+    from hivwholeseq.utils.msa import align_muscle_batch
 
     if VERBOSE >= 1:
         print 'Building consensus from mapped reads:', bamfilename
@@ -746,17 +894,21 @@ def build_consensus_from_mapped_reads(bamfilename, maxreads=2000, block_len=100,
     if VERBOSE >= 2:
         print 'Aligning groups and picking consensus blocks'
 
-    # MSA within each group
-    conss = []
-    for irg, read_grouped in enumerate(reads_grouped):
-
-        # Pick a few random ones out (or all if there are less than that)
+    # Pick a few random ones out of each group (or all if there are less than that)
+    seqs_groups = []
+    for read_grouped in reads_grouped:
         ind = np.arange(len(read_grouped))
         np.random.shuffle(ind)
         ind = ind[:min_reads_per_group]
         read_grouped_rnd = [read_grouped[i] for i in ind]
-        ali = align_muscle(*[SeqRecord(Seq(s, ambiguous_dna), id=str(i))
-                             for (i, s) in enumerate(read_grouped_rnd)])
+        seqs_groups.append([SeqRecord(Seq(s, ambiguous_dna), id=str(i))
+                            for (i, s) in enumerate(read_grouped_rnd)])
+
+    # MSA within each group, all submitted at once
+    alis = align_muscle_batch(seqs_groups, threads=threads)
+
+    conss = []
+    for irg, ali in enumerate(alis):
 
         # Trim alignment to start from the first common position (this exists
         # because we binned reads according to their start!). In addition, every
@@ -6,11 +6,15 @@ content:    Support module with sequence utility functions which for some reason
             are missing from Biopython.
 '''
 # Modules
+import os
 from numpy import array
 from hivwholeseq.utils.genome_info import genes as genes_all
 
 
 # Globals
+# Default backend of align_muscle ('muscle' or 'center_star')
+msa_backend = os.getenv('HIVWHOLESEQ_MSA_BACKEND', 'muscle')
+
 # Alphabet of nucleotides
 alphas = 'ACGT-N'
 alphal = list(alphas)
@@ -61,46 +65,32 @@ def align_pairwise(seq1, seq2, method='global', **kwargs):
 
 
 def align_muscle(*seqs, **kwargs):
-    '''Global alignment of sequences via MUSCLE'''
-    import subprocess as sp
-    from Bio import AlignIO, SeqIO
-    from Bio.Align.Applications import MuscleCommandline
-    
+    '''Global alignment of sequences via MUSCLE
+
+    Parameters:
+       sort (bool): sort the rows of the alignment as the input sequences
+       backend (str): 'muscle' (default) or 'center_star', an in-process
+       aligner for small alignments (see utils/msa.py)
+    '''
+    from hivwholeseq.utils.msa import get_seqrecords, sort_alignment, \
+            start_muscle, finish_muscle, align_center_star
+
     if not len(seqs):
         return None
 
     # Convert to SeqRecord if required
-    if isinstance(seqs[0], basestring):
-        from Bio.Seq import Seq
-        from Bio.SeqRecord import SeqRecord
-        from Bio.Alphabet import single_letter_alphabet
-        seqs = [SeqRecord(Seq(s, single_letter_alphabet),
-                          id='seq'+str(i+1),
-                          name='seq'+str(i+1),
-                          description='seq'+str(i+1))
-                for i, s in enumerate(seqs)]
-
-    muscle_cline = MuscleCommandline(diags=True, quiet=True)
-    child = sp.Popen(str(muscle_cline),
-                     stdin=sp.PIPE,
-                     stdout=sp.PIPE,
-                     stderr=sp.PIPE,
-                     shell=True)
-    SeqIO.write(seqs, child.stdin, "fasta")
-    child.stdin.close()
-    align = AlignIO.read(child.stdout, "fasta")
-    child.stderr.close()
-    child.stdout.close()
+    seqs = get_seqrecords(seqs)
+
+    backend = kwargs.get('backend', msa_backend)
+    if backend == 'center_star':
+        return align_center_star(seqs)
+    elif backend != 'muscle':
+        raise ValueError('MSA backend not found: '+str(backend))
+
+    align = finish_muscle(start_muscle(seqs))
 
     if ('sort' in kwargs) and kwargs['sort']:
-        from Bio.Align import MultipleSeqAlignment as MSA
-        alisort = []
-        for seq in seqs:
-            for row in align:
-                if row.id == seq.id:
-                    alisort.append(row)
-                    break
-        align = MSA(alisort)
+        align = sort_alignment(align, seqs)
 
     return align
 
@@ -0,0 +1,85 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Cached access to the sheets of the general table (HIV_table.xlsx).
+'''
+# Modules
+from __future__ import absolute_import
+import os
+import cPickle as pickle
+
+
+
+# Globals
+_tables = {}
+
+
+
+# Functions
+def read_table_sheet(sheetname, index_col=0, use_disk_cache=True):
+    '''Read a sheet of the general table, parsing the workbook only when needed
+
+    Parameters:
+       sheetname (str): name of the sheet in the workbook
+       index_col (int): column to use as index
+       use_disk_cache (bool): keep a binary copy of the sheet on disk, to skip
+       parsing the workbook in new processes
+
+    Each sheet is kept in memory for the process lifetime and, optionally, as a
+    pickled DataFrame (which stores the columns as contiguous arrays) on disk.
+    Both copies are invalidated when the modification time of the workbook
+    changes.
+
+    Returns:
+       table (pd.DataFrame): a copy of the sheet, safe to modify
+    '''
+    import pandas as pd
+    from hivwholeseq.filenames import table_filename, get_table_cache_filename
+
+    mtime = os.path.getmtime(table_filename)
+    key = (sheetname, index_col)
+
+    # 1. Memory
+    if (key in _tables) and (_tables[key][0] == mtime):
+        return _tables[key][1].copy()
+
+    # 2. Disk
+    table = None
+    fn_cache = get_table_cache_filename(sheetname, index_col=index_col)
+    if use_disk_cache and os.path.isfile(fn_cache):
+        try:
+            with open(fn_cache, 'rb') as f:
+                (mtime_cache, table_cache) = pickle.load(f)
+            if mtime_cache == mtime:
+                table = table_cache
+        except (IOError, EOFError, pickle.UnpicklingError):
+            pass
+
+    # 3. Workbook
+    if table is None:
+        table = pd.read_excel(table_filename, sheetname, index_col=index_col)
+
+        if use_disk_cache:
+            write_table_cache(fn_cache, mtime, table)
+
+    _tables[key] = (mtime, table)
+    return table.copy()
+
+
+def write_table_cache(filename, mtime, table):
+    '''Write the binary cache of a sheet, atomically and only if possible'''
+    from hivwholeseq.utils.generic import mkdirs
+    try:
+        mkdirs(os.path.dirname(filename))
+        fn_tmp = filename+'.'+str(os.getpid())+'.tmp'
+        with open(fn_tmp, 'wb') as f:
+            pickle.dump((mtime, table), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(fn_tmp, filename)
+    except (IOError, OSError):
+        pass
+
+
+def clear_table_cache():
+    '''Clear the in-memory cache of the general table'''
+    _tables.clear()
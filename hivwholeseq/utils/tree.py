@@ -4,6 +4,11 @@ author:     Fabio Zanini
 date:       11/09/14
 content:    Support module with tree utility functions.
 '''
+# Modules
+from itertools import izip
+
+
+
 # Functions
 def build_tree_fasttree(filename_or_ali, rootname=None, VERBOSE=0):
     '''Build phylogenetic tree using FastTree
@@ -114,43 +119,58 @@ def correct_minimal_branches(tree, cutoff=1e-3, min_length=1e-8, VERBOSE=0):
                 node.branch_length = min_length
 
 
-def find_parent(tree, node):
-    '''Find the parent node of a tree node'''
-    return tree.root.get_path(node)[-2]
+def get_parent_map(tree):
+    '''Map each node of a tree to its parent, in a single traversal
 
+    Returns:
+       parents (dict): node -> parent node (the root is missing)
+    '''
+    parents = {}
+    stack = [tree.root]
+    while stack:
+        node = stack.pop()
+        for child in node.clades:
+            parents[child] = node
+            stack.append(child)
+    return parents
 
-def get_path_toroot(tree, node):
-    '''Get the path to root'''
-    return tree.root.get_path(node)[::-1]
 
+def find_parent(tree, node, parents=None):
+    '''Find the parent node of a tree node
 
-def tree_to_json(node,
-                 fields=('DSI', 'seq', 'muts',
-                         'fmax', 'freq',
-                         'readcount',
-                         'VL', 'CD4',
-                         'confidence'),
-                ):
-    '''Convert tree in nested dictionary (JSON)'''
-    from numpy import isnan
+    Parameters:
+       parents (dict): parent map from get_parent_map, to avoid a tree search
+    '''
+    if parents is None:
+        return tree.root.get_path(node)[-2]
+    return parents[node]
 
-    if fields is None:
-        fieldsnode = set(node.__dict__.keys())
-        fieldsnode -= set(['clades', 'width', '_color'])
 
-    else:
-        fieldsnode = ['name', 'branch_length'] + list(fields)
+def get_path_toroot(tree, node, parents=None):
+    '''Get the path to root
+
+    Parameters:
+       parents (dict): parent map from get_parent_map, to avoid a tree search
+    '''
+    if parents is None:
+        return tree.root.get_path(node)[::-1]
 
+    # NOTE: like Bio.Phylo's get_path, the root itself is excluded
+    path = []
+    while node in parents:
+        path.append(node)
+        node = parents[node]
+    return path
+
+
+def _node_to_json(node, fieldsnode, isnan):
+    '''Convert the fields of one tree node (without children) into a dict'''
     json = {}
     for field in fieldsnode:
-        if not hasattr(node, field):
-            json[field] = "undefined"
-            continue
-
-        val = getattr(node, field)
+        val = getattr(node, field, None)
         if val is None:
             # The root is missing a branch length (maybe a FastTree or Biopython bug)
-            if field == 'branch_length': 
+            if (field == 'branch_length') and hasattr(node, field):
                 json[field] = 0
                 continue
 
@@ -171,15 +191,47 @@ def tree_to_json(node,
 
         json[field] = val
 
-    # repeat for all children
-    if len(node.clades):
-        json["children"] = []
-        for ch in node.clades:
-            json["children"].append(tree_to_json(ch, fields=fields))
-
     return json
 
 
+def tree_to_json(node,
+                 fields=('DSI', 'seq', 'muts',
+                         'fmax', 'freq',
+                         'readcount',
+                         'VL', 'CD4',
+                         'confidence'),
+                ):
+    '''Convert tree in nested dictionary (JSON)'''
+    from numpy import isnan
+
+    if fields is not None:
+        fieldsnode = ['name', 'branch_length'] + list(fields)
+
+    # Visit the tree with a stack instead of recursive calls
+    json_root = None
+    stack = [(node, None)]
+    while stack:
+        (node, json_parent) = stack.pop()
+
+        if fields is None:
+            fieldsnode = set(node.__dict__.keys())
+            fieldsnode -= set(['clades', 'width', '_color'])
+
+        json = _node_to_json(node, fieldsnode, isnan)
+        if json_parent is None:
+            json_root = json
+        else:
+            json_parent["children"].append(json)
+
+        # repeat for all children, in order
+        if len(node.clades):
+            json["children"] = []
+            for ch in reversed(node.clades):
+                stack.append((ch, json))
+
+    return json_root
+
+
 def tree_from_json(json):
     '''Convert JSON into a Biopython tree'''
     from Bio import Phylo
@@ -213,32 +265,33 @@ def add_mutations_tree(tree, translate=False,
                        mutation_attrname='muts'):
     '''Add mutations to a tree
     
-    NOTE: the nodes must have sequences already
+    NOTE: the nodes must have sequences already, all of the same length
     '''
     import numpy as np
     from Bio.Seq import translate as tran
-    from hivwholeseq.utils.tree import find_parent
-
-    # NOTE: the root has no mutations by definition
-    for node in tree.get_terminals() + tree.get_nonterminals():
-        try:
-            parent = find_parent(tree, node)
-        except IndexError:
-            continue
-
-        pseq = getattr(parent, sequence_attrname)
-        nseq = getattr(node, sequence_attrname)
-
-        if translate:
-            pseq = tran(pseq)
-            nseq = tran(nseq)
-
-        pseqm = np.fromstring(pseq, 'S1')
-        nseqm = np.fromstring(nseq, 'S1')
-        posm = (pseqm != nseqm).nonzero()[0]
-        muts = [pseqm[p]+str(p+1)+nseqm[p] for p in posm]
 
-        setattr(node, mutation_attrname, ', '.join(muts))
+    parents = get_parent_map(tree)
+    nodes = [tree.root] + parents.keys()
+    node_index = {node: i for i, node in enumerate(nodes)}
+
+    # Each sequence is read (and translated) once
+    seqs = [getattr(node, sequence_attrname) for node in nodes]
+    if translate:
+        seqs = map(tran, seqs)
+    seqs = map(str, seqs)
+    if len(set(map(len, seqs))) > 1:
+        raise ValueError('The sequences of the tree nodes must have the same length')
+    seqsm = np.array(map(list, seqs), 'S1', ndmin=2)
+
+    # Compare all edges at once (the root has no mutations by definition)
+    ind_parents = np.array([node_index[parents[node]] for node in nodes[1:]], int)
+    (edges, poss) = (seqsm[1:] != seqsm[ind_parents]).nonzero()
+    muts = [[] for node in nodes[1:]]
+    for (edge, pos) in izip(edges, poss):
+        muts[edge].append(seqsm[ind_parents[edge], pos]+str(pos+1)+seqsm[edge + 1, pos])
+
+    for node, mutsnode in izip(nodes[1:], muts):
+        setattr(node, mutation_attrname, ', '.join(mutsnode))
 
 
 def filter_rare_leaves(tree, freqmin, VERBOSE=0):
@@ -11,37 +11,123 @@ import numpy as np
 from itertools import izip
 import pysam
 
-from .miseq import alpha, alphal
+from .miseq import alpha, alphal, alphas
 from .mapping import pair_generator
 
 
+# Globals
+# Conversion table from ASCII to allele index
+_alpha_table = np.repeat(-1, 256)
+_alpha_table[np.fromstring(alphas, np.uint8)] = np.arange(len(alphas))
+
 
 
 # Functions
+def get_allele_calls_read_pair(reads, qual_min=30, rng=None):
+    '''Get the allele calls of a read pair, merging the overlap of the mates
+
+    Parameters:
+       reads (pair of reads): the read pair
+       qual_min (int): minimal PHRED quality of the base to be called
+       rng (numpy.random.RandomState): random number generator, used to pick
+       one of the two calls when the mates disagree at an overlap
+
+    Returns:
+       (pos, aind): sorted reference positions and allele indices, one per
+       position
+    '''
+    if rng is None:
+        rng = np.random
+
+    poss = []
+    ainds = []
+    for read in reads:
+        alleles_ind = _alpha_table[np.fromstring(read.seq, np.uint8)]
+        allqual_ind = np.fromstring(read.qual, np.uint8) - 33
+
+        pos_ref = read.pos
+        pos_read = 0
+        for (bt, bl) in read.cigar:
+            if bt == 1:
+                pos_read += bl
+            elif bt == 2:
+                # NOTE: no CIGAR can start NOR end with a deletion
+                qual_deletion = allqual_ind[pos_read: pos_read + 2].min()
+                if qual_deletion >= qual_min:
+                    poss.append(np.arange(pos_ref, pos_ref + bl))
+                    ainds.append(np.repeat(4, bl))
+                pos_ref += bl
+            else:
+                alleles_indb = alleles_ind[pos_read: pos_read + bl]
+                allqual_indb = allqual_ind[pos_read: pos_read + bl]
+                ind = (alleles_indb != -1) & (allqual_indb >= qual_min)
+                poss.append(ind.nonzero()[0] + pos_ref)
+                ainds.append(alleles_indb[ind])
+                pos_read += bl
+                pos_ref += bl
+
+    if not poss:
+        return (np.zeros(0, int), np.zeros(0, int))
+
+    pos = np.concatenate(poss)
+    aind = np.concatenate(ainds)
+    ind = np.lexsort((aind, pos))
+    pos = pos[ind]
+    aind = aind[ind]
+
+    # Avoid doubles (paired reads are twice the same biological molecule):
+    # if both reads agree @ an overlap allele, take a single call, else pick
+    # one at random (FIXME: pick the highest phred)
+    idup = (pos[1:] == pos[:-1]).nonzero()[0]
+    if len(idup):
+        idrop = idup + 1
+        disagree = aind[idup] != aind[idup + 1]
+        idrop[disagree] = idup[disagree] + rng.randint(2, size=disagree.sum())
+        keep = np.ones(len(pos), bool)
+        keep[idrop] = False
+        pos = pos[keep]
+        aind = aind[keep]
+
+    return (pos, aind)
+
+
 def get_coallele_counts_from_file(bamfilename, length, qual_min=30,
                                   maxreads=-1, VERBOSE=0,
-                                  use_tests=False):
-    '''Get counts of join occurence of two alleles'''
-    from .utils.mapping import (test_read_pair_exotic_cigars,
-                                test_read_pair_exceed_reference)
+                                  use_tests=False,
+                                  sparse=False,
+                                  seed=None):
+    '''Get counts of join occurence of two alleles
+
+    Parameters:
+       sparse (bool): return the compact upper-triangular representation (see
+       sparsify_coallele_counts) instead of the dense (alpha x alpha x length
+       x length) matrix. The dense matrix is never allocated in this case.
+       seed (int): seed for the random choice between the mates when they
+       disagree at an overlap (None: do not reseed)
+    '''
+    from .mapping import (test_read_pair_exotic_cigars,
+                          test_read_pair_exceed_reference)
 
     if VERBOSE >= 1:
         print 'Getting coallele counts'
 
+    if seed is not None:
+        rng = np.random.RandomState(seed)
+    else:
+        rng = np.random
 
-    # Precompute conversion tables
-    alpha_mapping = {a: alphal.index(a) for a in alphal}
-    SANGER_SCORE_OFFSET = ord("!")
-    q_mapping = dict()
-    for letter in xrange(0, 255):
-        q_mapping[chr(letter)] = letter - SANGER_SCORE_OFFSET
-    
     if VERBOSE >= 2:
         print 'Initializing matrix of cocounts'
 
     # NOTE: we are ignoring fwd/rev and read1/2
-    counts = np.zeros((len(alpha), len(alpha), length, length), int)
-    posall = np.zeros(1000, dtype=[('pos', int), ('aind', int)])
+    if not sparse:
+        counts = np.zeros((len(alpha), len(alpha), length, length), int)
+    else:
+        # Only pairs of positions within the same read pair are ever covered,
+        # so we keep a band of pos2 - pos1 and widen it when needed
+        band = 256
+        counts = np.zeros((len(alpha), len(alpha), length, band), np.uint32)
+        triu_cache = {}
 
     if VERBOSE >= 2:
         from hivwholeseq.utils.mapping import get_number_reads
@@ -67,79 +153,175 @@ def get_coallele_counts_from_file(bamfilename, length, qual_min=30,
                 if test_read_pair_exceed_reference(reads, length):
                     raise ValueError('Read pair exceeds reference length of '+str(length))
 
+            (pos, aind) = get_allele_calls_read_pair(reads, qual_min=qual_min,
+                                                     rng=rng)
+            if not len(pos):
+                continue
+
+            # Add allele cocounts to the matrix in a single scatter. The flat
+            # index of (a1, a2, pos1, pos2) is a sum of a term in (a1, pos1)
+            # and one in (a2, pos2), so we build it by broadcasting.
+            # NOTE: positions are unique within the pair, hence so are indices
+            if not sparse:
+                ind1 = (aind * len(alpha) * length + pos) * length
+                ind2 = aind * length * length + pos
+                ind = (ind1[:, np.newaxis] + ind2).ravel()
+
+            else:
+                # Widen the band if this read pair spans more
+                span = pos[-1] - pos[0] + 1
+                if span > band:
+                    band_new = min(length, 2**int(np.ceil(np.log2(span))))
+                    counts_new = np.zeros((len(alpha), len(alpha), length, band_new),
+                                          np.uint32)
+                    counts_new[:, :, :, :band] = counts
+                    counts = counts_new
+                    band = band_new
+
+                # Positions are sorted, so the upper triangle has pos1 <= pos2
+                n = len(pos)
+                if n not in triu_cache:
+                    triu_cache[n] = np.triu_indices(n)
+                ind1 = aind * len(alpha) * length * band + pos * (band - 1)
+                ind2 = aind * length * band + pos
+                ind = (ind1[:, np.newaxis] + ind2)[triu_cache[n]]
 
-            # Temp structures
-            posall[:] = (-1, -1)
-            iall = 0
-
-            # Collect alleles
-            for read in reads:
-                alleles_ind = np.fromiter((alpha_mapping[x] for x in read.seq),
-                                          np.uint8, len(read.seq))
-                allqual_ind = np.fromiter((q_mapping[x] for x in read.qual),
-                                          np.uint8, len(read.qual))
-
-                pos_ref = read.pos
-                pos_read = 0
-                for (bt, bl) in read.cigar:
-                    if bt == 1:
-                        pos_read += bl
-                    elif bt == 2:
-                        # NOTE: no CIGAR can start NOR end with a deletion
-                        qual_deletion = allqual_ind[pos_read: pos_read + 2].min()
-                        if qual_deletion >= qual_min:
-                            posall['pos'][iall: iall + bl] = np.arange(pos_ref,
-                                                                       pos_ref + bl)
-                            posall['aind'][iall: iall + bl] = 4
-                            iall += bl
-                        pos_ref += bl
-                    else:
-                        alleles_indb = alleles_ind[pos_read: pos_read + bl]
-                        allqual_indb = allqual_ind[pos_read: pos_read + bl]
-                        for i in xrange(len(alpha)):
-                            aitmp = (alleles_indb == i) & (allqual_indb >= qual_min)
-                            aitmp = aitmp.nonzero()[0] + pos_ref
-                            aitmplen = len(aitmp)
-                            posall['pos'][iall: iall + aitmplen] = aitmp
-                            posall['aind'][iall: iall + aitmplen] = i
-                            iall += aitmplen
-
-                        pos_read += bl
-                        pos_ref += bl
-
-            # Avoid doubles (paired reads are twice the same biological molecule)
-            posall.sort(order=('pos', 'aind'))
-            iall = (posall['pos'] != -1).nonzero()[0][0]
-            while iall < len(posall) - 1:
-                if posall['pos'][iall + 1] == posall['pos'][iall]:
-
-                    # If both reads agree @ an overlap allele, take a single call
-                    if posall['aind'][iall + 1] == posall['aind'][iall]:
-                        posall[iall + 1] = (-1, -1)
-
-                    # else, pick one at random (FIXME: pick the highest phred)
-                    else:
-                        ibin = np.random.randint(2)
-                        posall[iall + ibin] = (-1, -1)
-
-                    iall += 1
-                iall += 1
-
-            # Add allele cocounts to the matrix
-            # NOTE: this already takes care of the symmetry
-            poss = [posall['pos'][posall['aind'] == i1] for i1 in xrange(len(alpha))]
-            for i1 in xrange(len(alpha)):
-                poss1 = poss[i1]
-                if not len(poss1):
-                    continue
-                for i2 in xrange(len(alpha)):
-                    poss2 = poss[i2]
-                    if not len(poss2):
-                        continue
-
-                    # Raveling vodoo for efficiency
-                    cobra = counts[i1, i2].ravel()
-                    ind = poss1.repeat(len(poss2)) * length + np.tile(poss2, len(poss1))
-                    cobra[ind] += 1
+            counts.ravel()[ind] += 1
+
+    if sparse:
+        (a1, a2, pos1, dpos) = counts.nonzero()
+        counts = {'length': length,
+                  'pos1': pos1,
+                  'pos2': pos1 + dpos,
+                  'allele1': a1,
+                  'allele2': a2,
+                  'counts': counts[a1, a2, pos1, dpos],
+                 }
+        counts = _shrink_coallele_counts_sparse(counts)
 
     return counts
+
+
+def _shrink_coallele_counts_sparse(cocounts):
+    '''Cast sparse cocounts to the smallest integer dtypes that fit'''
+    length = cocounts['length']
+    cocounts['pos1'] = cocounts['pos1'].astype(np.min_scalar_type(length))
+    cocounts['pos2'] = cocounts['pos2'].astype(np.min_scalar_type(length))
+    cocounts['allele1'] = cocounts['allele1'].astype(np.uint8)
+    cocounts['allele2'] = cocounts['allele2'].astype(np.uint8)
+    if len(cocounts['counts']):
+        cmax = cocounts['counts'].max()
+    else:
+        cmax = 0
+    cocounts['counts'] = cocounts['counts'].astype(np.min_scalar_type(cmax))
+    return cocounts
+
+
+def sparsify_coallele_counts(counts):
+    '''Convert dense allele cocounts into the compact representation
+
+    The compact representation is a dict with the length of the reference and
+    the coordinates (pos1, pos2, allele1, allele2) and counts of the nonzero
+    entries. Since the dense matrix is symmetric, only pos1 <= pos2 is kept.
+    Entries are sorted by pos1 and stored with the smallest dtypes that fit.
+    '''
+    length = counts.shape[-1]
+    data = {key: [] for key in ('pos1', 'pos2', 'allele1', 'allele2', 'counts')}
+    # NOTE: go allele by allele, to avoid copying the whole matrix at once
+    for a1 in xrange(counts.shape[0]):
+        for a2 in xrange(counts.shape[1]):
+            (pos1, pos2) = np.triu(counts[a1, a2]).nonzero()
+            data['pos1'].append(pos1)
+            data['pos2'].append(pos2)
+            data['allele1'].append(np.repeat(a1, len(pos1)))
+            data['allele2'].append(np.repeat(a2, len(pos1)))
+            data['counts'].append(counts[a1, a2, pos1, pos2])
+
+    cocounts = {key: np.concatenate(value) for key, value in data.iteritems()}
+    cocounts['length'] = length
+    cocounts = sort_coallele_counts_sparse(cocounts)
+    return _shrink_coallele_counts_sparse(cocounts)
+
+
+def sort_coallele_counts_sparse(cocounts):
+    '''Sort sparse cocounts by pos1, pos2, allele1, allele2'''
+    ind = np.lexsort((cocounts['allele2'], cocounts['allele1'],
+                      cocounts['pos2'], cocounts['pos1']))
+    for key in ('pos1', 'pos2', 'allele1', 'allele2', 'counts'):
+        cocounts[key] = cocounts[key][ind]
+    return cocounts
+
+
+def densify_coallele_counts(cocounts):
+    '''Convert compact allele cocounts into the dense symmetric matrix'''
+    length = cocounts['length']
+    counts = np.zeros((len(alpha), len(alpha), length, length), int)
+    (pos1, pos2) = (cocounts['pos1'], cocounts['pos2'])
+    (a1, a2) = (cocounts['allele1'], cocounts['allele2'])
+    counts[a1, a2, pos1, pos2] = cocounts['counts']
+
+    # Fill the lower triangle (the diagonal is there already)
+    ind = pos1 != pos2
+    counts[a2[ind], a1[ind], pos2[ind], pos1[ind]] = cocounts['counts'][ind]
+    return counts
+
+
+def save_coallele_counts_sparse(filename, cocounts, blocksize=100):
+    '''Save compact allele cocounts to file, in blocks of pos1
+
+    Every block is compressed independently, so that a position range can be
+    loaded without decompressing the whole matrix (see load_coallele_counts_sparse).
+    '''
+    cocounts = sort_coallele_counts_sparse(dict(cocounts))
+    length = cocounts['length']
+    n_blocks = (length + blocksize - 1) // blocksize
+    bounds = np.searchsorted(cocounts['pos1'],
+                             np.arange(n_blocks + 1) * blocksize)
+
+    data = {'length': length,
+            'blocksize': blocksize,
+           }
+    for ib in xrange(n_blocks):
+        (i0, i1) = bounds[ib: ib + 2]
+        if i0 == i1:
+            continue
+        for key in ('pos1', 'pos2', 'allele1', 'allele2', 'counts'):
+            data[key+'_'+str(ib)] = cocounts[key][i0: i1]
+
+    np.savez_compressed(filename, **data)
+
+
+def load_coallele_counts_sparse(filename, start=0, end=None):
+    '''Load compact allele cocounts from file, restricted to a position range
+
+    Only pairs with both positions in [start, end) are returned, and their
+    coordinates are shifted by start. Only the blocks overlapping the range
+    are decompressed.
+    '''
+    keys = ('pos1', 'pos2', 'allele1', 'allele2', 'counts')
+    npz = np.load(filename)
+    length = int(npz['length'])
+    blocksize = int(npz['blocksize'])
+    if end is None:
+        end = length
+
+    data = {key: [] for key in keys}
+    for ib in xrange(start // blocksize, (end + blocksize - 1) // blocksize):
+        if 'pos1_'+str(ib) not in npz.files:
+            continue
+        block = {key: npz[key+'_'+str(ib)] for key in keys}
+        ind = ((block['pos1'] >= start) & (block['pos1'] < end) &
+               (block['pos2'] < end))
+        for key in keys:
+            data[key].append(block[key][ind])
+
+    cocounts = {'length': end - start}
+    for key in keys:
+        if data[key]:
+            cocounts[key] = np.concatenate(data[key])
+        else:
+            cocounts[key] = np.zeros(0, np.uint8)
+    cocounts['pos1'] = cocounts['pos1'] - start
+    cocounts['pos2'] = cocounts['pos2'] - start
+
+    return _shrink_coallele_counts_sparse(cocounts)